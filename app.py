@@ -1,23 +1,15 @@
 
 from __future__ import annotations
 
-import json, sys, types
+import json
 from pathlib import Path
 from datetime import datetime
-from typing import Optional
 from llm_tools import prompt  
 
 import streamlit as st
 import pandas as pd
-from stqdm import stqdm
-import tqdm
-
-tqdm.tqdm = stqdm
-sys.modules["tqdm"].tqdm = stqdm
-auto_mod = types.ModuleType("tqdm.auto")
-auto_mod.tqdm = stqdm
-sys.modules["tqdm.auto"] = auto_mod
-from llm_tools import pipeline as llm_eval  # updated path
+from llm_tools.jobs import JobManager, collect_results
+from llm_tools.labels import LabelLog, PagedResults, PendingQueue
 
 
 COL_TEXT   = "report"
@@ -27,6 +19,8 @@ COL_SCORE  = "accuracy_2_score"
 COL_RESULT = "accuracy_3"
 
 NO_ERROR_JSON = {"error": "no error", "error_reason": "N/A"}
+LABEL_COMPACT_EVERY = 200   # labels appended to the log before it is folded into CURRENT_RESULTS.csv
+LABEL_PREFETCH = 3          # upcoming flagged rows parsed in the background while one is labelled
 
 def tmp_save_path() -> Path:
     if "results_dir" not in st.session_state:
@@ -36,9 +30,16 @@ def tmp_save_path() -> Path:
 
     return st.session_state["results_dir"] / "CURRENT_RESULTS.csv"
 
+def label_log_path() -> Path:
+    return tmp_save_path().with_name("CURRENT_LABELS.jsonl")
+
 def final_save_path() -> Path:
     return st.session_state["results_dir"] / "FINAL_RESULTS_DF.csv"
 
+@st.cache_resource
+def job_manager() -> JobManager:
+    return JobManager(prompt.JOBS_DIR)
+
 def parse_error_cell(cell) -> dict:
     if isinstance(cell, dict):
         return cell
@@ -54,55 +55,86 @@ def parse_error_cell(cell) -> dict:
         return {"error": str(cell), "error_reason": "Invalid JSON"}
 
 # ───────────────────────────────
-def ensure_schema(df: pd.DataFrame) -> pd.DataFrame:
-    req = {COL_TEXT, COL_ERROR, COL_SCORE}
-    if not req.issubset(df.columns):
-        raise ValueError(f"CSV must contain: {', '.join(req)}")
-
-    df[COL_SCORE] = (
-        pd.to_numeric(df[COL_SCORE], errors="coerce")
-          .fillna(0)
-          .astype(int)
-    )
-
-    df[COL_ERROR] = df[COL_ERROR].apply(parse_error_cell)
-
-    if COL_RESULT not in df.columns:
-        df[COL_RESULT] = ""
-    else:
-        df[COL_RESULT] = df[COL_RESULT].fillna("")
-    if COL_PREPROCESSED not in df.columns:
-        df[COL_PREPROCESSED] = "{}"
-
-    return df
-
-# ───────────────────────────────
-# CSV load/save
+# Results: paged labeling backend
 # ───────────────────────────────
-def load_csv(file) -> Optional[pd.DataFrame]:
-    if file is None:
-        return None
-    if st.session_state.get("file_name") == file.name and "df" in st.session_state:
-        return st.session_state["df"]
-
+def parse_row(payload: dict) -> dict:
+    """Display form of one flagged row; runs only when the row is fetched."""
+    cell = payload.get(COL_PREPROCESSED) or "{}"
     try:
-        df = pd.read_csv(file)
-    except Exception as e:
-        st.error(f"Failed to read CSV: {e}")
-        return None
+        obj = json.loads(cell)
+        findings, impression = obj.get("findings", ""), obj.get("impression", "")
+    except Exception:
+        findings, impression = str(cell), ""
+    return {"error": parse_error_cell(payload.get(COL_ERROR)), "findings": findings, "impression": impression}
 
-    df = ensure_schema(df)
-    st.session_state.update({"df": df, "file_name": file.name})
-    return df
-
-def save_csv(path: Path):
+def save_results(df: pd.DataFrame, path: Path):
     path.parent.mkdir(parents=True, exist_ok=True)
-    st.session_state["df"].to_csv(path, index=False, encoding="utf-8")
-
-def next_pending_index() -> Optional[int]:
-    df: pd.DataFrame = st.session_state["df"]
-    mask = (df[COL_SCORE] == 0) & (df[COL_RESULT].fillna("") == "")
-    return int(mask.idxmax()) if mask.any() else None
+    if COL_ERROR in df.columns:
+        df = df.assign(**{COL_ERROR: df[COL_ERROR].map(lambda v: json.dumps(v, ensure_ascii=False) if isinstance(v, dict) else v)})
+    tmp = path.with_name(path.name + ".tmp")
+    df.to_csv(tmp, index=False, encoding="utf-8")
+    tmp.replace(path)
+
+def start_labeling(*, fresh: bool):
+    """Open CURRENT_RESULTS.csv for labeling and queue the flagged rows still unlabelled.
+
+    Only the flagged rows' positions and labels are kept in the session; their payloads
+    are fetched on demand. `fresh` starts a new label log (new LLM results); otherwise the
+    log is replayed, which is how a reopened session gets its labels back.
+    """
+    if "paged" in st.session_state:
+        st.session_state.pop("paged").close()
+    paged = PagedResults(
+        tmp_save_path(), score_col=COL_SCORE, label_col=COL_RESULT,
+        payload_cols=[COL_ERROR, COL_PREPROCESSED], parse=parse_row,
+    )
+    path = label_log_path()
+    if fresh:
+        path.unlink(missing_ok=True)
+    try:
+        log = LabelLog(path, paged.fingerprint)
+    except ValueError:
+        st.warning(f"Ignoring {path.name}: it holds labels for different results.")
+        path.unlink()
+        log = LabelLog(path, paged.fingerprint)
+    labels = {**paged.labels, **log.replay()}
+    st.session_state.update({
+        "paged": paged,
+        "label_log": log,
+        "labels": labels,
+        "pending": PendingQueue((p for p in paged.flagged if p not in labels), total=len(paged.flagged)),
+    })
+
+def compact_labels():
+    """Fold the logged labels into CURRENT_RESULTS.csv and start the log over."""
+    st.session_state["paged"].export(tmp_save_path(), st.session_state["labels"])
+    st.session_state["label_log"].clear()
+
+def label_job(job_id: str):
+    """Label the finished part of a background job; call again to add newly finished parts.
+
+    Labels are folded into the job's CURRENT_RESULTS.csv before new rows are appended, so
+    the label log (tied to the file's contents) can start over afterwards.
+    """
+    if "paged" in st.session_state:
+        compact_labels()  # still pointing at the results being labelled until now
+        st.session_state.pop("paged").close()
+    job_dir = job_manager().job_dir(job_id)
+    st.session_state.update({"results_dir": job_dir, "job_id": job_id, "file_name": job_id})
+    st.session_state.pop("final_saved", None)
+    if tmp_save_path().exists() and label_log_path().exists():
+        start_labeling(fresh=False)  # labels logged in an earlier session
+        compact_labels()
+    st.session_state["job_parts"] = collect_results(job_dir, tmp_save_path())
+    if tmp_save_path().exists():
+        start_labeling(fresh=True)  # the log was folded into the file above
+
+def final_columns(chunk: pd.DataFrame) -> pd.DataFrame:
+    chunk = chunk.drop(columns="__part__", errors="ignore")
+    # accuracy_3_score = accuracy_2_score copy, then overwrite FP rows with 1
+    chunk[COL_SCORE] = pd.to_numeric(chunk[COL_SCORE], errors="coerce").fillna(0).astype(int)
+    chunk["accuracy_3_score"] = chunk[COL_SCORE].where(chunk[COL_RESULT] != "FP", 1)
+    return chunk
 
 # ───────────────────────────────
 # Streamlit UI
@@ -124,9 +156,25 @@ st.subheader("📄 MP-RRED: Multi-Pass LLM Radiology Report Error Detector")
 
 # 1️⃣ LLM Evaluation --------------------------------------------------------
 with st.expander("1️⃣  LLM Evaluation", expanded=False):
-    uploaded_file = st.file_uploader("Upload CSV", type="csv")
+    uploaded_files = st.file_uploader("Upload CSV", type="csv", accept_multiple_files=True)
     api_key  = st.text_input("② OpenAI API key", type="password")
     model = st.text_input("③ Model", value="o3")
+    local_pre = st.checkbox(
+        "⚡ Local preprocessing for templated reports",
+        value=False,
+        help="Split Findings/Impression and redact dates/PHI locally; only reports it cannot parse are sent to the 1st-pass LLM.",
+    )
+    dedup = st.checkbox(
+        "🧬 Deduplicate identical reports",
+        value=False,
+        help="Reports identical after preprocessing (ignoring case, whitespace and [DATE]/[PHI]) share one error check and FP check.",
+    )
+    cascade = st.checkbox(
+        "🪜 Screen with a cheap model first",
+        value=False,
+        help=f"{prompt.SCREEN_MODEL} ({prompt.SCREEN_EFFORT} reasoning effort) checks every report; only reports it flags "
+             "or is unsure about are sent to the model above. A 5% sample also gets the full check to measure agreement.",
+    )
 
     # ── Prompt Editor ──────────────────────────
     if st.toggle("🛠️ Prompt Editor", value=False):
@@ -165,85 +213,131 @@ with st.expander("1️⃣  LLM Evaluation", expanded=False):
                     st.success("Prompts updated (session-only) ✅")
 
     if st.button("🚀 LLM Error Detection"):
-
-        # CSV  -----------------------------------------------------
-        if uploaded_file is None:
+        if not uploaded_files:
             st.warning("Upload a CSV file first.")
             st.stop()
+        if not api_key:
+            st.warning("Enter your OpenAI API key first.")
+            st.stop()
 
-        # Prompt -------------------------------------------
-        DEFAULT_PROMPTS = {
-            "SYSTEM_PROMPT_PREPROCESS": prompt.SYSTEM_PROMPT_PREPROCESS,
-            "SYSTEM_PROMPT_ERROR_CHECK": prompt.SYSTEM_PROMPT_ERROR_CHECK,
-            "SYSTEM_PROMPT_FP_CHECK":     prompt.SYSTEM_PROMPT_FP_CHECK,
+        # Each file becomes a background job; prompts are passed to it, not patched in here
+        settings = {
+            "model": model,
+            "local_preprocess": local_pre,
+            "dedup": dedup,
+            "cascade": cascade,
+            "prompts": st.session_state.get("CUSTOM_PROMPTS", {}),
         }
-        custom_prompts = st.session_state.get("CUSTOM_PROMPTS", DEFAULT_PROMPTS)
-        st.session_state["CUSTOM_PROMPTS"] = custom_prompts     
-
-        # 2) CSV → DataFrame ----------------------------------------------------
-        raw_df = pd.read_csv(uploaded_file)          
-
-        raw_file = Path(uploaded_file.name)          
-
-        # prompt monkey-patch -----------------------------------------------
-        _orig = {k: getattr(prompt, k) for k in custom_prompts}
-        for k, v in custom_prompts.items():
-            setattr(prompt, k, v)
-
-        # LM pipeline -------------------------------------------------
-        with st.spinner("Detecting errors..."):
+        for uploaded_file in uploaded_files:
             try:
-                result_df, _ = llm_eval.get_unstructured_accuracy(
-                    raw_df,
-                    use_chatgpt=True,
-                    model=model,
-                    api_key=api_key,
-                )
-            finally:
-                for k, v in _orig.items():
-                    setattr(prompt, k, v)
-
-        #  ------------------------------------------
-        st.session_state["df"] = ensure_schema(result_df)
-        st.session_state["file_name"] = raw_file.name
+                job_id = job_manager().submit(uploaded_file, name=uploaded_file.name, api_key=api_key, settings=settings)
+            except ValueError as e:
+                st.error(f"{uploaded_file.name}: {e}")
+                continue
+            st.success(f"Queued {uploaded_file.name} as job {job_id}.")
+
+# 📋 Background jobs ---------------------------------------------------------
+def _job_progress(job: dict) -> str:
+    rows = job.get("rows", 0)
+    return " · ".join(f"{desc} {n:,}/{rows:,}" for desc, (n, _) in job["progress"].items())
+
+@st.fragment(run_every=prompt.JOB_POLL_INTERVAL)
+def jobs_panel(api_key: str):
+    jobs = job_manager().jobs()
+    if not jobs:
+        return
+    st.markdown("#### 📋 Jobs")
+    table = pd.DataFrame([
+        {
+            "Job": j["id"],
+            "File": j.get("name", ""),
+            "Status": j["status"],
+            "Reports": j.get("rows", 0),
+            "Parts done": f"{j['parts_done']} / {-(-j.get('rows', 0) // j['settings'].get('chunksize', prompt.JOB_CHUNKSIZE))}",
+            "Progress": _job_progress(j),
+            "Started": datetime.fromtimestamp(j["started"]).strftime("%Y-%m-%d %H:%M") if j.get("started") else "",
+            "Error": j.get("error", ""),
+        }
+        for j in reversed(jobs)
+    ])
+    st.dataframe(table, hide_index=True)
+
+    by_id = {j["id"]: j for j in jobs}
+    job_id = st.selectbox("Job", list(reversed(by_id)), format_func=lambda i: f"{i} · {by_id[i].get('name', '')}")
+    job = by_id[job_id]
+    label_col, cancel_col, resume_col = st.columns(3)
+    if label_col.button("🏷️ Label finished reports", disabled=job["parts_done"] == 0):
+        label_job(job_id)
         st.rerun()
+    if cancel_col.button("⏹️ Cancel", disabled=job["status"] not in ("queued", "running")):
+        job_manager().cancel(job_id)
+        st.rerun(scope="fragment")
+    if resume_col.button("▶️ Resume", disabled=job["status"] not in ("failed", "cancelled") or not api_key,
+                         help="Continue from the finished parts with the API key entered above."):
+        job_manager().start(job_id, api_key)
+        st.rerun(scope="fragment")
+
+jobs_panel(api_key)
 
 # 2️⃣ Labeling Section ------------------------------------------------------
-if "df" not in st.session_state:
+if "paged" not in st.session_state:
+    if tmp_save_path().exists() and st.button(f"↩️ Resume labeling {tmp_save_path()}"):
+        st.session_state["file_name"] = tmp_save_path().name
+        try:
+            start_labeling(fresh=False)
+        except ValueError as e:
+            st.error(f"Cannot resume: {e}")
+            st.stop()
+        st.rerun()
     st.info("Please run the LLM evaluation first.")
     st.stop()
 
-if "fail_count" in st.session_state and st.session_state["fail_count"] > 0:
-    fail_count = st.session_state.pop("fail_count")
-    st.warning(f"⚠️ {fail_count} reports could not be processed by the LLM. "
-               "See 'failed_requests.csv' in the results directory for details.")
-
-df: pd.DataFrame = st.session_state["df"]
-
-mask_total = df[COL_SCORE] == 0
-total_to_label = int(mask_total.sum())
-done_now = int((mask_total & (df[COL_RESULT].fillna("") != "")).sum())
-
-st.progress(done_now / total_to_label if total_to_label else 0)
-st.caption(f"🔖 {done_now} / {total_to_label} labeled")
-
-idx = next_pending_index()
+job = job_manager().status(st.session_state["job_id"]) if "job_id" in st.session_state else None
+if job is not None:
+    failed_csv = job_manager().job_dir(job["id"]) / prompt.FAILED_CSV
+    if failed_csv.exists():
+        st.warning(f"⚠️ {len(pd.read_csv(failed_csv))} LLM calls failed after all retries. "
+                   f"See '{failed_csv}' for details.")
+    if "cache_hits" in job:
+        st.caption(f"🗄️ Response cache: {job['cache_hits']:,} hits / {job['cache_misses']:,} misses")
+    summary_csv = job_manager().job_dir(job["id"]) / "summary.csv"
+    if summary_csv.exists():
+        with st.expander("📈 Run summary: accuracy, latency, tokens and estimated cost per pass", expanded=False):
+            st.dataframe(pd.read_csv(summary_csv), hide_index=True)
+
+paged: PagedResults = st.session_state["paged"]
+labels: dict = st.session_state["labels"]
+pending: PendingQueue = st.session_state["pending"]
+label_log: LabelLog = st.session_state["label_log"]
+
+st.progress(pending.done / pending.total if pending.total else 0)
+st.caption(f"🔖 {pending.done} / {pending.total} labeled")
+
+pos = pending.peek()
 
 # ── Labeling UI / Completion ----------------------------------------------
-if idx is None:   
+if pos is None and job is not None and (job["status"] in ("queued", "running") or job["parts_done"] > st.session_state["job_parts"]):
+    # The job is still producing parts: label what has finished so far
+    st.info(f"🏷️ All finished reports of job {job['id']} are labelled; "
+            f"{job['parts_done']} parts are done and the job is {job['status']}.")
+    if st.button("🔄 Load newly finished reports"):
+        label_job(job["id"])
+        st.rerun()
+    st.stop()
+elif pos is None:
     # --------------------------------------------------------------------
     # 🎉 Finish Screen with statistics & file saving (table removed)
     # --------------------------------------------------------------------
     st.success("🎉 Labeling complete!")
-
-    # 1) accuracy_3_score = accuracy_2_score copy, then overwrite FP rows with 1
-    df["accuracy_3_score"] = df[COL_SCORE].copy()
-    df.loc[df[COL_RESULT] == "FP", "accuracy_3_score"] = 1
-
-    # 2) Compute statistics
-    total_reports    = len(df)
-    tp_count         = int(df[COL_RESULT].eq("TP").sum())
-    fp_count         = int(df[COL_RESULT].eq("FP").sum())
+    if job is not None and job["status"] != "done":
+        st.warning(f"Job {job['id']} is {job['status']}; these results cover only its finished parts. {job.get('error', '')}")
+    if label_log.pending:
+        compact_labels()
+
+    # Compute statistics (labels exist only on flagged rows)
+    total_reports    = paged.rows
+    tp_count         = sum(v == "TP" for v in labels.values())
+    fp_count         = sum(v == "FP" for v in labels.values())
     true_error_ratio = tp_count / total_reports if total_reports else 0
     ppv              = tp_count / (tp_count + fp_count) if (tp_count + fp_count) else 0
 
@@ -283,7 +377,9 @@ if idx is None:
     FINAL_SAVE = final_save_path()
     STATS_SAVE = FINAL_SAVE.parent / "RESULT_STATS.csv"
 
-    save_csv(FINAL_SAVE)                  
+    if not st.session_state.get("final_saved"):
+        paged.export(FINAL_SAVE, labels, transform=final_columns)
+        st.session_state["final_saved"] = True
     stats_df.to_csv(STATS_SAVE, index=False, encoding="utf-8")
 
 
@@ -296,23 +392,17 @@ if idx is None:
     )
     st.stop()
 else:
-    row = df.loc[idx]
-    err_json    = row[COL_ERROR]                    
+    row = paged.get(pos)
+    paged.prefetch(pending.upcoming(LABEL_PREFETCH + 1)[1:])
+    err_json    = row["error"]
     error_msg   = err_json.get("error", "N/A")
     error_cause = err_json.get("error_reason", "N/A")
 
     left_col, right_col = st.columns([2, 1])
 
     with left_col:
-        st.subheader(f"📝 Report #{idx}")
-        cell = row.get(COL_PREPROCESSED, "{}")
-        try:
-            obj = cell if isinstance(cell, dict) else json.loads(cell)
-            findings_part    = obj.get("findings", "")
-            impression_part  = obj.get("impression", "")
-        except Exception:
-            findings_part, impression_part = str(cell), ""
-        st.markdown(f"**Findings**\n\n{findings_part}\n\n**Impression**\n\n{impression_part}")
+        st.subheader(f"📝 Report #{pos}")
+        st.markdown(f"**Findings**\n\n{row['findings']}\n\n**Impression**\n\n{row['impression']}")
     with right_col:
         upper, lower = st.container(), st.container()
 
@@ -331,6 +421,10 @@ else:
     )
 
     if st.button("💾 Save & Next"):
-        df.at[idx, COL_RESULT] = "TP" if choice.startswith("TP") else "FP"
-        save_csv(tmp_save_path())
+        label = "TP" if choice.startswith("TP") else "FP"
+        labels[pos] = label
+        label_log.append(pos, label)
+        pending.mark_done(pos)
+        if label_log.pending >= LABEL_COMPACT_EVERY:
+            compact_labels()
         st.rerun()
\ No newline at end of file
@@ -0,0 +1,179 @@
+"""End-to-end throughput benchmark against the local stub: `python -m benchmarks.bench`.
+
+For every (corpus size, concurrency) pair, a fresh stub server and a fresh worker process
+are started. The worker runs the pipeline over a synthetic corpus and reports:
+- reports/s;
+- p50/p95/p99 call latency from telemetry;
+- peak RSS.
+Nothing leaves the machine. Example:
+
+    python -m benchmarks.bench --sizes 1000,10000 --concurrency 16,64,256 --latency-ms 300 --rate-429 0.01
+"""
+from __future__ import annotations
+import argparse, asyncio, json, logging, multiprocessing, os, random, resource, socket, subprocess, sys, tempfile, time
+from pathlib import Path
+from typing import Any, Dict, List
+
+from benchmarks.stub_server import _config_from_args, add_stub_arguments, serve
+
+_ORGANS = ["liver", "spleen", "pancreas", "gallbladder", "kidney", "adrenal gland", "lung", "pleura", "bowel", "bladder"]
+_FINDINGS = [
+    "No focal lesion is seen in the {organ}.",
+    "A {size} cm cyst is noted in the {side} {organ}.",
+    "The {organ} is normal in size and attenuation.",
+    "Mild wall thickening of the {organ} without surrounding stranding.",
+    "A {size} mm nodule in the {side} {organ}, unchanged since [DATE].",
+]
+_IMPRESSIONS = [
+    "No acute abnormality.",
+    "{size} cm cyst in the {side} {organ}, likely benign.",
+    "Stable {side} {organ} nodule.",
+    "Findings suggest mild inflammation of the {organ}.",
+]
+
+def synthetic_corpus(n: int, *, seed: int = 0, min_sentences: int = 3, max_sentences: int = 12):
+    """`n` templated radiology reports with a `report` column."""
+    import pandas as pd
+    rng = random.Random(seed)
+
+    def fill(template: str) -> str:
+        return template.format(organ=rng.choice(_ORGANS), side=rng.choice(("left", "right")), size=rng.randint(2, 40) / 10)
+
+    reports = []
+    for _ in range(n):
+        findings = " ".join(fill(rng.choice(_FINDINGS)) for _ in range(rng.randint(min_sentences, max_sentences)))
+        impression = " ".join(fill(rng.choice(_IMPRESSIONS)) for _ in range(rng.randint(1, 3)))
+        reports.append(f"EXAM: CT abdomen [DATE]\nFINDINGS: {findings}\nIMPRESSION: {impression}")
+    return pd.DataFrame({"report": reports})
+
+def _peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+def _worker(args: argparse.Namespace) -> Dict[str, Any]:
+    """Run the pipeline once in this process (OPENAI_BASE_URL points at the stub)."""
+    from llm_tools import events, pipeline
+    from llm_tools.hedging import Hedger
+    from llm_tools.scheduler import TokenScheduler
+    from llm_tools.telemetry import Telemetry
+
+    logging.basicConfig(level=logging.ERROR)
+    df = synthetic_corpus(args.size, seed=args.seed)
+    rss_before = _peak_rss_mb()
+    telemetry = Telemetry()
+    common = dict(
+        api_key="stub", model=args.model, max_concurrency=args.concurrency, pack_reports=args.pack_reports,
+        reporter=events.Reporter(), telemetry=telemetry,
+    )
+    if args.mode != "batch" and (args.longest_first or args.budget_tpm):
+        common["scheduler"] = TokenScheduler(longest_first=args.longest_first, tpm=args.budget_tpm)
+    if args.mode != "batch" and args.hedge:
+        common["hedger"] = Hedger()
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.mode == "stream":
+            path = Path(tmp) / "corpus.csv"
+            df.to_csv(path, index=False)
+            del df
+            start = time.perf_counter()
+            pipeline.stream_unstructured_accuracy(path, Path(tmp) / "out", chunksize=args.chunksize, **common)
+        else:
+            batch = dict(batch_state=Path(tmp) / "state.json", batch_poll_interval=0.2) if args.mode == "batch" else {}
+            start = time.perf_counter()
+            pipeline.get_unstructured_accuracy(df, **batch, **common)
+        elapsed = time.perf_counter() - start
+    total = telemetry.summary().loc["total"]
+    return {
+        "mode": args.mode,
+        "size": args.size,
+        "concurrency": args.concurrency,
+        "seconds": round(elapsed, 3),
+        "reports_per_s": round(args.size / elapsed, 1),
+        "calls": int(total["calls"]),
+        "errors": int(total["errors"]),
+        "prompt_estimate_error": round(float(total["prompt_estimate_error"]), 4),
+        "hedges": int(total["hedges"]),
+        "latency_p50_s": round(float(total["latency_p50_s"]), 4),
+        "latency_p95_s": round(float(total["latency_p95_s"]), 4),
+        "latency_p99_s": round(float(total["latency_p99_s"]), 4),
+        "rss_before_mb": round(rss_before, 1),
+        "peak_rss_mb": round(_peak_rss_mb(), 1),
+    }
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _serve(config, port: int, ready) -> None:
+    asyncio.run(serve(config, "127.0.0.1", port, ready))
+
+def _run_one(args: argparse.Namespace, size: int, concurrency: int) -> Dict[str, Any]:
+    port = _free_port()
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target=_serve, args=(_config_from_args(args), port, ready), daemon=True)
+    server.start()
+    try:
+        if not ready.wait(10):
+            raise RuntimeError("stub server did not start")
+        env = {**os.environ, "OPENAI_BASE_URL": f"http://127.0.0.1:{port}/v1", "OPENAI_API_KEY": "stub"}
+        cmd = [
+            sys.executable, "-m", "benchmarks.bench", "--worker",
+            "--mode", args.mode, "--size", str(size), "--concurrency", str(concurrency), "--model", args.model,
+            "--pack-reports", str(args.pack_reports), "--chunksize", str(args.chunksize), "--seed", str(args.seed),
+        ]
+        if args.longest_first:
+            cmd.append("--longest-first")
+        if args.budget_tpm:
+            cmd += ["--budget-tpm", str(args.budget_tpm)]
+        if args.hedge:
+            cmd.append("--hedge")
+        proc = subprocess.run(cmd, env=env, capture_output=True, text=True)
+        if proc.returncode != 0:
+            raise RuntimeError(f"worker failed (size={size}, concurrency={concurrency}):\n{proc.stderr[-2000:]}")
+        return json.loads(proc.stdout.strip().splitlines()[-1])
+    finally:
+        server.terminate()
+        server.join()
+
+def _ints(text: str) -> List[int]:
+    return [int(float(x)) for x in text.split(",") if x.strip()]
+
+def main(argv: List[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=_ints, default=[1000], help="Comma-separated corpus sizes, e.g. 1000,100000,1e6.")
+    parser.add_argument("--concurrency", type=_ints, default=[16, 64, 256], help="Comma-separated max_concurrency values.")
+    parser.add_argument("--mode", choices=("memory", "stream", "batch"), default="memory")
+    parser.add_argument("--model", default="o4-mini")
+    parser.add_argument("--pack-reports", type=int, default=1)
+    parser.add_argument("--chunksize", type=int, default=10_000, help="Rows per chunk in stream mode.")
+    parser.add_argument("--longest-first", action="store_true", help="Dispatch the longest reports first (TokenScheduler).")
+    parser.add_argument("--budget-tpm", type=int, help="Client-side tokens-per-minute budget per model (TokenScheduler).")
+    parser.add_argument("--hedge", action="store_true", help="Hedge slow calls (Hedger).")
+    parser.add_argument("--out", type=Path, help="Also append the results to this JSON-lines file.")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--size", type=int, help=argparse.SUPPRESS)
+    add_stub_arguments(parser)
+    args = parser.parse_args(argv)
+    if args.seed is None:
+        args.seed = 0
+
+    if args.worker:
+        args.concurrency = args.concurrency[0] if isinstance(args.concurrency, list) else args.concurrency
+        print(json.dumps(_worker(args)), flush=True)
+        return 0
+
+    cols = ["mode", "size", "concurrency", "seconds", "reports_per_s", "calls", "errors",
+            "latency_p50_s", "latency_p95_s", "latency_p99_s", "peak_rss_mb"]
+    print("  ".join(f"{c:>13}" for c in cols), flush=True)
+    for size in args.sizes:
+        for concurrency in args.concurrency:
+            result = _run_one(args, size, concurrency)
+            print("  ".join(f"{result[c]!s:>13}" for c in cols), flush=True)
+            if args.out is not None:
+                args.out.parent.mkdir(parents=True, exist_ok=True)
+                with open(args.out, "a", encoding="utf-8") as f:
+                    f.write(json.dumps({**result, "stub": {k: v for k, v in vars(args).items() if k.startswith(("latency", "rate", "rpm", "tpm", "per_token"))}}) + "\n")
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,341 @@
+"""Local OpenAI-compatible stub for benchmarks: `python -m benchmarks.stub_server --port 8765`.
+
+Serves `/v1/chat/completions` (schema-valid `PREPROCESSING_SCHEMA`, `ERROR_SCHEMA` and
+`PACKED_ERROR_SCHEMA` answers) and enough of `/v1/files` + `/v1/batches` for batch mode.
+It injects latency drawn from a configurable distribution, 429s, 5xx errors and malformed
+JSON, and can enforce request/token-per-minute limits with `retry-after-ms` and
+`x-ratelimit-*` headers. Standard library only; point the SDK at it with
+`OPENAI_BASE_URL=http://127.0.0.1:<port>/v1`.
+"""
+from __future__ import annotations
+import argparse, asyncio, hashlib, json, math, random, re, time, uuid
+from typing import Any, Dict, Optional, Tuple
+
+_REASONING_TOKENS = {None: 0, "low": 64, "medium": 192, "high": 512}
+
+def _fraction(text: str, salt: str) -> float:
+    """Deterministic pseudo-random number in [0, 1) for `text`."""
+    return int.from_bytes(hashlib.blake2b(f"{salt}\x00{text}".encode("utf-8"), digest_size=8).digest(), "big") / 2**64
+
+class TokenBucket:
+    """Per-minute budget refilled continuously; `take` returns the seconds to wait, or 0."""
+
+    def __init__(self, per_minute: float):
+        self.rate = per_minute / 60.0
+        self.capacity = per_minute
+        self.level = per_minute
+        self.stamp = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def take(self, amount: float) -> float:
+        self._refill()
+        if self.level >= amount:
+            self.level -= amount
+            return 0.0
+        return (amount - self.level) / self.rate
+
+class StubConfig:
+    def __init__(
+        self,
+        *,
+        latency_ms: float = 200.0,
+        latency_sigma: float = 0.5,
+        latency_dist: str = "lognormal",
+        per_token_ms: float = 0.0,
+        rate_429: float = 0.0,
+        rate_5xx: float = 0.0,
+        rate_malformed: float = 0.0,
+        rpm: float = 0.0,
+        tpm: float = 0.0,
+        error_rate: float = 0.1,
+        fp_rate: float = 0.5,
+        batch_speedup: float = 100.0,
+        seed: Optional[int] = None,
+    ):
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.latency_dist = latency_dist
+        self.per_token_ms = per_token_ms
+        self.rate_429 = rate_429
+        self.rate_5xx = rate_5xx
+        self.rate_malformed = rate_malformed
+        self.rpm = rpm
+        self.tpm = tpm
+        self.error_rate = error_rate
+        self.fp_rate = fp_rate
+        self.batch_speedup = batch_speedup
+        self.seed = seed
+
+class StubServer:
+    """Minimal HTTP/1.1 keep-alive server speaking the subset of the OpenAI API we use."""
+
+    def __init__(self, config: StubConfig):
+        self.config = config
+        self.rng = random.Random(config.seed)
+        self.requests = TokenBucket(config.rpm) if config.rpm else None
+        self.tokens = TokenBucket(config.tpm) if config.tpm else None
+        self.files: Dict[str, bytes] = {}
+        self.batches: Dict[str, Dict[str, Any]] = {}
+        self.counts: Dict[str, int] = {}
+
+    # ── responses ───────────────────────────
+    def _latency(self, tokens: int) -> float:
+        cfg = self.config
+        base = cfg.latency_ms / 1000
+        if cfg.latency_dist == "fixed":
+            value = base
+        elif cfg.latency_dist == "uniform":
+            value = self.rng.uniform(base * (1 - cfg.latency_sigma), base * (1 + cfg.latency_sigma))
+        elif cfg.latency_dist == "exponential":
+            value = self.rng.expovariate(1 / base) if base > 0 else 0.0
+        else:  # lognormal with median `latency_ms`
+            value = base * math.exp(self.rng.gauss(0, cfg.latency_sigma))
+        return max(0.0, value) + tokens * cfg.per_token_ms / 1000
+
+    def _answer(self, body: Dict[str, Any]) -> Tuple[str, Dict[str, int]]:
+        schema = (body.get("response_format") or {}).get("json_schema", {}).get("name")
+        messages = body.get("messages") or []
+        user = messages[-1].get("content", "") if messages else ""
+        user = user if isinstance(user, str) else json.dumps(user)
+        cfg = self.config
+
+        def verdict(text: str) -> Dict[str, str]:
+            if "<previous error JSON>" in text:  # FP check: keep or drop the candidate error
+                if _fraction(text, "fp") < cfg.fp_rate:
+                    return {"error": "no error", "error_reason": "N/A"}
+                return {"error": text[:60], "error_reason": "Confirmed internal contradiction."}
+            if _fraction(text, "err") < cfg.error_rate:
+                return {"error": text[:60], "error_reason": "Laterality differs between Findings and Impression."}
+            return {"error": "no error", "error_reason": "N/A"}
+
+        if schema == "preprocessing":
+            findings, _, impression = user.partition("IMPRESSION:")
+            content = {"findings": findings.replace("FINDINGS:", "").strip() or "N/A", "impression": impression.strip() or "N/A"}
+        elif schema == "packed_error_report":
+            parts = re.findall(r'<report id="([^"]+)">\n(.*?)\n</report>', user, flags=re.S)
+            content = {"results": [{"id": rid, **verdict(text)} for rid, text in parts]}
+        else:
+            content = verdict(user)
+        text = json.dumps(content, ensure_ascii=False)
+        prompt_text = "".join(
+            m["content"] if isinstance(m.get("content"), str) else "".join(p.get("text", "") for p in m.get("content") or [])
+            for m in messages
+        )
+        reasoning = _REASONING_TOKENS.get(body.get("reasoning_effort"), 0)
+        usage = {
+            "prompt_tokens": len(prompt_text) // 4 + 1,
+            "completion_tokens": len(text) // 4 + 1 + reasoning,
+            "total_tokens": 0,
+            "prompt_tokens_details": {"cached_tokens": 0},
+            "completion_tokens_details": {"reasoning_tokens": reasoning},
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        return text, usage
+
+    def _completion(self, body: Dict[str, Any], content: str, usage: Dict[str, int]) -> Dict[str, Any]:
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "stub"),
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+            "usage": usage,
+        }
+
+    def _count(self, key: str) -> None:
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+    async def chat(self, body: Dict[str, Any]) -> Tuple[int, Dict[str, Any], Dict[str, str]]:
+        cfg, rng = self.config, self.rng
+        content, usage = self._answer(body)
+        headers: Dict[str, str] = {}
+        for bucket, amount, name in ((self.requests, 1, "requests"), (self.tokens, usage["total_tokens"], "tokens")):
+            if bucket is None:
+                continue
+            wait = bucket.take(amount)
+            headers[f"x-ratelimit-limit-{name}"] = str(int(bucket.capacity))
+            headers[f"x-ratelimit-remaining-{name}"] = str(max(0, int(bucket.level)))
+            if wait:
+                self._count("429_limit")
+                headers["retry-after-ms"] = str(int(wait * 1000) + 1)
+                return 429, {"error": {"message": f"Rate limit reached for {name}", "type": name, "code": "rate_limit_exceeded"}}, headers
+        if rng.random() < cfg.rate_429:
+            self._count("429_injected")
+            headers["retry-after-ms"] = str(int(self._latency(0) * 1000))
+            return 429, {"error": {"message": "Injected rate limit", "type": "requests", "code": "rate_limit_exceeded"}}, headers
+        await asyncio.sleep(self._latency(usage["completion_tokens"]))
+        if rng.random() < cfg.rate_5xx:
+            self._count("5xx_injected")
+            return rng.choice((500, 502, 503)), {"error": {"message": "Injected server error", "type": "server_error"}}, headers
+        if rng.random() < cfg.rate_malformed:
+            self._count("malformed_injected")
+            content = content[: max(1, len(content) // 2)]
+        self._count("ok")
+        return 200, self._completion(body, content, usage), headers
+
+    # ── files / batches ─────────────────────
+    def _file_object(self, file_id: str, purpose: str = "batch") -> Dict[str, Any]:
+        return {
+            "id": file_id, "object": "file", "bytes": len(self.files[file_id]), "created_at": int(time.time()),
+            "filename": f"{file_id}.jsonl", "purpose": purpose, "status": "processed",
+        }
+
+    def upload(self, content_type: str, body: bytes) -> Dict[str, Any]:
+        boundary = re.search(r'boundary="?([^";]+)"?', content_type).group(1).encode()
+        data = b""
+        for part in body.split(b"--" + boundary):
+            head, _, payload = part.partition(b"\r\n\r\n")
+            if b'name="file"' in head:
+                data = payload[:-2] if payload.endswith(b"\r\n") else payload
+        file_id = f"file-{uuid.uuid4().hex[:16]}"
+        self.files[file_id] = data
+        return self._file_object(file_id)
+
+    def _batch_object(self, batch_id: str) -> Dict[str, Any]:
+        b = self.batches[batch_id]
+        return {
+            "id": batch_id, "object": "batch", "endpoint": "/v1/chat/completions", "errors": None,
+            "input_file_id": b["input_file_id"], "completion_window": "24h", "status": b["status"],
+            "output_file_id": b.get("output_file_id"), "error_file_id": None, "created_at": b["created_at"],
+            "request_counts": {"total": b["total"], "completed": b["completed"], "failed": b["failed"]},
+        }
+
+    async def _run_batch(self, batch_id: str) -> None:
+        b = self.batches[batch_id]
+        b["status"] = "in_progress"
+        lines = [json.loads(x) for x in self.files[b["input_file_id"]].decode("utf-8").splitlines() if x.strip()]
+        b["total"] = len(lines)
+        out = []
+        for line in lines:
+            status, payload, _ = await self._batch_line(line["body"])
+            b["completed" if status == 200 else "failed"] += 1
+            out.append(json.dumps({
+                "id": f"batch_req_{uuid.uuid4().hex[:12]}", "custom_id": line["custom_id"],
+                "response": {"status_code": status, "request_id": uuid.uuid4().hex, "body": payload}, "error": None,
+            }))
+        file_id = f"file-{uuid.uuid4().hex[:16]}"
+        self.files[file_id] = ("\n".join(out) + "\n").encode("utf-8")
+        b.update(status="completed", output_file_id=file_id)
+
+    async def _batch_line(self, body: Dict[str, Any]) -> Tuple[int, Dict[str, Any], Dict[str, str]]:
+        content, usage = self._answer(body)
+        await asyncio.sleep(self._latency(usage["completion_tokens"]) / self.config.batch_speedup)
+        if self.rng.random() < self.config.rate_malformed:
+            content = content[: max(1, len(content) // 2)]
+        return 200, self._completion(body, content, usage), {}
+
+    def create_batch(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        batch_id = f"batch_{uuid.uuid4().hex[:16]}"
+        self.batches[batch_id] = {
+            "input_file_id": body["input_file_id"], "status": "validating", "created_at": int(time.time()),
+            "total": 0, "completed": 0, "failed": 0,
+        }
+        asyncio.get_running_loop().create_task(self._run_batch(batch_id))
+        return self._batch_object(batch_id)
+
+    # ── HTTP ────────────────────────────────
+    async def route(self, method: str, path: str, headers: Dict[str, str], body: bytes) -> Tuple[int, Any, Dict[str, str]]:
+        path = path.split("?", 1)[0].rstrip("/")
+        if method == "POST" and path.endswith("/chat/completions"):
+            return await self.chat(json.loads(body))
+        if method == "POST" and path.endswith("/files"):
+            return 200, self.upload(headers.get("content-type", ""), body), {}
+        m = re.search(r"/files/([^/]+)(/content)?$", path)
+        if method == "GET" and m and m.group(1) in self.files:
+            return 200, (self.files[m.group(1)] if m.group(2) else self._file_object(m.group(1))), {}
+        if method == "POST" and path.endswith("/batches"):
+            return 200, self.create_batch(json.loads(body)), {}
+        m = re.search(r"/batches/([^/]+)$", path)
+        if method == "GET" and m and m.group(1) in self.batches:
+            return 200, self._batch_object(m.group(1)), {}
+        if method == "GET" and path.endswith("/stats"):
+            return 200, self.counts, {}
+        return 404, {"error": {"message": f"No route for {method} {path}"}}, {}
+
+    async def _read_body(self, reader: asyncio.StreamReader, headers: Dict[str, str]) -> bytes:
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b";")[0].strip() or b"0", 16)
+                if size == 0:
+                    await reader.readline()
+                    return b"".join(chunks)
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+        return await reader.readexactly(int(headers.get("content-length", 0)))
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers: Dict[str, str] = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, _, value = line.decode("latin-1").partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                body = await self._read_body(reader, headers)
+                try:
+                    status, payload, extra = await self.route(method, target, headers, body)
+                except Exception as e:  # a broken request must not take the server down
+                    status, payload, extra = 400, {"error": {"message": str(e)}}, {}
+                data = payload if isinstance(payload, bytes) else json.dumps(payload).encode("utf-8")
+                ctype = "application/octet-stream" if isinstance(payload, bytes) else "application/json"
+                head = [f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}", f"content-type: {ctype}",
+                        f"content-length: {len(data)}", "connection: keep-alive"]
+                head += [f"{k}: {v}" for k, v in extra.items()]
+                writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + data)
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+async def serve(config: StubConfig, host: str = "127.0.0.1", port: int = 8765, ready=None) -> None:
+    stub = StubServer(config)
+    server = await asyncio.start_server(stub.handle, host, port, backlog=4096)
+    if ready is not None:
+        ready.set()
+    async with server:
+        await server.serve_forever()
+
+def _config_from_args(args: argparse.Namespace) -> StubConfig:
+    return StubConfig(
+        latency_ms=args.latency_ms, latency_sigma=args.latency_sigma, latency_dist=args.latency_dist,
+        per_token_ms=args.per_token_ms, rate_429=args.rate_429, rate_5xx=args.rate_5xx,
+        rate_malformed=args.rate_malformed, rpm=args.rpm, tpm=args.tpm, seed=args.seed,
+    )
+
+def add_stub_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--latency-ms", type=float, default=200.0, help="Median (lognormal) or mean latency.")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="Lognormal sigma / uniform half-width ratio.")
+    parser.add_argument("--latency-dist", choices=("lognormal", "uniform", "exponential", "fixed"), default="lognormal")
+    parser.add_argument("--per-token-ms", type=float, default=0.0, help="Extra latency per completion token.")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="Share of requests answered with an injected 429.")
+    parser.add_argument("--rate-5xx", type=float, default=0.0, help="Share of requests answered with a 5xx.")
+    parser.add_argument("--rate-malformed", type=float, default=0.0, help="Share of answers with truncated JSON.")
+    parser.add_argument("--rpm", type=float, default=0.0, help="Requests-per-minute limit (0 = none).")
+    parser.add_argument("--tpm", type=float, default=0.0, help="Tokens-per-minute limit (0 = none).")
+    parser.add_argument("--seed", type=int, default=None)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_stub_arguments(parser)
+    args = parser.parse_args()
+    print(f"Stub OpenAI API on http://{args.host}:{args.port}/v1", flush=True)
+    asyncio.run(serve(_config_from_args(args), args.host, args.port))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,3 @@
+from llm_tools.cli import main
+
+raise SystemExit(main())
@@ -0,0 +1,324 @@
+from __future__ import annotations
+import json, os, time
+from pathlib import Path
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+import pandas as pd
+from llm_tools import events, prompt, llm_call, telemetry
+from llm_tools.cache import ResponseCache, _cache_key
+from llm_tools.journal import _corpus_fingerprint
+from llm_tools.local_preprocess import LocalPreprocessor
+from llm_tools.dedup import Deduplicator
+from llm_tools.results import ResultStore
+
+_TERMINAL = {"completed", "failed", "expired", "cancelled"}
+_DEAD = _TERMINAL - {"completed"}
+
+def _request_line(
+    custom_id: Hashable,
+    model: str,
+    system_prompt: str,
+    user_message: str,
+    schema: Dict[str, Any],
+    reasoning_effort: Optional[str],
+) -> Dict[str, Any]:
+    body: Dict[str, Any] = {
+        "model": model,
+        "messages": llm_call._build_messages(system_prompt, user_message),
+        "response_format": {"type": "json_schema", "json_schema": schema},
+    }
+    if reasoning_effort:
+        body["reasoning_effort"] = reasoning_effort
+    return {"custom_id": str(custom_id), "method": "POST", "url": "/v1/chat/completions", "body": body}
+
+def _line_cache_key(pass_name: str, line: Dict[str, Any]) -> str:
+    """The `ResponseCache` key of a request line; the same as for the interactive request."""
+    body = line["body"]
+    system, user = body["messages"]
+    return _cache_key(
+        pass_name, body["model"], system["content"][0]["text"], body["response_format"]["json_schema"],
+        body.get("reasoning_effort"), user["content"],
+    )
+
+def _load_state(path: Path) -> Dict[str, Any]:
+    if path.exists():
+        return json.loads(path.read_text(encoding="utf-8"))
+    return {}
+
+def _save_state(path: Path, state: Dict[str, Any]) -> None:
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    tmp.write_text(json.dumps(state, indent=2), encoding="utf-8")
+    os.replace(tmp, path)
+
+def _submit(client, lines: List[Dict[str, Any]], jsonl_path: Path) -> str:
+    with open(jsonl_path, "w", encoding="utf-8") as f:
+        for line in lines:
+            f.write(json.dumps(line, ensure_ascii=False) + "\n")
+    with open(jsonl_path, "rb") as f:
+        input_file = client.files.create(file=f, purpose="batch")
+    batch = client.batches.create(
+        input_file_id=input_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window=prompt.BATCH_COMPLETION_WINDOW,
+    )
+    return batch.id
+
+def _wait(client, batch_id: str, poll_interval: float):
+    while True:
+        batch = llm_call._retry_call(lambda: client.batches.retrieve(batch_id), prompt.RETRY_LIMIT_FIRST, prefix="Batch poll")
+        if batch.status in _TERMINAL:
+            return batch
+        time.sleep(poll_interval)
+
+def _line_error(obj: Dict[str, Any]) -> Tuple[str, str]:
+    """(error class, message) of a failed batch output line."""
+    response = obj.get("response") or {}
+    status = response.get("status_code")
+    error = obj.get("error") or (response.get("body") or {}).get("error") or {}
+    message = error.get("message") if isinstance(error, dict) else str(error)
+    if status == 429:
+        error_class = "rate_limited"
+    elif status is not None and status >= 500:
+        error_class = "server"
+    else:
+        error_class = "client" if status is not None else "other"
+    return error_class, f"HTTP {status}: {message}" if status is not None else str(message)
+
+def _collect(
+    client, file_id: Optional[str], out_path: Path, pass_name: Optional[str] = None,
+) -> Tuple[Dict[str, str], Dict[str, Tuple[str, str]]]:
+    """custom_id → message content for every successful line of a batch output file, and
+    custom_id → (error class, message) for the failed ones.
+
+    Token usage of the successful lines is recorded in the current telemetry (no latency:
+    the Batch API does not report per-request timing).
+    """
+    if not out_path.exists():
+        if not file_id:
+            return {}, {}
+        text = llm_call._retry_call(lambda: client.files.content(file_id).text, prompt.RETRY_LIMIT_FIRST, prefix="Batch download")
+        out_path.write_text(text, encoding="utf-8")
+    results: Dict[str, str] = {}
+    errors: Dict[str, Tuple[str, str]] = {}
+    tm = telemetry.current()
+    now = time.time()
+    for raw in out_path.read_text(encoding="utf-8").splitlines():
+        if not raw.strip():
+            continue
+        obj = json.loads(raw)
+        response = obj.get("response") or {}
+        if obj.get("error") or response.get("status_code") != 200:
+            errors[obj.get("custom_id")] = _line_error(obj)
+            continue
+        try:
+            results[obj["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+        except (KeyError, IndexError, TypeError):
+            errors[obj.get("custom_id")] = ("invalid", "Response without message content")
+            continue
+        if tm is not None:
+            tm.record(
+                pass_name=pass_name or "unknown", model=response["body"].get("model", ""), start=now, latency=None,
+                usage=response["body"].get("usage"), batch=True,
+            )
+    return results, errors
+
+def _batch_output(client, batch_id: str, out_path: Path, pass_name: str, poll_interval: float):
+    """Wait for `batch_id` to end; returns it with the `_collect`ed results and errors of its lines."""
+    batch = _wait(client, batch_id, poll_interval)
+    return batch, _collect(client, batch.output_file_id, out_path, pass_name)
+
+def _run_batch_pass(
+    client,
+    pass_name: str,
+    requests: Dict[Hashable, Dict[str, Any]],
+    validate: Callable[[str], None],
+    state: Dict[str, Any],
+    state_path: Path,
+    poll_interval: float,
+    cache: Optional[ResponseCache] = None,
+    failures: Optional[List[Dict[str, Any]]] = None,
+) -> Dict[Hashable, str]:
+    """Validated responses to `requests` (index → request line), from the cache or the pass's batches.
+
+    When a batch ends (completed or not) with requests that have no valid response
+    (failed, invalid or missing lines), those are resubmitted as a follow-up batch, up to
+    `BATCH_MAX_RESUBMITS` times per pass; a batch that ended failed, expired or cancelled
+    is followed up on resume as well. Requests that never get a valid response are
+    appended to `failures` (rows for `retry.write_failures`).
+    """
+    if not requests:
+        return {}
+    first = time.time()
+    model = next(iter(requests.values()))["body"]["model"]
+    results: Dict[Hashable, str] = {}
+    if cache is not None:
+        for idx, line in requests.items():
+            hit = cache.get(_line_cache_key(pass_name, line))
+            if hit is not None:
+                results[idx] = hit
+        if results:
+            events.info(f"[Batch] {pass_name}: {len(results)} of {len(requests)} responses from the cache")
+        requests = {idx: line for idx, line in requests.items() if idx not in results}
+        if not requests:
+            return results
+    work_dir = state_path.parent
+    output = lambda batch_id: work_dir / f"{state_path.stem}.{pass_name}.{batch_id}.output.jsonl"
+
+    by_id = {str(idx): idx for idx in requests}
+    errors: Dict[str, Tuple[str, str]] = {}
+
+    def _accept(collected: Tuple[Dict[str, str], Dict[str, Tuple[str, str]]]) -> None:
+        contents, line_errors = collected
+        errors.update(line_errors)
+        for custom_id, content in contents.items():
+            idx = by_id.get(custom_id)
+            if idx is None or idx in results:
+                continue
+            try:
+                validate(content)
+            except ValueError as e:
+                telemetry.record_invalid(pass_name, model)
+                events.warning(f"[Batch {pass_name}] idx={custom_id} failed: {e}")
+                errors[custom_id] = ("invalid", str(e))
+                continue
+            results[idx] = content
+            if cache is not None:
+                cache.put(_line_cache_key(pass_name, requests[idx]), content, pass_name=pass_name, model=model)
+
+    entry = state["passes"].get(pass_name)
+    earlier: List[str] = list(entry.get("earlier", [])) if entry is not None else []
+    if entry is not None and entry.get("status") in _DEAD:
+        earlier.append(entry["batch_id"])
+        entry = None
+    elif entry is not None and entry.get("batch_id") is None:
+        entry = None
+    for batch_id in earlier:
+        _accept(_batch_output(client, batch_id, output(batch_id), pass_name, poll_interval)[1])
+    while True:
+        if entry is None:
+            pending = [line for idx, line in requests.items() if idx not in results]
+            if not pending:
+                break
+            batch_id = _submit(client, pending, work_dir / f"{state_path.stem}.{pass_name}.input.jsonl")
+            events.info(f"[Batch] {pass_name}: submitted {len(pending)} requests as {batch_id}")
+            entry = state["passes"][pass_name] = {"batch_id": batch_id, "count": len(pending), "earlier": earlier}
+            _save_state(state_path, state)
+        else:
+            events.info(f"[Batch] {pass_name}: resuming {entry['batch_id']}")
+        batch, collected = _batch_output(client, entry["batch_id"], output(entry["batch_id"]), pass_name, poll_interval)
+        if batch.status != "completed":
+            events.warning(f"[Batch] {pass_name}: batch {batch.id} ended with status '{batch.status}'")
+        entry["status"] = batch.status
+        _save_state(state_path, state)
+        _accept(collected)
+        missing = sum(idx not in results for idx in requests)
+        if not missing or len(earlier) >= prompt.BATCH_MAX_RESUBMITS:
+            break
+        events.warning(f"[Batch] {pass_name}: resubmitting {missing} requests without a valid response")
+        earlier = earlier + [entry["batch_id"]]
+        entry = None
+
+    failed = [idx for idx in requests if idx not in results]
+    if failed:
+        events.warning(f"[Batch] {pass_name}: {len(failed)} of {len(requests)} requests returned no valid response")
+        if failures is not None:
+            now = time.time()
+            for idx in failed:
+                error_class, message = errors.get(str(idx), ("other", "No response line in the batch output"))
+                failures.append({
+                    "index": idx, "pass": pass_name, "error_class": error_class, "attempts": len(earlier) + 1,
+                    "error": message, "first_attempt": first, "last_attempt": now,
+                })
+    return results
+
+def _run_batch(
+    df: pd.DataFrame,
+    client,
+    model: str,
+    preprocess_model: str,
+    state_path: str | Path,
+    *,
+    poll_interval: float = prompt.BATCH_POLL_INTERVAL,
+    local_preprocessor: Optional[LocalPreprocessor] = None,
+    dedup: Optional[Deduplicator] = None,
+    cache: Optional[ResponseCache] = None,
+    failures: Optional[List[Dict[str, Any]]] = None,
+) -> ResultStore:
+    """Run the passes for `df` through the Batch API, one batch per pass.
+
+    `custom_id` is the DataFrame index. Submitted batch ids are saved in `state_path`
+    (a JSON file; inputs and downloaded outputs are kept next to it), so calling this
+    again after a restart polls the existing batches instead of resubmitting. Only the
+    `files.create/content` and `batches.create/retrieve` client methods are used, so a
+    local stand-in for those endpoints can replace the OpenAI client. Reports that
+    `local_preprocessor` can parse skip the pass-1 batch; with `dedup`, passes 2 and 3 are
+    submitted once per duplicate group and the verdict is copied to every member. Requests
+    answered by `cache` are not submitted, and validated batch responses are added to it.
+    Requests without a valid response after the follow-up batches are appended to
+    `failures`; a failed FP check keeps the pass-2 verdict.
+    Returns the results; rows whose preprocessing failed are left empty.
+    """
+    if not df.index.is_unique:
+        raise ValueError("Batch mode needs a unique DataFrame index (it is used as custom_id).")
+    state_path = Path(state_path)
+    state_path.parent.mkdir(parents=True, exist_ok=True)
+    fingerprint = _corpus_fingerprint(df, model, preprocess_model)
+    state = _load_state(state_path)
+    if state and state.get("fingerprint") != fingerprint:
+        raise ValueError(f"{state_path} belongs to a different corpus, model or prompt set; use a new batch state path.")
+    state.setdefault("fingerprint", fingerprint)
+    state.setdefault("passes", {})
+
+    # 1) Preprocess (locally where possible)
+    local: Dict[Hashable, str] = {}
+    if local_preprocessor is not None:
+        for idx, report in df[prompt.COL_REPORT].items():
+            content = local_preprocessor(report)
+            if content is not None:
+                local[idx] = content
+    pre = _run_batch_pass(
+        client, prompt.PASS_PREPROCESS,
+        {idx: _request_line(idx, preprocess_model, prompt.SYSTEM_PROMPT_PREPROCESS, report, prompt.PREPROCESSING_SCHEMA, None)
+         for idx, report in df[prompt.COL_REPORT].items() if idx not in local},
+        llm_call._validate_preprocessing_response, state, state_path, poll_interval, cache, failures,
+    )
+    pre.update(local)
+    store = ResultStore(df.index)
+    for idx, content in pre.items():
+        store.set_preprocessed(idx, content)
+
+    # row → the row whose pass-2/3 requests stand for its duplicate group
+    leader: Dict[Hashable, Hashable] = {idx: idx for idx in pre}
+    if dedup is not None:
+        first_of: Dict[str, Hashable] = {}
+        for idx in df.index:
+            if idx in pre:
+                leader[idx] = first_of.setdefault(dedup.key(pre[idx]), idx)
+
+    def _fan_out(results: Dict[Hashable, str]) -> Dict[Hashable, str]:
+        return {idx: results[lead] for idx, lead in leader.items() if lead in results}
+
+    # 2) Error detection
+    first = _fan_out(_run_batch_pass(
+        client, prompt.PASS_ERROR_CHECK,
+        {idx: _request_line(idx, model, prompt.SYSTEM_PROMPT_ERROR_CHECK, report, prompt.ERROR_SCHEMA, "high")
+         for idx, report in pre.items() if leader[idx] == idx},
+        llm_call._validate_json_response, state, state_path, poll_interval, cache, failures,
+    ))
+    scores = {idx: llm_call._parse_score(content) for idx, content in first.items()}
+    for idx, content in first.items():
+        store.set_error_check(idx, content, scores[idx])
+
+    # 3) False-positive check, only for rows flagged in pass 2
+    fp = _fan_out(_run_batch_pass(
+        client, prompt.PASS_FP_CHECK,
+        {idx: _request_line(
+            idx, model, prompt.SYSTEM_PROMPT_FP_CHECK,
+            f"<preprocessed report JSON>\n{pre[idx]}\n\n<previous error JSON>\n{content}",
+            prompt.ERROR_SCHEMA, "high",
+         ) for idx, content in first.items() if leader[idx] == idx and scores[idx] == 0},
+        llm_call._validate_json_response, state, state_path, poll_interval, cache, failures,
+    ))
+    for idx, content in fp.items():
+        store.set_fp_check(idx, content, llm_call._parse_score(content))
+    return store
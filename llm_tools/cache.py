@@ -0,0 +1,121 @@
+from __future__ import annotations
+import hashlib, json, sqlite3, threading, time
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from llm_tools import prompt
+
+def _cache_key(
+    pass_name: str,
+    model: str,
+    system_prompt: str,
+    schema: Dict[str, Any],
+    reasoning_effort: Optional[str],
+    user_message: str,
+) -> str:
+    payload = json.dumps(
+        [pass_name, model, system_prompt, schema, reasoning_effort, user_message],
+        sort_keys=True, ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    """On-disk (SQLite) cache of validated LLM responses, keyed by `_cache_key`.
+
+    Entries older than `max_age` seconds are treated as misses and purged; once the
+    table grows beyond `max_entries` the least recently used rows are evicted.
+    """
+
+    _EVICT_EVERY = 1000  # puts between eviction sweeps
+
+    def __init__(
+        self,
+        path: str | Path = prompt.CACHE_PATH,
+        *,
+        max_entries: int = prompt.CACHE_MAX_ENTRIES,
+        max_age: float = prompt.CACHE_MAX_AGE,
+    ):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY, pass TEXT, model TEXT, content TEXT,"
+            " created REAL, accessed REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses(accessed)")
+        self._conn.commit()
+        self.evict()
+
+    def get(self, key: str, *alternatives: str) -> Optional[str]:
+        """Content under `key`, else under the first of `alternatives` that has it; one hit or miss is counted."""
+        now = time.time()
+        with self._lock:
+            for k in (key, *alternatives):
+                row = self._conn.execute(
+                    "SELECT content, created FROM responses WHERE key = ?", (k,)
+                ).fetchone()
+                if row is not None and not (self.max_age and now - row[1] > self.max_age):
+                    break
+            else:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, k))
+            self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, content: str, *, pass_name: str = "", model: str = "") -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, pass, model, content, created, accessed)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (key, pass_name, model, content, now, now),
+            )
+            self._conn.commit()
+            self._puts += 1
+            sweep = self._puts % self._EVICT_EVERY == 0
+        if sweep:
+            self.evict()
+
+    def evict(self) -> int:
+        with self._lock:
+            removed = 0
+            if self.max_age:
+                removed += self._conn.execute(
+                    "DELETE FROM responses WHERE created < ?", (time.time() - self.max_age,)
+                ).rowcount
+            if self.max_entries:
+                (count,) = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()
+                if count > self.max_entries:
+                    removed += self._conn.execute(
+                        "DELETE FROM responses WHERE key IN ("
+                        " SELECT key FROM responses ORDER BY accessed ASC LIMIT ?)",
+                        (count - self.max_entries,),
+                    ).rowcount
+            self._conn.commit()
+            return removed
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": count,
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,104 @@
+from __future__ import annotations
+import hashlib
+from typing import Any, Dict, List, Optional, Tuple
+
+from llm_tools import prompt
+from llm_tools.llm_call import _parse_score
+
+class Cascade:
+    """Cheap-first error detection: a screen decides which reports need the full pass 2.
+
+    Every report is first checked `samples` times by `screen_model` at `screen_effort`.
+    If every sample says "no error", the screen's answer is the pass-2 verdict. If any
+    sample flags an error, fails to parse, or the samples disagree, the report is escalated
+    to the full high-effort error check (and, if still flagged, the FP verifier).
+
+    To verify that the savings do not cost sensitivity, a deterministic `audit_rate`
+    sample of reports also runs the full check even when the screen passed them; the
+    agreement between screen and full check on that sample is in `stats()`. Audited
+    reports keep the cascade's verdict, so the output does not depend on the audit.
+    """
+
+    def __init__(
+        self,
+        screen_model: str = prompt.SCREEN_MODEL,
+        *,
+        screen_effort: Optional[str] = prompt.SCREEN_EFFORT,
+        samples: int = 1,
+        audit_rate: float = 0.0,
+    ):
+        if samples < 1:
+            raise ValueError("samples must be at least 1.")
+        if not 0.0 <= audit_rate <= 1.0:
+            raise ValueError("audit_rate must be between 0 and 1.")
+        self.screen_model = screen_model
+        self.screen_effort = screen_effort
+        self.samples = samples
+        self.audit_rate = audit_rate
+        self.reset()
+
+    def reset(self) -> None:
+        self.screened = self.escalated = self.disagreements = 0
+        # audited reports: (screen escalated?, full check flagged?) → count
+        self._audit: Dict[Tuple[bool, bool], int] = {}
+
+    def decide(self, contents: List[str]) -> Tuple[bool, str]:
+        """(escalate?, screen answer to keep if not) for one report's screen samples."""
+        self.screened += 1
+        scores = [_parse_score(c) for c in contents]
+        if len(set(scores)) > 1:
+            self.disagreements += 1
+        if all(score == 1 for score in scores):
+            return False, contents[0]
+        self.escalated += 1
+        return True, next((c for c, s in zip(contents, scores) if s == 0), contents[0])
+
+    def audits(self, report: str) -> bool:
+        """Whether `report` belongs to the audit sample (stable across runs)."""
+        if self.audit_rate <= 0.0:
+            return False
+        h = int.from_bytes(hashlib.blake2b(report.encode("utf-8"), digest_size=8).digest(), "big")
+        return h / 2 ** 64 < self.audit_rate
+
+    def record_audit(self, escalated: bool, full_content: str) -> None:
+        key = (escalated, _parse_score(full_content) == 0)
+        self._audit[key] = self._audit.get(key, 0) + 1
+
+    @property
+    def escalation_rate(self) -> float:
+        return self.escalated / self.screened if self.screened else 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        """Escalation rate, and agreement with the full check on the audit sample.
+
+        `sensitivity` is the share of audited reports the full check flags that the screen
+        escalated; `missed` counts the flagged ones it let through.
+        """
+        tp = self._audit.get((True, True), 0)
+        fn = self._audit.get((False, True), 0)
+        audited = sum(self._audit.values())
+        agree = tp + self._audit.get((False, False), 0)
+        return {
+            "screened": self.screened,
+            "escalated": self.escalated,
+            "escalation_rate": self.escalation_rate,
+            "sample_disagreements": self.disagreements,
+            "audited": audited,
+            "agreement": agree / audited if audited else None,
+            "sensitivity": tp / (tp + fn) if tp + fn else None,
+            "missed": fn,
+        }
+
+    def summary(self) -> str:
+        s = self.stats()
+        text = (
+            f"Cascade: {s['escalated']:,} of {s['screened']:,} reports escalated from {self.screen_model} "
+            f"to the full error check (escalation rate {s['escalation_rate']:.1%})"
+        )
+        if s["audited"]:
+            sensitivity = "n/a" if s["sensitivity"] is None else f"{s['sensitivity']:.1%}"
+            text += (
+                f"; audit of {s['audited']:,} reports: agreement {s['agreement']:.1%}, "
+                f"sensitivity {sensitivity}, {s['missed']:,} missed"
+            )
+        return text + "."
@@ -0,0 +1,393 @@
+"""Headless command line: `python -m llm_tools run reports.csv --out results/reports.csv`.
+
+Distributed mode: `queue init` splits a corpus into shards, any number of `worker`
+processes (on hosts sharing the queue directory) lease and process them, and
+`queue merge` writes the combined result.
+
+Experiments: `experiment reports.csv --variants variants.json --out results/exp` runs
+pass 1 once and compares several pass-2/3 prompt/model/effort variants side by side;
+`calibrate-effort FINAL_RESULTS_DF.csv` measures what each tier of the adaptive
+reasoning-effort policy (`--adaptive-effort`) costs in TP recall.
+
+`job run <dir>` is the process behind a background job of the app (see `llm_tools.jobs`).
+
+Only the standard library is imported up front; pandas, openai and the pipeline are loaded
+once a command actually runs, and no UI package is imported at all.
+"""
+from __future__ import annotations
+import argparse, logging, os, sys
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from llm_tools import prompt
+
+log = logging.getLogger("llm_tools")
+
+def _add_pipeline_arguments(p: argparse.ArgumentParser, *, model_default: Optional[str] = "o4-mini") -> None:
+    p.add_argument("--model", default=model_default)
+    p.add_argument("--api-key", default=os.environ.get("OPENAI_API_KEY"), help="Default: $OPENAI_API_KEY.")
+    p.add_argument("--azure", action="store_true",
+                   help="Use Azure OpenAI (endpoint and version from AZURE_OPENAI_ENDPOINT / OPENAI_API_VERSION).")
+    p.add_argument("--endpoints", type=Path,
+                   help="JSON list of OpenAI accounts / Azure deployments to spread the calls over (replaces --api-key/--azure).")
+    p.add_argument("--cache", type=Path, default=Path(prompt.CACHE_PATH), help="Response cache (SQLite).")
+    p.add_argument("--no-cache", action="store_true")
+    p.add_argument("--max-concurrency", type=int, default=prompt.MAX_CONCURRENCY)
+    p.add_argument("--local-preprocess", action="store_true", help="Rule-based pass 1 for templated reports.")
+    p.add_argument("--dedup", action="store_true", help="One error/FP check per group of identical reports.")
+    p.add_argument("--near-duplicates", action="store_true", help="With --dedup, also merge near-duplicates.")
+    p.add_argument("--cascade", action="store_true",
+                   help="Screen every report with a cheap model first; only flagged/uncertain ones get --model.")
+    p.add_argument("--screen-model", default=prompt.SCREEN_MODEL)
+    p.add_argument("--screen-effort", default=prompt.SCREEN_EFFORT, help="Reasoning effort of the screen ('none' to omit).")
+    p.add_argument("--screen-samples", type=int, default=1, help="Screen samples per report; any disagreement escalates.")
+    p.add_argument("--audit-rate", type=float, default=0.0,
+                   help="Share of screened-clean reports also given the full check, to measure agreement.")
+    p.add_argument("--pack-reports", type=int, default=1, help="Reports per packed error/FP request.")
+    p.add_argument("--longest-first", action="store_true", help="Dispatch the longest reports first to shorten each pass's tail.")
+    p.add_argument("--hedge", action="store_true",
+                   help=f"Send a duplicate of calls slower than the p{prompt.HEDGE_QUANTILE * 100:g} latency of their pass; first valid answer wins.")
+    p.add_argument("--hedge-rate", type=float, default=prompt.HEDGE_MAX_RATE, help="Most calls hedged, as a share of each pass's calls.")
+    p.add_argument("--adaptive-effort", action="store_true",
+                   help="Pick each error/FP check's reasoning effort from the report's complexity (see effort.EffortPolicy).")
+    p.add_argument("--tpm", type=int, help="Tokens-per-minute budget per model; calls wait for budget instead of hitting 429s.")
+    p.add_argument("--metrics-jsonl", type=Path, help="Append one JSON line per LLM call here.")
+    p.add_argument("--metrics-prom", type=Path, help="Write Prometheus text-format metrics here after each input.")
+    _add_logging_arguments(p)
+
+def _add_logging_arguments(p: argparse.ArgumentParser) -> None:
+    p.add_argument("--no-progress", action="store_true", help="Do not draw progress bars.")
+    p.add_argument("-v", "--verbose", action="store_true", help="Debug logging, including every HTTP request.")
+    p.add_argument("-q", "--quiet", action="store_true", help="Only log errors.")
+
+def _build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m llm_tools", description="Multi-pass LLM radiology report error detector.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    run = sub.add_parser("run", help="Run the three passes over one or more CSV/JSONL/Parquet files.")
+    run.add_argument("inputs", nargs="+", type=Path, help="Input files with a 'report' column.")
+    run.add_argument("--out", required=True, type=Path,
+                     help="Output CSV (one input) or directory (several inputs, or --stream).")
+    run.add_argument("--journal-dir", type=Path, help="Journal results here so an interrupted run can resume.")
+    run.add_argument("--batch-state", type=Path, help="Use the Batch API, with resumable state in this JSON file.")
+    run.add_argument("--stream", action="store_true", help="Process in chunks into partitioned output under --out.")
+    run.add_argument("--chunksize", type=int, default=prompt.STREAM_CHUNKSIZE)
+    run.add_argument("--format", choices=("csv", "parquet"), default="csv", help="Partition format for --stream.")
+    run.add_argument("--failed-csv", type=Path,
+                     help=f"Where to list calls that failed after all retries (default: {prompt.FAILED_CSV} next to the output).")
+    _add_pipeline_arguments(run)
+
+    exp = sub.add_parser("experiment", help="Compare pass-2/3 variants (prompts, model, reasoning effort) on one input.")
+    exp.add_argument("input", type=Path, help="Input file with a 'report' column.")
+    exp.add_argument("--variants", required=True, type=Path,
+                     help="JSON list of {name, model, error_prompt or error_prompt_file, fp_prompt or fp_prompt_file, "
+                          "reasoning_effort}; unset fields use --model and the default prompts.")
+    exp.add_argument("--out", required=True, type=Path, help="Directory for one <variant>.csv per variant and comparison.csv.")
+    _add_pipeline_arguments(exp)
+
+    cal = sub.add_parser("calibrate-effort", help="Measure TP recall, latency and cost of each reasoning-effort tier on labelled results.")
+    cal.add_argument("input", type=Path, help="Labelled results (FINAL_RESULTS_DF.csv from the app).")
+    cal.add_argument("--out", type=Path, help="Also write the table to this CSV.")
+    cal.add_argument("--clean-sample", type=int, default=200, help="Reports the original run passed, re-checked for the flag rate and cost.")
+    _add_pipeline_arguments(cal)
+
+    queue = sub.add_parser("queue", help="Distributed mode: split a corpus into leased shards, watch progress, merge results.")
+    queue_sub = queue.add_subparsers(dest="queue_command", required=True)
+    init = queue_sub.add_parser("init", help="Split an input file into shards in a new work-queue directory.")
+    init.add_argument("input", type=Path, help="Input file with a 'report' column.")
+    init.add_argument("--queue", required=True, type=Path, help="Work-queue directory (shared by all workers).")
+    init.add_argument("--model", default="o4-mini", help="Model the workers must use.")
+    init.add_argument("--shard-size", type=int, default=prompt.SHARD_SIZE)
+    status = queue_sub.add_parser("status", help="Show shard counts per status.")
+    status.add_argument("--queue", required=True, type=Path)
+    merge = queue_sub.add_parser("merge", help="Merge the finished shards into one CSV, in input order.")
+    merge.add_argument("--queue", required=True, type=Path)
+    merge.add_argument("--out", required=True, type=Path)
+    merge.add_argument("--partial", action="store_true", help="Merge even if some shards are not done.")
+    for p in (init, status, merge):
+        _add_logging_arguments(p)
+
+    worker = sub.add_parser("worker", help="Lease shards from a work queue and process them until none are left.")
+    worker.add_argument("--queue", required=True, type=Path, help="Work-queue directory created by `queue init`.")
+    worker.add_argument("--processes", type=int, default=1, help="Worker processes to start on this host.")
+    worker.add_argument("--lease-ttl", type=float, default=prompt.LEASE_TTL, help="Seconds before a silent worker's shard is reassigned.")
+    _add_pipeline_arguments(worker, model_default=None)
+    worker.set_defaults(no_progress=True)
+
+    job = sub.add_parser("job", help="Background jobs submitted from the app.")
+    job_sub = job.add_subparsers(dest="job_command", required=True)
+    job_run = job_sub.add_parser("run", help="Run a submitted job (started by the app; the API key comes from $OPENAI_API_KEY).")
+    job_run.add_argument("job_dir", type=Path)
+    job_list = job_sub.add_parser("list", help="Show the jobs and their status.")
+    job_list.add_argument("--root", type=Path, default=Path(prompt.JOBS_DIR))
+    for p in (job_run, job_list):
+        _add_logging_arguments(p)
+    return parser
+
+def _read_table(path: Path):
+    import pandas as pd
+    suffix = path.suffix.lower()
+    if suffix == ".parquet":
+        return pd.read_parquet(path)
+    if suffix in (".jsonl", ".ndjson"):
+        return pd.read_json(path, lines=True)
+    return pd.read_csv(path)
+
+def _output_for(args: argparse.Namespace, path: Path) -> Path:
+    if len(args.inputs) == 1 and not args.stream:
+        return args.out
+    return args.out / (path.stem if args.stream else f"{path.stem}.csv")
+
+def _pipeline_kwargs(args: argparse.Namespace, cache) -> Dict[str, Any]:
+    """Keyword arguments for the pipeline entry points from the shared options."""
+    from llm_tools import events
+    from llm_tools.cascade import Cascade
+    from llm_tools.dedup import Deduplicator
+    from llm_tools.effort import EffortPolicy
+    from llm_tools.endpoints import EndpointPool
+    from llm_tools.hedging import Hedger
+    from llm_tools.local_preprocess import RuleBasedPreprocessor
+    from llm_tools.scheduler import TokenScheduler
+
+    reporter = events.Reporter() if args.no_progress else events.TqdmReporter()
+    return dict(
+        api_key=args.api_key,
+        model=args.model,
+        use_chatgpt=not args.azure,
+        cache=cache,
+        max_concurrency=args.max_concurrency,
+        local_preprocessor=RuleBasedPreprocessor() if args.local_preprocess else None,
+        dedup=Deduplicator(near_duplicates=args.near_duplicates) if args.dedup else None,
+        pack_reports=args.pack_reports,
+        cascade=Cascade(
+            args.screen_model, screen_effort=None if args.screen_effort == "none" else args.screen_effort,
+            samples=args.screen_samples, audit_rate=args.audit_rate,
+        ) if args.cascade else None,
+        scheduler=TokenScheduler(longest_first=args.longest_first, tpm=args.tpm)
+        if args.longest_first or args.tpm else None,
+        hedger=Hedger(max_rate=args.hedge_rate) if args.hedge else None,
+        effort_policy=EffortPolicy() if args.adaptive_effort else None,
+        endpoints=EndpointPool.from_json(args.endpoints) if args.endpoints else None,
+        reporter=reporter,
+    )
+
+def _run(args: argparse.Namespace) -> int:
+    from llm_tools import pipeline
+    from llm_tools.cache import ResponseCache
+    from llm_tools.telemetry import Telemetry
+
+    if not args.api_key and args.endpoints is None:
+        log.error("No API key: pass --api-key, set OPENAI_API_KEY or use --endpoints.")
+        return 2
+    cache = None if args.no_cache else ResponseCache(args.cache)
+    common = _pipeline_kwargs(args, cache)
+    failed = 0
+    totals = Telemetry()
+    try:
+        for path in args.inputs:
+            out = _output_for(args, path)
+            failed_csv = args.failed_csv or (out if args.stream else out.parent) / prompt.FAILED_CSV
+            if args.failed_csv is not None and len(args.inputs) > 1:
+                failed_csv = failed_csv.with_name(f"{failed_csv.stem}.{path.stem}{failed_csv.suffix}")
+            tm = Telemetry(args.metrics_jsonl)
+            try:
+                if args.stream:
+                    summary = pipeline.stream_unstructured_accuracy(
+                        path, out, chunksize=args.chunksize, out_format=args.format,
+                        failed_csv=failed_csv, telemetry=tm, **common,
+                    )
+                else:
+                    batch_state = args.batch_state
+                    if batch_state is not None and len(args.inputs) > 1:
+                        batch_state = batch_state.with_name(f"{batch_state.stem}.{path.stem}{batch_state.suffix}")
+                    df, summary = pipeline.get_unstructured_accuracy(
+                        _read_table(path), batch_state=batch_state, journal_dir=args.journal_dir,
+                        failed_csv=failed_csv, telemetry=tm, **common,
+                    )
+                    out.parent.mkdir(parents=True, exist_ok=True)
+                    df.to_csv(out, index=False, encoding="utf-8")
+            except Exception as e:
+                failed += 1
+                log.error("%s failed: %s", path, e)
+                continue
+            finally:
+                tm.close()
+                totals.merge(tm)
+                if args.metrics_prom is not None:
+                    totals.write_prometheus(args.metrics_prom)
+            log.info("%s → %s", path, out)
+            print(f"{path}\n{summary.to_string(index=False)}", flush=True)
+    finally:
+        if cache is not None:
+            cache.close()
+    return 1 if failed else 0
+
+def _load_variants(path: Path) -> List[Any]:
+    import json
+    from llm_tools.experiment import Variant
+
+    specs = json.loads(path.read_text(encoding="utf-8"))
+    for spec in specs:
+        for key in ("error_prompt", "fp_prompt"):
+            if f"{key}_file" in spec:
+                spec[key] = (path.parent / spec.pop(f"{key}_file")).read_text(encoding="utf-8")
+    return [Variant.from_dict(spec) for spec in specs]
+
+def _experiment(args: argparse.Namespace) -> int:
+    from llm_tools import pipeline
+    from llm_tools.cache import ResponseCache
+    from llm_tools.telemetry import Telemetry
+
+    if not args.api_key and args.endpoints is None:
+        log.error("No API key: pass --api-key, set OPENAI_API_KEY or use --endpoints.")
+        return 2
+    variants = _load_variants(args.variants)
+    cache = None if args.no_cache else ResponseCache(args.cache)
+    kwargs = _pipeline_kwargs(args, cache)
+    if kwargs.pop("cascade") is not None:
+        log.warning("--cascade is not used in experiments; every variant gets the full error check.")
+    tm = Telemetry(args.metrics_jsonl)
+    try:
+        results, comparison = pipeline.run_experiment(
+            _read_table(args.input), variants, failed_csv=args.out / prompt.FAILED_CSV, telemetry=tm, **kwargs,
+        )
+    finally:
+        tm.close()
+        if cache is not None:
+            cache.close()
+    args.out.mkdir(parents=True, exist_ok=True)
+    for name, df in results.items():
+        df.to_csv(args.out / f"{name}.csv", index=False, encoding="utf-8")
+    comparison.to_csv(args.out / "comparison.csv", index=False, encoding="utf-8")
+    print(comparison.to_string(index=False), flush=True)
+    return 0
+
+def _calibrate(args: argparse.Namespace) -> int:
+    import pandas as pd
+    from llm_tools.cache import ResponseCache
+    from llm_tools.effort import EffortPolicy, calibrate
+
+    if not args.api_key and args.endpoints is None:
+        log.error("No API key: pass --api-key, set OPENAI_API_KEY or use --endpoints.")
+        return 2
+    cache = None if args.no_cache else ResponseCache(args.cache)
+    kwargs = _pipeline_kwargs(args, cache)
+    kwargs.pop("cascade")
+    policy = kwargs.pop("effort_policy") or EffortPolicy()
+    try:
+        table = calibrate(pd.read_csv(args.input), policy=policy, clean_sample=args.clean_sample, **kwargs)
+    finally:
+        if cache is not None:
+            cache.close()
+    if args.out is not None:
+        args.out.parent.mkdir(parents=True, exist_ok=True)
+        table.to_csv(args.out, index=False, encoding="utf-8")
+    print(table.to_string(index=False), flush=True)
+    return 0
+
+def _queue(args: argparse.Namespace) -> int:
+    from llm_tools import pipeline
+    from llm_tools.workqueue import WorkQueue, merge
+
+    if args.queue_command == "init":
+        queue = WorkQueue.create(args.queue, args.input, model=args.model, shard_size=args.shard_size)
+        log.info("%s: %s shards of up to %s rows", args.queue, queue.meta()["shards"], args.shard_size)
+    else:
+        queue = WorkQueue(args.queue)
+        if not queue.meta():
+            log.error("%s is not a work queue; create it with `queue init` first.", args.queue)
+            return 2
+    try:
+        if args.queue_command == "merge":
+            out, (acc1, acc2) = merge(queue, args.out, allow_partial=args.partial)
+            log.info("merged → %s", out)
+            print(pipeline._summary(acc1, acc2).to_string(index=False), flush=True)
+        status = queue.status()
+        print("  ".join(f"{k}={v:,}" for k, v in status.items()), flush=True)
+        return 1 if status["failed"] else 0
+    finally:
+        queue.close()
+
+def _work(args: argparse.Namespace) -> int:
+    """One worker process: lease shards and run the passes on each until the queue is drained."""
+    from llm_tools import pipeline
+    from llm_tools.cache import ResponseCache
+    from llm_tools.telemetry import Telemetry
+    from llm_tools.workqueue import WorkQueue, run_worker, worker_id
+
+    queue = WorkQueue(args.queue, lease_ttl=args.lease_ttl)
+    model = args.model or queue.meta().get("model")
+    queue.check_settings(model)
+    cache = None if args.no_cache else ResponseCache(args.cache)
+    common = {**_pipeline_kwargs(args, cache), "model": model}
+    totals = Telemetry()
+    me = worker_id()
+
+    def _process(df, shard: int):
+        tm = Telemetry(args.metrics_jsonl)
+        try:
+            result, _ = pipeline.get_unstructured_accuracy(
+                df, journal_dir=queue.root / "journal", telemetry=tm,
+                failed_csv=queue.root / "failed" / f"shard-{shard:05d}.csv", **common,
+            )
+        finally:
+            tm.close()
+            totals.merge(tm)
+            if args.metrics_prom is not None:
+                totals.write_prometheus(args.metrics_prom.with_name(f"{args.metrics_prom.stem}.{os.getpid()}{args.metrics_prom.suffix}"))
+        return result
+
+    try:
+        done = run_worker(queue, _process, worker=me)
+    finally:
+        queue.close()
+        if cache is not None:
+            cache.close()
+    log.info("[%s] finished %d shards", me, done)
+    return 0
+
+def _worker(args: argparse.Namespace) -> int:
+    if not args.api_key and args.endpoints is None:
+        log.error("No API key: pass --api-key, set OPENAI_API_KEY or use --endpoints.")
+        return 2
+    if args.processes <= 1:
+        return _work(args)
+    import multiprocessing
+    procs = [multiprocessing.Process(target=_work, args=(args,)) for _ in range(args.processes)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+    return 1 if any(p.exitcode for p in procs) else 0
+
+def _job(args: argparse.Namespace) -> int:
+    from llm_tools import jobs
+
+    if args.job_command == "run":
+        return jobs.run_job(args.job_dir)
+    for j in jobs.JobManager(args.root).jobs():
+        print(f"{j['id']}  {j['status']:<9}  {j.get('rows', 0):>9,} rows  {j['parts_done']:>5} parts  {j.get('name', '')}", flush=True)
+    return 0
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = _build_parser().parse_args(argv)
+    level = logging.ERROR if args.quiet else (logging.DEBUG if args.verbose else logging.INFO)
+    logging.basicConfig(level=level, format="%(asctime)s %(levelname)s %(message)s", stream=sys.stderr)
+    if not args.verbose:
+        logging.getLogger("httpx").setLevel(logging.WARNING)  # one INFO line per request otherwise
+    if args.command == "run":
+        if args.stream and args.batch_state is not None:
+            log.error("--stream and --batch-state cannot be combined.")
+            return 2
+        return _run(args)
+    if args.command == "experiment":
+        return _experiment(args)
+    if args.command == "calibrate-effort":
+        return _calibrate(args)
+    if args.command == "queue":
+        return _queue(args)
+    if args.command == "worker":
+        return _worker(args)
+    if args.command == "job":
+        return _job(args)
+    return 2
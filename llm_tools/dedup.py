@@ -0,0 +1,120 @@
+from __future__ import annotations
+import hashlib, json, re
+from array import array
+from typing import Dict, List, Optional
+
+_TOKEN = re.compile(r"\[\s*(date|phi)\s*\]", flags=re.I)
+_SPACE = re.compile(r"\s+")
+_MERSENNE = (1 << 61) - 1
+
+def _normalize(text: str) -> str:
+    text = _TOKEN.sub(lambda m: f"[{m.group(1).lower()}]", text)
+    return _SPACE.sub(" ", text).strip().lower()
+
+def _normalize_report(preprocessed: str) -> str:
+    """Case/whitespace/[DATE]/[PHI]-insensitive form of a pass-1 JSON (or raw text)."""
+    try:
+        obj = json.loads(preprocessed)
+        return f"{_normalize(str(obj.get('findings', '')))}\x00{_normalize(str(obj.get('impression', '')))}"
+    except (TypeError, ValueError, AttributeError):
+        return _normalize(str(preprocessed))
+
+def _hash64(text: str) -> int:
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "big")
+
+class Deduplicator:
+    """Groups preprocessed reports so passes 2 and 3 run once per group.
+
+    Reports are grouped exactly by a hash of their normalized text. With
+    `near_duplicates=True`, a MinHash/LSH index over word shingles also puts a report into
+    an existing group whose estimated Jaccard similarity is at least `threshold`. This is
+    off by default: a near-duplicate can differ in exactly the word (e.g. laterality) that
+    makes it an error.
+    """
+
+    def __init__(
+        self,
+        *,
+        near_duplicates: bool = False,
+        threshold: float = 0.9,
+        num_perm: int = 64,
+        bands: int = 16,
+        shingle: int = 3,
+    ):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.near_duplicates = near_duplicates
+        self.threshold = threshold
+        self.shingle = shingle
+        self._rows_per_band = num_perm // bands
+        self._bands = bands
+        seeds = [_hash64(f"minhash-{i}") for i in range(2 * num_perm)]
+        self._perm = list(zip(seeds[::2], seeds[1::2]))
+        self._exact: Dict[str, str] = {}
+        self._signatures: Dict[str, array] = {}
+        self._buckets: Dict[tuple, str] = {}
+        self.rows = 0
+        self.groups = 0
+        self.near_matches = 0
+
+    def _signature(self, text: str) -> array:
+        words = text.split()
+        k = min(self.shingle, len(words)) or 1
+        hashes = {_hash64(" ".join(words[i:i + k])) for i in range(max(1, len(words) - k + 1))}
+        return array("Q", (min((a * h + b) % _MERSENNE for h in hashes) for a, b in self._perm))
+
+    def _band_keys(self, sig: array) -> List[tuple]:
+        r = self._rows_per_band
+        return [(b, tuple(sig[b * r:(b + 1) * r])) for b in range(self._bands)]
+
+    def _near_group(self, text: str) -> Optional[str]:
+        sig = self._signature(text)
+        keys = self._band_keys(sig)
+        for band_key in keys:
+            group = self._buckets.get(band_key)
+            if group is None:
+                continue
+            other = self._signatures[group]
+            if sum(x == y for x, y in zip(sig, other)) / len(sig) >= self.threshold:
+                return group
+        group = hashlib.sha1(text.encode("utf-8")).hexdigest()
+        self._signatures[group] = sig
+        for band_key in keys:
+            self._buckets.setdefault(band_key, group)
+        return None
+
+    def key(self, preprocessed: str) -> str:
+        """Group key of a preprocessed report; registers a new group when nothing matches."""
+        self.rows += 1
+        text = _normalize_report(preprocessed)
+        digest = hashlib.sha1(text.encode("utf-8")).hexdigest()
+        group = self._exact.get(digest)
+        if group is not None:
+            return group
+        if self.near_duplicates:
+            near = self._near_group(text)
+            if near is not None:
+                self.near_matches += 1
+                self._exact[digest] = near
+                return near
+        self._exact[digest] = digest
+        self.groups += 1
+        return digest
+
+    def reset(self) -> None:
+        self._exact.clear()
+        self._signatures.clear()
+        self._buckets.clear()
+        self.rows = self.groups = self.near_matches = 0
+
+    @property
+    def ratio(self) -> float:
+        """Share of pass-2/3 calls saved: 1 - groups / rows."""
+        return 1 - self.groups / self.rows if self.rows else 0.0
+
+    def summary(self) -> str:
+        near = f" ({self.near_matches:,} near-duplicate matches)" if self.near_duplicates else ""
+        return (
+            f"Deduplication: {self.rows:,} reports in {self.groups:,} groups{near}; "
+            f"dedup ratio {self.ratio:.1%} of error-check/FP calls saved."
+        )
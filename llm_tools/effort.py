@@ -0,0 +1,163 @@
+from __future__ import annotations
+import json, math, re
+from typing import Any, Dict, List, Mapping, Optional, Sequence
+
+import pandas as pd
+from llm_tools import prompt
+from llm_tools.scheduler import estimate_tokens
+
+_MEASUREMENT_RE = re.compile(r"\d+(?:\.\d+)?(?:\s*[x×]\s*\d+(?:\.\d+)?)*\s*(?:mm|cm|ml|cc)\b", re.I)
+_LATERALITY_RE = re.compile(r"\b(?:left|right|bilateral(?:ly)?|ipsilateral|contralateral)\b", re.I)
+_ADDENDUM_RE = re.compile(r"\b(?:addend(?:um|a)|correction|amendment)\b", re.I)
+
+def report_features(report: str) -> Dict[str, float]:
+    """Cheap local features of a preprocessed report (the `PREPROCESSING_SCHEMA` JSON, or plain text)."""
+    try:
+        sections = json.loads(report)
+        findings, impression = str(sections.get("findings", "")), str(sections.get("impression", ""))
+    except (TypeError, ValueError, AttributeError):
+        findings, impression = str(report), ""
+    text = f"{findings}\n{impression}"
+    return {
+        "tokens": float(estimate_tokens(text)),
+        "measurements": float(len(_MEASUREMENT_RE.findall(text))),
+        "laterality": float(min(6, len(_LATERALITY_RE.findall(text)))),
+        "addendum": float(bool(_ADDENDUM_RE.search(text))),
+        "impression_ratio": min(2.0, len(impression) / len(findings)) if findings else 0.0,
+    }
+
+class Tier:
+    """A reasoning effort (and optionally a model) for reports scoring at least `threshold`."""
+
+    def __init__(self, reasoning_effort: Optional[str], threshold: float = 0.0, *, model: Optional[str] = None, name: Optional[str] = None):
+        self.reasoning_effort = reasoning_effort
+        self.threshold = threshold
+        self.model = model
+        self.name = name or (f"{model}:{reasoning_effort}" if model else str(reasoning_effort))
+
+    def __repr__(self) -> str:
+        return f"Tier({self.reasoning_effort!r}, {self.threshold!r}, model={self.model!r})"
+
+class EffortPolicy:
+    """Picks the reasoning effort (and optionally the model) of every error check and FP check.
+
+    Each report's `report_features` are combined into a complexity score with `weights`
+    (default `prompt.EFFORT_WEIGHTS`). The report gets the tier with the highest threshold
+    the score reaches (default `prompt.EFFORT_TIERS`: low, medium, high), so a two-line
+    normal study is checked at low effort and a long report with measurements, laterality
+    and an addendum at high effort. Tiers without a model use the run's model.
+    Use `calibrate` on labelled results to check what each tier costs in TP recall.
+    """
+
+    def __init__(self, tiers: Optional[Sequence[Tier]] = None, *, weights: Optional[Mapping[str, float]] = None):
+        tiers = tiers if tiers is not None else [Tier(effort, threshold) for effort, threshold in prompt.EFFORT_TIERS]
+        if not tiers:
+            raise ValueError("An effort policy needs at least one tier.")
+        self.tiers: List[Tier] = sorted(tiers, key=lambda t: t.threshold)
+        self.weights = dict(prompt.EFFORT_WEIGHTS if weights is None else weights)
+        self.reset()
+
+    def reset(self) -> None:
+        self.counts: Dict[str, int] = dict.fromkeys((t.name for t in self.tiers), 0)
+
+    def score(self, report: str) -> float:
+        features = report_features(report)
+        return sum(w * features.get(name, 0.0) for name, w in self.weights.items())
+
+    def tier(self, report: str) -> Tier:
+        """The tier of `report`, without counting it."""
+        score = self.score(report)
+        chosen = self.tiers[0]
+        for tier in self.tiers:
+            if score >= tier.threshold:
+                chosen = tier
+        return chosen
+
+    def choose(self, report: str) -> Tier:
+        tier = self.tier(report)
+        self.counts[tier.name] += 1
+        return tier
+
+    def summary(self) -> str:
+        total = sum(self.counts.values())
+        shares = ", ".join(f"{name} {n:,} ({n / total:.0%})" for name, n in self.counts.items()) if total else "no checks"
+        return f"Effort policy: {shares}."
+
+def _rate(mask: pd.Series) -> float:
+    return float(mask.mean()) if len(mask) else math.nan
+
+def calibrate(
+    results: pd.DataFrame,
+    *,
+    api_key: str,
+    model: str = "o4-mini",
+    policy: Optional[EffortPolicy] = None,
+    clean_sample: int = 200,
+    label_col: str = "accuracy_3",
+    seed: int = 0,
+    **kw: Any,
+) -> pd.DataFrame:
+    """Measure each tier of `policy` against the reviewer labels of a `FINAL_RESULTS_DF.csv`.
+
+    The reports labelled TP or FP, plus `clean_sample` reports the original run passed,
+    are checked again once per tier (one `run_experiment` variant per tier, sharing
+    pass 1). Per tier the table gives TP recall (labelled true errors still flagged), the
+    share of labelled false positives flagged again, the flag rate on the clean sample,
+    error-check latency and tokens and cost per report. A last row estimates the same for
+    the policy itself, taking each report's verdict from the tier it would choose.
+    Other keyword arguments go to `pipeline.run_experiment`.
+    """
+    from llm_tools import pipeline
+    from llm_tools.experiment import Variant
+
+    policy = policy if policy is not None else EffortPolicy()
+    labels = results[label_col].astype(str) if label_col in results.columns else pd.Series("", index=results.index)
+    labelled = results[labels.isin(["TP", "FP"])]
+    if labelled.empty:
+        raise ValueError(f"No TP/FP labels in column '{label_col}'; label a results file first.")
+    passed = results[pd.to_numeric(results[prompt.COL_ACC2_SCORE], errors="coerce") == 1]
+    clean = passed.sample(min(clean_sample, len(passed)), random_state=seed)
+    data = pd.concat([labelled, clean])[[prompt.COL_REPORT]].reset_index(drop=True)
+    kind = pd.Series(list(labels.loc[labelled.index]) + ["clean"] * len(clean))
+
+    variants = [Variant(t.name, model=t.model or model, reasoning_effort=t.reasoning_effort) for t in policy.tiers]
+    by_tier, comparison = pipeline.run_experiment(data, variants, api_key=api_key, model=model, **kw)
+    comparison = comparison.set_index("variant")
+
+    rows = []
+    verdicts: Dict[str, pd.Series] = {}
+    for tier in policy.tiers:
+        df = by_tier[tier.name]
+        flagged = pd.to_numeric(df[prompt.COL_ACC2_SCORE], errors="coerce").reindex(data.index) == 0
+        verdicts[tier.name] = flagged
+        stats = comparison.loc[tier.name]
+        rows.append({
+            "tier": tier.name,
+            "model": tier.model or model,
+            "reasoning_effort": tier.reasoning_effort,
+            "min_score": tier.threshold,
+            "tp_recall": _rate(flagged[kind == "TP"]),
+            "fp_reflagged": _rate(flagged[kind == "FP"]),
+            "clean_flag_rate": _rate(flagged[kind == "clean"]),
+            "error_check_p50_s": stats["error_check_p50_s"],
+            "error_check_p95_s": stats["error_check_p95_s"],
+            "tokens_per_report": stats["tokens_per_report"],
+            "cost_per_report_usd": stats["cost_usd"] / stats["reports"] if stats["reports"] else math.nan,
+        })
+
+    preprocessed = by_tier[policy.tiers[0].name][prompt.COL_PREPROCESSED].reindex(data.index)
+    chosen = preprocessed.map(lambda r: policy.tier(r).name if isinstance(r, str) else None)
+    flagged = pd.Series(
+        [verdicts[name][i] if name is not None else False for i, name in chosen.items()], index=data.index,
+    )
+    share = chosen.value_counts(normalize=True)
+    per_tier = pd.DataFrame(rows).set_index("tier")
+    rows.append({
+        "tier": "policy (" + ", ".join(f"{name} {share.get(name, 0):.0%}" for name in per_tier.index) + ")",
+        "tp_recall": _rate(flagged[kind == "TP"]),
+        "fp_reflagged": _rate(flagged[kind == "FP"]),
+        "clean_flag_rate": _rate(flagged[kind == "clean"]),
+        "tokens_per_report": sum(share.get(name, 0) * per_tier.at[name, "tokens_per_report"] for name in per_tier.index),
+        "cost_per_report_usd": sum(share.get(name, 0) * per_tier.at[name, "cost_per_report_usd"] for name in per_tier.index),
+    })
+    return pd.DataFrame(rows)
@@ -0,0 +1,223 @@
+from __future__ import annotations
+import asyncio, json, os, time
+from pathlib import Path
+from typing import Any, Dict, List, Mapping, Optional, Sequence
+
+from llm_tools import prompt
+from llm_tools.ratelimit import ConcurrencyController, _error_class
+from llm_tools.scheduler import TokenBudget
+
+class Endpoint:
+    """One OpenAI account or Azure deployment: its credentials, share of traffic and limits.
+
+    With `azure_endpoint` the client is Azure OpenAI, and `deployments` maps model names to
+    the endpoint's deployment names (an endpoint with `deployments` only serves those
+    models). `max_concurrency` is the ceiling of the endpoint's own adaptive concurrency
+    limit per model, and `tpm` (one limit, or {model: limit}) its tokens-per-minute quota.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        *,
+        api_key: str,
+        azure_endpoint: Optional[str] = None,
+        api_version: Optional[str] = None,
+        base_url: Optional[str] = None,
+        weight: float = 1.0,
+        max_concurrency: int = prompt.MAX_CONCURRENCY,
+        tpm: Optional[int | Mapping[str, int]] = None,
+        deployments: Optional[Mapping[str, str]] = None,
+    ):
+        if weight <= 0:
+            raise ValueError(f"Endpoint '{name}' needs a positive weight.")
+        self.name = name
+        self.api_key = api_key
+        self.azure_endpoint = azure_endpoint
+        self.api_version = api_version
+        self.base_url = base_url
+        self.weight = float(weight)
+        self.max_concurrency = max_concurrency
+        self.tpm = tpm
+        self.deployments = dict(deployments) if deployments else None
+        self.client = None
+        self._controllers: Dict[str, ConcurrencyController] = {}
+        self._budgets: Dict[str, TokenBudget] = {}
+        self.inflight = 0
+        self.failures = 0          # consecutive 429/5xx/timeouts
+        self.ejected_until = 0.0
+        self.cooldown = 0.0
+        self.reset()
+
+    @classmethod
+    def from_dict(cls, d: Mapping[str, Any]) -> "Endpoint":
+        """Endpoint from a JSON object; the key is `api_key`, or read from the variable named by `api_key_env`."""
+        d = dict(d)
+        if "api_key" not in d:
+            env = d.pop("api_key_env", "OPENAI_API_KEY")
+            d["api_key"] = os.environ.get(env)
+            if not d["api_key"]:
+                raise ValueError(f"Endpoint '{d.get('name')}': ${env} is not set.")
+        return cls(d.pop("name"), **d)
+
+    def reset(self) -> None:
+        self.calls = self.errors = self.ejections = 0
+
+    def serves(self, model: str) -> bool:
+        return self.deployments is None or model in self.deployments
+
+    def deployment(self, model: str) -> str:
+        return self.deployments.get(model, model) if self.deployments else model
+
+    def controller(self, model: str) -> ConcurrencyController:
+        ctl = self._controllers.get(model)
+        if ctl is None:
+            ctl = self._controllers[model] = ConcurrencyController(max_limit=self.max_concurrency)
+        return ctl
+
+    def budget(self, model: str) -> Optional[TokenBudget]:
+        budget = self._budgets.get(model)
+        if budget is None:
+            tpm = self.tpm.get(model) if isinstance(self.tpm, Mapping) else self.tpm
+            if not tpm:
+                return None
+            budget = self._budgets[model] = TokenBudget(tpm)
+        return budget
+
+    def load(self, model: str) -> float:
+        """Requests in flight per unit of capacity: the current concurrency limit times the weight."""
+        return (self.inflight + 1) / (self.weight * self.controller(model).limit)
+
+    def __repr__(self) -> str:
+        return f"Endpoint({self.name!r}, weight={self.weight!r}, max_concurrency={self.max_concurrency!r})"
+
+class EndpointPool:
+    """Spreads the LLM calls of a run over several OpenAI accounts and Azure deployments.
+
+    Pass the pool as `endpoints=` to the pipeline entry points (CLI: `--endpoints
+    endpoints.json`); it takes the place of the single client. Every call goes to the
+    least-loaded healthy endpoint that serves its model, where load is the requests in
+    flight relative to the endpoint's learned concurrency limit times its `weight`. Each
+    endpoint has its own `ConcurrencyController` and TPM budget per model, so throughput
+    adds up over the deployments and a 429 on one does not slow the others down.
+
+    After `eject_after` consecutive 429s, 5xx errors or timeouts, an endpoint is taken
+    out of rotation for `cooldown` seconds. When it comes back, one more failure ejects
+    it again for twice as long (up to `max_cooldown`) and a success restores it. While
+    every endpoint is out, calls wait for the first to return.
+    """
+
+    def __init__(
+        self,
+        endpoints: Sequence[Endpoint],
+        *,
+        eject_after: int = prompt.ENDPOINT_EJECT_AFTER,
+        cooldown: float = prompt.ENDPOINT_COOLDOWN,
+        max_cooldown: float = 16 * prompt.ENDPOINT_COOLDOWN,
+    ):
+        names = [e.name for e in endpoints]
+        if not names or len(set(names)) != len(names):
+            raise ValueError("An endpoint pool needs at least one endpoint, with unique names.")
+        self.endpoints: List[Endpoint] = list(endpoints)
+        self.eject_after = eject_after
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        for e in self.endpoints:
+            e.cooldown = cooldown
+
+    @classmethod
+    def from_json(cls, path: str | Path, **kw: Any) -> "EndpointPool":
+        """Pool from a JSON list of `Endpoint.from_dict` objects."""
+        specs = json.loads(Path(path).read_text(encoding="utf-8"))
+        return cls([Endpoint.from_dict(spec) for spec in specs], **kw)
+
+    @property
+    def max_concurrency(self) -> int:
+        """Sum of the endpoints' concurrency ceilings."""
+        return sum(e.max_concurrency for e in self.endpoints)
+
+    async def __aenter__(self) -> "EndpointPool":
+        from llm_tools import llm_call
+
+        for e in self.endpoints:
+            if e.azure_endpoint is not None:
+                e.client = llm_call._make_async_client(
+                    e.api_key, False, max_connections=e.max_concurrency,
+                    azure_endpoint=e.azure_endpoint, api_version=e.api_version or os.environ.get("OPENAI_API_VERSION"),
+                )
+            else:
+                kw = {"base_url": e.base_url} if e.base_url else {}
+                e.client = llm_call._make_async_client(e.api_key, True, max_connections=e.max_concurrency, **kw)
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        for e in self.endpoints:
+            if e.client is not None:
+                await e.client.close()
+                e.client = None
+
+    async def acquire(self, model: str) -> Endpoint:
+        """The endpoint for the next call to `model`; give it back with `release`."""
+        candidates = [e for e in self.endpoints if e.serves(model)]
+        if not candidates:
+            raise ValueError(f"No endpoint in the pool serves model '{model}'.")
+        while True:
+            now = time.monotonic()
+            healthy = [e for e in candidates if e.ejected_until <= now and e.controller(model).paused_until <= now]
+            if healthy:
+                endpoint = min(healthy, key=lambda e: e.load(model))
+                endpoint.inflight += 1
+                endpoint.calls += 1
+                return endpoint
+            back = min(max(e.ejected_until, e.controller(model).paused_until) for e in candidates)
+            await asyncio.sleep(max(0.0, back - now))
+
+    def release(self, endpoint: Endpoint, error: Optional[BaseException] = None) -> None:
+        """Record the outcome of a call routed to `endpoint` (`error` None: it succeeded)."""
+        endpoint.inflight -= 1
+        if isinstance(error, asyncio.CancelledError):
+            return
+        if error is None:
+            endpoint.failures = 0
+            endpoint.cooldown = self.base_cooldown
+            return
+        endpoint.errors += 1
+        if _error_class(error) not in ("rate_limited", "timeout", "server"):
+            return
+        endpoint.failures += 1
+        now = time.monotonic()
+        if endpoint.failures >= self.eject_after and endpoint.ejected_until <= now:
+            if endpoint.ejections and endpoint.failures > self.eject_after:  # failed again right after returning
+                endpoint.cooldown = min(self.max_cooldown, endpoint.cooldown * 2)
+            endpoint.ejected_until = now + endpoint.cooldown
+            endpoint.ejections += 1
+
+    def reset(self) -> None:
+        for e in self.endpoints:
+            e.reset()
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Per endpoint: calls, errors, ejections, whether it is in rotation and its concurrency limits."""
+        now = time.monotonic()
+        return {
+            e.name: {
+                "calls": e.calls,
+                "errors": e.errors,
+                "ejections": e.ejections,
+                "in_rotation": e.ejected_until <= now,
+                "limits": {model: int(ctl.limit) for model, ctl in e._controllers.items()},
+            }
+            for e in self.endpoints
+        }
+
+    def summary(self) -> str:
+        total = sum(e.calls for e in self.endpoints)
+        parts = []
+        for e in self.endpoints:
+            text = f"{e.name} {e.calls:,} calls ({e.calls / total:.0%})" if total else f"{e.name} no calls"
+            if e.errors:
+                text += f", {e.errors:,} errors"
+            if e.ejections:
+                text += f", ejected {e.ejections:,}×"
+            parts.append(text)
+        return "Endpoints: " + "; ".join(parts) + "."
@@ -0,0 +1,115 @@
+from __future__ import annotations
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Iterator, Optional
+
+logger = logging.getLogger("llm_tools")
+
+INFO, SUCCESS, WARNING, ERROR = "info", "success", "warning", "error"
+_LOG_LEVELS = {INFO: logging.INFO, SUCCESS: logging.INFO, WARNING: logging.WARNING, ERROR: logging.ERROR}
+
+class Progress:
+    """Progress counter with the subset of the tqdm interface the passes use."""
+
+    def __init__(self, desc: str, total: Optional[int] = None):
+        self.desc = desc
+        self.total = total
+        self.n = 0
+
+    def update(self, n: int = 1) -> None:
+        self.n += n
+
+    def refresh(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self) -> "Progress":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+class Reporter:
+    """Receives the pipeline's messages and progress; the default logs to `llm_tools`.
+
+    Subclass it to route them elsewhere (a UI, a scheduler's task log, metrics). The
+    pipeline reaches the active reporter through `use_reporter`, so helpers deep in the
+    call stack do not need it passed in.
+    """
+
+    def event(self, level: str, message: str) -> None:
+        logger.log(_LOG_LEVELS.get(level, logging.INFO), message)
+
+    def progress(self, desc: str, total: Optional[int] = None, unit: str = "rep") -> Progress:
+        return Progress(desc, total)
+
+class CallbackReporter(Reporter):
+    """Reporter built from plain functions: `on_event(level, message)` and
+    `on_progress(desc, done, total)`, the latter called after every update."""
+
+    def __init__(
+        self,
+        on_event: Optional[Callable[[str, str], None]] = None,
+        on_progress: Optional[Callable[[str, int, Optional[int]], None]] = None,
+    ):
+        self.on_event = on_event
+        self.on_progress = on_progress
+
+    def event(self, level: str, message: str) -> None:
+        if self.on_event is None:
+            super().event(level, message)
+        else:
+            self.on_event(level, message)
+
+    def progress(self, desc: str, total: Optional[int] = None, unit: str = "rep") -> Progress:
+        if self.on_progress is None:
+            return Progress(desc, total)
+        callback = self.on_progress
+
+        class _CallbackProgress(Progress):
+            def update(self, n: int = 1) -> None:
+                super().update(n)
+                callback(self.desc, self.n, self.total)
+        return _CallbackProgress(desc, total)
+
+class TqdmReporter(Reporter):
+    """Console reporter: tqdm bars on stderr, messages through `logging`."""
+
+    def progress(self, desc: str, total: Optional[int] = None, unit: str = "rep"):
+        from tqdm import tqdm
+        return tqdm(total=total, desc=desc, unit=unit, leave=False)
+
+_reporter: ContextVar[Reporter] = ContextVar("llm_tools_reporter", default=Reporter())
+
+def current() -> Reporter:
+    return _reporter.get()
+
+@contextmanager
+def use_reporter(reporter: Optional[Reporter]) -> Iterator[Reporter]:
+    """Make `reporter` the active one for this context (and the tasks it starts)."""
+    if reporter is None:
+        yield current()
+        return
+    token = _reporter.set(reporter)
+    try:
+        yield reporter
+    finally:
+        _reporter.reset(token)
+
+def info(message: str) -> None:
+    current().event(INFO, message)
+
+def success(message: str) -> None:
+    current().event(SUCCESS, message)
+
+def warning(message: str) -> None:
+    current().event(WARNING, message)
+
+def error(message: str) -> None:
+    current().event(ERROR, message)
+
+def progress(desc: str, total: Optional[int] = None, unit: str = "rep") -> Progress:
+    return current().progress(desc, total, unit)
@@ -0,0 +1,100 @@
+from __future__ import annotations
+import math
+from typing import Any, Dict, List, Mapping, Optional, Sequence
+
+import pandas as pd
+from llm_tools import prompt
+from llm_tools.telemetry import Telemetry
+
+_SHARED = "(shared pass 1)"
+
+class Variant:
+    """One configuration of passes 2 and 3: model, error-check and FP-check prompts, reasoning effort.
+
+    Unset prompts are the `prompt` module's as they are when the variant is created, and
+    an unset model is the run's; the variant is passed to the passes explicitly, so
+    several of them can run side by side in one process without patching module globals.
+    The calls made for the variant are recorded in its own `telemetry`.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        *,
+        model: Optional[str] = None,
+        error_prompt: Optional[str] = None,
+        fp_prompt: Optional[str] = None,
+        reasoning_effort: Optional[str] = "high",
+    ):
+        self.name = name
+        self.model = model
+        self.error_prompt = prompt.SYSTEM_PROMPT_ERROR_CHECK if error_prompt is None else error_prompt
+        self.fp_prompt = prompt.SYSTEM_PROMPT_FP_CHECK if fp_prompt is None else fp_prompt
+        self.reasoning_effort = reasoning_effort
+        self.reset()
+
+    @classmethod
+    def from_dict(cls, d: Mapping[str, Any]) -> "Variant":
+        """Variant from a JSON object with `name` and any of the keyword arguments."""
+        return cls(d["name"], **{k: d[k] for k in ("model", "error_prompt", "fp_prompt", "reasoning_effort") if k in d})
+
+    def reset(self) -> None:
+        self.telemetry = Telemetry()
+
+    def __repr__(self) -> str:
+        return f"Variant({self.name!r}, model={self.model!r}, reasoning_effort={self.reasoning_effort!r})"
+
+def _rate(n: int, d: int) -> float:
+    return n / d if d else math.nan
+
+def compare(
+    variants: Sequence[Variant],
+    results: Mapping[str, pd.DataFrame],
+    shared: Optional[Telemetry] = None,
+) -> pd.DataFrame:
+    """Side-by-side table of the variants of one experiment, one row per variant.
+
+    Verdicts: share of checked reports flagged by the error check, share of flags the
+    FP verifier overturned, final error rate, and agreement of the final verdict with the
+    first variant. Calls: p50/p95 latency of the error check, tokens and estimated cost
+    of passes 2 and 3. With `shared`, a last row gives the cost of the pass-1 calls that
+    all variants reused.
+    """
+    rows: List[Dict[str, Any]] = []
+    baseline = results[variants[0].name][prompt.COL_ACC2_SCORE] if variants else None
+    for v in variants:
+        df = results[v.name]
+        first = df[prompt.COL_ACC1_SCORE].dropna()
+        final = df[prompt.COL_ACC2_SCORE].dropna()
+        flagged = first.index[first == 0]
+        overturned = int((df.loc[flagged, prompt.COL_ACC2_SCORE] == 1).sum())
+        agree = pd.concat([final, baseline], axis=1, join="inner").dropna()
+        calls = v.telemetry.summary()
+        err = calls.loc[prompt.PASS_ERROR_CHECK] if prompt.PASS_ERROR_CHECK in calls.index else None
+        total = calls.loc["total"]
+        tokens = int(total["prompt_tokens"] + total["completion_tokens"])
+        rows.append({
+            "variant": v.name,
+            "model": v.model,
+            "reasoning_effort": v.reasoning_effort,
+            "reports": len(first),
+            "flag_rate": _rate(len(flagged), len(first)),
+            "fp_overturn_rate": _rate(overturned, len(flagged)),
+            "final_error_rate": _rate(int((final == 0).sum()), len(final)),
+            "agreement_with_first": _rate(int((agree.iloc[:, 0] == agree.iloc[:, 1]).sum()), len(agree)),
+            "failed_checks": len(df) - len(first),
+            "error_check_p50_s": math.nan if err is None else err["latency_p50_s"],
+            "error_check_p95_s": math.nan if err is None else err["latency_p95_s"],
+            "calls": int(total["calls"]),
+            "tokens": tokens,
+            "tokens_per_report": _rate(tokens, len(first)),
+            "cost_usd": total["cost_usd"],
+        })
+    if shared is not None and shared.calls:
+        total = shared.summary().loc["total"]
+        tokens = int(total["prompt_tokens"] + total["completion_tokens"])
+        rows.append({"variant": _SHARED, "calls": int(total["calls"]), "tokens": tokens, "cost_usd": total["cost_usd"]})
+    table = pd.DataFrame(rows)
+    for col in ("reports", "failed_checks", "calls", "tokens"):
+        table[col] = table[col].astype("Int64")
+    return table
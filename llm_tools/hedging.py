@@ -0,0 +1,189 @@
+from __future__ import annotations
+import asyncio, time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Awaitable, Callable, Deque, Dict, Iterator, List, Optional, Tuple
+
+from llm_tools import prompt, telemetry
+
+def _quantile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+class _KeyStats:
+    """Recent latencies and hedge counts of one (pass, model)."""
+
+    def __init__(self, window: int):
+        self.latencies: Deque[float] = deque(maxlen=window)
+        self.threshold: Optional[float] = None
+        self.calls = self.hedges = self.wins = 0
+        self._since_update = 0
+
+class Hedger:
+    """Fires a duplicate of a call that is slower than usual; the first valid answer wins.
+
+    The latency of successful calls is tracked per (pass, model). Once `min_samples` are
+    known, a call still running after the `quantile` of them (at least `min_delay` seconds)
+    gets a second, identical request; whichever returns a schema-valid response first is
+    used and the other is cancelled. If one fails, the other is awaited. At most
+    `max_rate` of each pass's calls are hedged, which bounds the extra cost and the extra
+    requests in flight (hedges do not wait for a concurrency slot).
+
+    Only single-report requests are hedged (not packed ones). A hedge that wins cuts the
+    slow call short, so how long it would have taken is estimated from the latencies seen
+    above that point; `summary()` and the telemetry report the hedges and that estimate.
+    The cancelled request is recorded in the telemetry as `hedge_cancelled`.
+    """
+
+    def __init__(
+        self,
+        *,
+        quantile: float = prompt.HEDGE_QUANTILE,
+        max_rate: float = prompt.HEDGE_MAX_RATE,
+        min_samples: int = prompt.HEDGE_MIN_SAMPLES,
+        min_delay: float = prompt.HEDGE_MIN_DELAY,
+        window: int = 1_000,
+    ):
+        if not 0.0 < quantile < 1.0:
+            raise ValueError("quantile must be between 0 and 1.")
+        if not 0.0 <= max_rate <= 1.0:
+            raise ValueError("max_rate must be between 0 and 1.")
+        self.quantile = quantile
+        self.max_rate = max_rate
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.window = window
+        self.reset()
+
+    def reset(self) -> None:
+        self._keys: Dict[Tuple[str, str], _KeyStats] = {}
+        self.observed: Deque[float] = deque(maxlen=10_000)   # latency the pipeline saw
+        self.unhedged: Deque[float] = deque(maxlen=10_000)   # the same, without hedging (estimated)
+        self.saved = 0.0
+
+    def _stats(self, pass_name: str, model: str) -> _KeyStats:
+        key = (pass_name, model)
+        stats = self._keys.get(key)
+        if stats is None:
+            stats = self._keys[key] = _KeyStats(self.window)
+        return stats
+
+    def _learn(self, stats: _KeyStats, latency: float) -> None:
+        stats.latencies.append(latency)
+        stats._since_update += 1
+        if len(stats.latencies) >= self.min_samples and (stats.threshold is None or stats._since_update >= 20):
+            stats.threshold = max(self.min_delay, _quantile(list(stats.latencies), self.quantile))
+            stats._since_update = 0
+
+    def delay(self, pass_name: str, model: str) -> Optional[float]:
+        """Seconds after which a call of this pass/model would be hedged (None: not yet known)."""
+        return self._stats(pass_name, model).threshold
+
+    def _residual(self, stats: _KeyStats, elapsed: float) -> float:
+        """Expected latency of a call known to be slower than `elapsed`."""
+        slower = [x for x in stats.latencies if x > elapsed]
+        return sum(slower) / len(slower) if slower else elapsed
+
+    async def call(self, pass_name: str, model: str, attempt: Callable[..., Awaitable[str]]) -> str:
+        """Run `attempt(on_send)` (one validated request), hedged with a second one if it is slow.
+
+        `attempt` calls `on_send()` when its request leaves, so time spent waiting for a
+        concurrency slot or token budget does not count towards the hedge delay. The hedge is
+        `attempt(None, hedge=True)`, which should skip the concurrency queue.
+        """
+        stats = self._stats(pass_name, model)
+        stats.calls += 1
+        sent = asyncio.Event()
+        sides: Dict[str, Dict[str, bool]] = {"primary": {}, "backup": {}}
+        with telemetry.hedge_side(sides["primary"]):
+            primary = asyncio.ensure_future(attempt(sent.set))
+        backup: Optional[asyncio.Future] = None
+        try:
+            waiter = asyncio.ensure_future(sent.wait())
+            try:
+                await asyncio.wait({primary, waiter}, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                waiter.cancel()
+            start = time.monotonic()
+            if not primary.done() and stats.threshold is not None:
+                await asyncio.wait({primary}, timeout=stats.threshold)
+            if primary.done() or stats.threshold is None or stats.hedges >= self.max_rate * stats.calls:
+                content = await primary
+                latency = time.monotonic() - start
+                self._learn(stats, latency)
+                self.observed.append(latency)
+                self.unhedged.append(latency)
+                return content
+
+            stats.hedges += 1
+            hedged_at = time.monotonic()
+            with telemetry.hedge_side(sides["backup"]):
+                backup = asyncio.ensure_future(attempt(None, hedge=True))
+            pending = {primary, backup}
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = next((t for t in done if t.exception() is None), None)
+                if winner is not None:
+                    break
+                error = error or next(iter(done)).exception()
+            else:
+                raise error
+
+            latency = time.monotonic() - start
+            self.observed.append(latency)
+            won = winner is backup
+            saved = 0.0
+            if won:
+                stats.wins += 1
+                self._learn(stats, latency - (hedged_at - start))
+                saved = self._residual(stats, latency) - latency
+            else:
+                self._learn(stats, latency)
+            self.unhedged.append(latency + saved)
+            self.saved += saved
+            telemetry.record_hedge(pass_name, model, won=won, saved=saved)
+            return winner.result()
+        finally:
+            for task, side in ((primary, sides["primary"]), (backup, sides["backup"])):
+                if task is not None and not task.done():
+                    side["cancelled"] = backup is not None  # the telemetry records hedge losers
+                    task.cancel()
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Per `pass/model`: calls, hedges, hedges that won, and the current trigger delay."""
+        return {
+            f"{pass_name}/{model}": {"calls": s.calls, "hedges": s.hedges, "wins": s.wins, "delay_s": s.threshold}
+            for (pass_name, model), s in self._keys.items()
+        }
+
+    def summary(self) -> str:
+        calls = sum(s.calls for s in self._keys.values())
+        hedges = sum(s.hedges for s in self._keys.values())
+        wins = sum(s.wins for s in self._keys.values())
+        text = (
+            f"Hedging (after p{self.quantile * 100:g} latency, at most {self.max_rate:.0%} of calls): "
+            f"{hedges:,} of {calls:,} calls hedged, {wins:,} won by the hedge"
+        )
+        if self.observed:
+            text += (
+                f"; p99 latency {_quantile(list(self.observed), 0.99):.1f} s, "
+                f"about {_quantile(list(self.unhedged), 0.99):.1f} s without hedging "
+                f"({self.saved:,.0f} s saved in total)"
+            )
+        return text + "."
+
+_hedger: ContextVar[Optional[Hedger]] = ContextVar("llm_tools_hedger", default=None)
+
+def current() -> Optional[Hedger]:
+    return _hedger.get()
+
+@contextmanager
+def use_hedger(hedger: Optional[Hedger]) -> Iterator[Optional[Hedger]]:
+    """Hedge the single-report LLM calls made in this context (and the tasks it starts)."""
+    token = _hedger.set(hedger)
+    try:
+        yield hedger
+    finally:
+        _hedger.reset(token)
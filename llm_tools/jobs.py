@@ -0,0 +1,279 @@
+from __future__ import annotations
+import json, os, shutil, signal, subprocess, sys, time, uuid
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple
+
+import pandas as pd
+from llm_tools import events, prompt
+
+_PART = "__part__"  # stream partition a collected row came from
+_ACTIVE = ("queued", "running")
+_last_seq = 0
+
+def _next_seq() -> int:
+    """Nanosecond submit timestamp, strictly increasing within this process."""
+    global _last_seq
+    _last_seq = max(_last_seq + 1, time.time_ns())
+    return _last_seq
+
+def _order(job: Dict[str, Any]) -> Tuple[int, str]:
+    # jobs written before `seq` was stored fall back to their `created` time
+    return job.get("seq", int(job.get("created", 0) * 1e9)), job.get("id", "")
+
+def _write_json(path: Path, obj: Dict[str, Any]) -> None:
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    tmp.write_text(json.dumps(obj, ensure_ascii=False), encoding="utf-8")
+    os.replace(tmp, path)
+
+def _read_json(path: Path) -> Dict[str, Any]:
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+
+def _alive(pid: Optional[int]) -> bool:
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    try:  # a finished child of this process stays a zombie until it is reaped
+        return os.waitpid(pid, os.WNOHANG) == (0, 0)
+    except ChildProcessError:
+        return True
+
+class JobReporter(events.Reporter):
+    """Writes a job's messages to `events.jsonl` and its progress to `progress.json`."""
+
+    def __init__(self, job_dir: Path, *, interval: float = 1.0):
+        self.job_dir = job_dir
+        self.interval = interval
+        self._bars: Dict[str, Tuple[int, Optional[int]]] = {}
+        self._written = 0.0
+
+    def event(self, level: str, message: str) -> None:
+        super().event(level, message)
+        with open(self.job_dir / "events.jsonl", "a", encoding="utf-8") as f:
+            f.write(json.dumps({"ts": time.time(), "level": level, "message": message}, ensure_ascii=False) + "\n")
+
+    def _update(self, desc: str, n: int, total: Optional[int], force: bool = False) -> None:
+        self._bars[desc] = (n, total)
+        now = time.monotonic()
+        if force or now - self._written >= self.interval:
+            self._written = now
+            _write_json(self.job_dir / "progress.json", {d: list(v) for d, v in self._bars.items()})
+
+    def progress(self, desc: str, total: Optional[int] = None, unit: str = "rep") -> events.Progress:
+        reporter = self
+
+        class _JobProgress(events.Progress):
+            def update(self, n: int = 1) -> None:
+                super().update(n)
+                reporter._update(self.desc, self.n, self.total)
+
+            def close(self) -> None:
+                reporter._update(self.desc, self.n, self.total, force=True)
+        return _JobProgress(desc, total)
+
+class JobManager:
+    """Error-detection runs in the background, one directory per job under `root`.
+
+    `submit` saves the input and settings and starts a detached `python -m llm_tools job
+    run <dir>` process, so a run outlives Streamlit reruns, refreshes and dropped sessions.
+    The API key is handed to that process in its environment and never written to disk.
+    Jobs run one at a time in submission order. Each job streams its input through the
+    passes (`stream_unstructured_accuracy`), writing `out/part-NNNNN.csv` as chunks finish.
+    A cancelled or crashed job resumes from those parts and their journals when it is
+    started again.
+
+    Each file in a job directory has one writer. The submitting side writes `job.json`
+    (settings), `pid` and `cancelled`. The job process writes `state.json`,
+    `progress.json`, `events.jsonl`, `summary.csv` and the output.
+    """
+
+    def __init__(self, root: str | Path = prompt.JOBS_DIR):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def job_dir(self, job_id: str) -> Path:
+        return self.root / job_id
+
+    def submit(self, source: BinaryIO, *, name: str, api_key: str, settings: Dict[str, Any]) -> str:
+        """Queue a run over the CSV file object `source` and start its process; returns the job id.
+
+        The bytes are copied to the job's `input.csv` as they are; only the header is
+        parsed here. `settings` are JSON-serialisable pipeline options: `model`,
+        `local_preprocess`, `dedup`, `cascade`, `prompts` (overrides of the `prompt`
+        module's system prompts), `cache_path` and `chunksize`.
+        """
+        seq = _next_seq()
+        job_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+        job_dir = self.job_dir(job_id)
+        job_dir.mkdir(parents=True)
+        input_csv = job_dir / "input.csv"
+        with open(input_csv, "wb") as f:
+            shutil.copyfileobj(source, f)
+        try:
+            columns = pd.read_csv(input_csv, nrows=0).columns
+        except (ValueError, UnicodeDecodeError) as e:  # EmptyDataError and ParserError are ValueErrors
+            shutil.rmtree(job_dir)
+            raise ValueError(f"Input is not a readable CSV: {e}") from e
+        if prompt.COL_REPORT not in columns:
+            shutil.rmtree(job_dir)
+            raise ValueError("Input must contain a 'report' column.")
+        rows = sum(len(c) for c in pd.read_csv(input_csv, usecols=[prompt.COL_REPORT], chunksize=prompt.JOB_CHUNKSIZE))
+        _write_json(job_dir / "job.json", {
+            "id": job_id, "name": name, "rows": rows, "created": time.time(), "seq": seq, "settings": settings,
+        })
+        self.start(job_id, api_key)
+        return job_id
+
+    def start(self, job_id: str, api_key: str) -> None:
+        """Start (or restart) the process of `job_id`."""
+        job_dir = self.job_dir(job_id).resolve()
+        (job_dir / "cancelled").unlink(missing_ok=True)
+        path = os.pathsep.join(filter(None, [str(Path(__file__).resolve().parents[1]), os.environ.get("PYTHONPATH")]))
+        with open(job_dir / "worker.log", "ab") as log:
+            proc = subprocess.Popen(
+                [sys.executable, "-m", "llm_tools", "job", "run", str(job_dir)],
+                env={**os.environ, "OPENAI_API_KEY": api_key, "PYTHONPATH": path},
+                stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT,
+                start_new_session=True,  # not killed with the UI server's process group
+            )
+        (job_dir / "pid").write_text(str(proc.pid), encoding="utf-8")
+
+    def cancel(self, job_id: str) -> None:
+        job_dir = self.job_dir(job_id)
+        (job_dir / "cancelled").touch()
+        pid = self._pid(job_dir)
+        if _alive(pid):
+            os.kill(pid, signal.SIGTERM)
+
+    def _pid(self, job_dir: Path) -> Optional[int]:
+        try:
+            return int((job_dir / "pid").read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None
+
+    def status(self, job_id: str) -> Dict[str, Any]:
+        """Settings, state and progress of one job.
+
+        `status` is queued, running, done, failed or cancelled; a job whose process is gone
+        without finishing counts as failed. `parts_done` is the number of leading output
+        parts that are complete, which can be labelled while the rest is still running.
+        """
+        job_dir = self.job_dir(job_id)
+        job = _read_json(job_dir / "job.json")
+        state = _read_json(job_dir / "state.json")
+        status = state.get("status", "queued")
+        if status in _ACTIVE:
+            if (job_dir / "cancelled").exists():
+                status = "cancelled"
+            elif not _alive(self._pid(job_dir)):
+                status, state["error"] = "failed", state.get("error") or "The job process exited unexpectedly."
+        return {
+            **job,
+            **state,
+            "status": status,
+            "progress": _read_json(job_dir / "progress.json"),
+            "parts_done": len(finished_parts(job_dir)),
+        }
+
+    def jobs(self) -> List[Dict[str, Any]]:
+        """Status of every job, oldest first (in submission order)."""
+        return sorted((self.status(p.name) for p in self.root.iterdir() if (p / "job.json").exists()), key=_order)
+
+    def _wait_for_turn(self, job_id: str, poll_interval: float) -> None:
+        turn = _order(_read_json(self.job_dir(job_id) / "job.json"))
+        while any(_order(j) < turn and j["status"] in _ACTIVE for j in self.jobs()):
+            time.sleep(poll_interval)
+
+def finished_parts(job_dir: Path) -> List[Path]:
+    """The output parts of a job, up to the first one that is not written yet."""
+    parts = []
+    while (path := job_dir / "out" / f"part-{len(parts):05d}.csv").exists():
+        parts.append(path)
+    return parts
+
+def collect_results(job_dir: str | Path, out_path: str | Path) -> int:
+    """Append the job's newly finished parts to `out_path`; returns how many parts it holds.
+
+    Rows keep their position in `out_path` as it grows, and rows already there (with any
+    labels written into them) are left as they are, so labeling can go on while the job
+    runs. A `__part__` column records where each row came from.
+    """
+    job_dir, out_path = Path(job_dir), Path(out_path)
+    merged, columns = -1, None
+    if out_path.exists():
+        columns = list(pd.read_csv(out_path, nrows=0).columns)
+        for chunk in pd.read_csv(out_path, usecols=[_PART], chunksize=prompt.STREAM_CHUNKSIZE):
+            if len(chunk):
+                merged = max(merged, int(chunk[_PART].max()))
+    new = finished_parts(job_dir)[merged + 1:]
+    if not new:
+        return merged + 1
+    tmp = out_path.with_name(out_path.name + ".tmp")
+    if out_path.exists():
+        shutil.copyfile(out_path, tmp)
+    with open(tmp, "a", newline="", encoding="utf-8") as f:
+        for part, path in enumerate(new, start=merged + 1):
+            df = pd.read_csv(path)
+            df[_PART] = part
+            if columns is None:
+                columns = list(df.columns)
+                df.to_csv(f, index=False)
+            else:
+                df.reindex(columns=columns).to_csv(f, index=False, header=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, out_path)
+    return merged + 1 + len(new)
+
+def run_job(job_dir: str | Path, *, poll_interval: float = prompt.JOB_POLL_INTERVAL) -> int:
+    """Body of a job process: wait for earlier jobs, then run the passes over the input."""
+    from llm_tools import pipeline
+    from llm_tools.cache import ResponseCache
+    from llm_tools.cascade import Cascade
+    from llm_tools.dedup import Deduplicator
+    from llm_tools.local_preprocess import RuleBasedPreprocessor
+
+    job_dir = Path(job_dir)
+    manager = JobManager(job_dir.parent)
+    job = _read_json(job_dir / "job.json")
+    settings = job["settings"]
+    state: Dict[str, Any] = {"status": "queued"}
+    _write_json(job_dir / "state.json", state)
+    manager._wait_for_turn(job["id"], poll_interval)
+
+    state.update(status="running", started=time.time())
+    _write_json(job_dir / "state.json", state)
+    for key, value in (settings.get("prompts") or {}).items():
+        setattr(prompt, key, value)  # this process only runs this job
+    cache = ResponseCache(settings.get("cache_path") or prompt.CACHE_PATH)
+    try:
+        summary = pipeline.stream_unstructured_accuracy(
+            job_dir / "input.csv", job_dir / "out",
+            api_key=os.environ.get("OPENAI_API_KEY", ""),
+            model=settings.get("model", "o4-mini"),
+            cache=cache,
+            chunksize=settings.get("chunksize", prompt.JOB_CHUNKSIZE),
+            local_preprocessor=RuleBasedPreprocessor() if settings.get("local_preprocess") else None,
+            dedup=Deduplicator() if settings.get("dedup") else None,
+            cascade=Cascade(audit_rate=0.05) if settings.get("cascade") else None,
+            failed_csv=job_dir / prompt.FAILED_CSV,
+            reporter=JobReporter(job_dir),
+        )
+        summary.to_csv(job_dir / "summary.csv", index=False, encoding="utf-8")
+        state.update(status="done", finished=time.time())
+        return 0
+    except Exception as e:
+        state.update(status="failed", finished=time.time(), error=f"{type(e).__name__}: {e}")
+        events.error(f"Job {job['id']} failed: {e}")
+        return 1
+    finally:
+        state.update(cache_hits=cache.hits, cache_misses=cache.misses)
+        _write_json(job_dir / "state.json", state)
+        cache.close()
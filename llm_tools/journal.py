@@ -0,0 +1,103 @@
+from __future__ import annotations
+import hashlib, json, os, time
+from pathlib import Path
+from typing import Any, Dict, Hashable, Optional
+
+import pandas as pd
+from llm_tools import prompt
+
+def _run_settings(*, cascade=None, effort_policy=None, pack_reports: int = 1) -> Dict[str, Any]:
+    """The options of a run that change its answers, as JSON; empty for a plain run."""
+    settings: Dict[str, Any] = {}
+    if cascade is not None:
+        settings["cascade"] = [cascade.screen_model, cascade.screen_effort, cascade.samples, cascade.audit_rate]
+    if effort_policy is not None:
+        settings["effort_policy"] = {
+            "tiers": [[t.reasoning_effort, t.threshold, t.model] for t in effort_policy.tiers],
+            "weights": effort_policy.weights,
+        }
+    if pack_reports > 1:
+        settings["pack_reports"] = [pack_reports, prompt.PACKED_INSTRUCTIONS]
+    return settings
+
+def _settings_hash(model: str, preprocess_model: str, settings: Optional[Dict[str, Any]] = None) -> Any:
+    h = hashlib.sha256()
+    for part in (model, preprocess_model, prompt.SYSTEM_PROMPT_PREPROCESS, prompt.SYSTEM_PROMPT_ERROR_CHECK, prompt.SYSTEM_PROMPT_FP_CHECK):
+        h.update(part.encode("utf-8") + b"\x00")
+    if settings:  # plain runs keep the fingerprint they had before options were hashed
+        h.update(json.dumps(settings, sort_keys=True, ensure_ascii=False).encode("utf-8") + b"\x00")
+    return h
+
+def _settings_fingerprint(model: str, preprocess_model: str, settings: Optional[Dict[str, Any]] = None) -> str:
+    """Hash of the models, system prompts and `_run_settings` of a run."""
+    return _settings_hash(model, preprocess_model, settings).hexdigest()
+
+def _corpus_fingerprint(df: pd.DataFrame, model: str, preprocess_model: str, settings: Optional[Dict[str, Any]] = None) -> str:
+    """Hash of the reports (with their index), models, system prompts and `_run_settings` of a run."""
+    h = _settings_hash(model, preprocess_model, settings)
+    for idx, report in df[prompt.COL_REPORT].items():
+        h.update(f"{idx}\x00{report}\x00".encode("utf-8"))
+    return h.hexdigest()
+
+def _json_idx(idx: Hashable) -> Any:
+    return idx.item() if hasattr(idx, "item") else idx
+
+class RunJournal:
+    """Append-only JSONL journal of completed (report index, pass, response) records.
+
+    Every record is flushed as soon as it is written and the file is fsync'ed at most every
+    `fsync_interval` seconds. `replay()` tolerates a torn last line from a crash.
+    """
+
+    def __init__(self, path: str | Path, fingerprint: str, *, fsync_interval: float = 1.0):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.fingerprint = fingerprint
+        self.fsync_interval = fsync_interval
+        self._last_sync = time.monotonic()
+        fresh = not self.path.exists() or self.path.stat().st_size == 0
+        if not fresh:
+            with open(self.path, encoding="utf-8") as f:
+                header = json.loads(f.readline() or "{}")
+            if header.get("fingerprint") != fingerprint:
+                raise ValueError(f"{self.path} belongs to a different corpus, model or prompt set.")
+        self._f = open(self.path, "a", encoding="utf-8")
+        if fresh:
+            self._write({"fingerprint": fingerprint})
+        else:
+            with open(self.path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    self._f.write("\n")  # terminate a torn last record before appending
+
+    def _write(self, obj: Dict[str, Any]) -> None:
+        self._f.write(json.dumps(obj, ensure_ascii=False) + "\n")
+        self._f.flush()
+        now = time.monotonic()
+        if now - self._last_sync >= self.fsync_interval:
+            os.fsync(self._f.fileno())
+            self._last_sync = now
+
+    def record(self, idx: Hashable, pass_name: str, content: str) -> None:
+        self._write({"idx": _json_idx(idx), "pass": pass_name, "content": content})
+
+    def replay(self) -> Dict[str, Dict[Hashable, str]]:
+        """pass name → {report index → response} for every record on disk."""
+        done: Dict[str, Dict[Hashable, str]] = {
+            prompt.PASS_PREPROCESS: {}, prompt.PASS_ERROR_CHECK: {}, prompt.PASS_FP_CHECK: {},
+        }
+        with open(self.path, encoding="utf-8") as f:
+            next(f, None)  # header
+            for line in f:
+                try:
+                    obj = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # torn write
+                done.setdefault(obj["pass"], {})[obj["idx"]] = obj["content"]
+        return done
+
+    def close(self) -> None:
+        if not self._f.closed:
+            self._f.flush()
+            os.fsync(self._f.fileno())
+            self._f.close()
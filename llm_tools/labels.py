@@ -0,0 +1,248 @@
+from __future__ import annotations
+import hashlib, json, os, sqlite3, tempfile, threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from pathlib import Path
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import pandas as pd
+from llm_tools import prompt
+
+class LabelLog:
+    """Append-only JSONL log of reviewer labels as (row position, label) records.
+
+    Positions are row numbers in the results file, so they survive a save/reload. Every
+    label is flushed and fsync'ed as it is written (one per click). `replay()` returns the
+    latest label per row and tolerates a torn last line. After the labels have been
+    written into the results file, `clear()` starts the log over (compaction).
+    """
+
+    def __init__(self, path: str | Path, fingerprint: str):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.fingerprint = fingerprint
+        fresh = not self.path.exists() or self.path.stat().st_size == 0
+        if not fresh:
+            with open(self.path, encoding="utf-8") as f:
+                header = json.loads(f.readline() or "{}")
+            if header.get("fingerprint") != fingerprint:
+                raise ValueError(f"{self.path} holds labels for a different results file.")
+        self._f = open(self.path, "a", encoding="utf-8")
+        self.pending = 0  # labels appended since the last compaction
+        if fresh:
+            self._write({"fingerprint": fingerprint})
+        else:
+            with open(self.path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    self._f.write("\n")  # terminate a torn last record before appending
+
+    def _write(self, obj: Dict) -> None:
+        self._f.write(json.dumps(obj, ensure_ascii=False) + "\n")
+        self._f.flush()
+        os.fsync(self._f.fileno())
+
+    def append(self, pos: int, label: str) -> None:
+        self._write({"pos": int(pos), "label": label})
+        self.pending += 1
+
+    def replay(self) -> Dict[int, str]:
+        labels: Dict[int, str] = {}
+        with open(self.path, encoding="utf-8") as f:
+            next(f, None)  # header
+            for line in f:
+                try:
+                    obj = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # torn write
+                labels[obj["pos"]] = obj["label"]
+        self.pending = len(labels)
+        return labels
+
+    def clear(self) -> None:
+        """Drop every record; call only once the labels are safely in the results file."""
+        self._f.close()
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        tmp.write_text(json.dumps({"fingerprint": self.fingerprint}) + "\n", encoding="utf-8")
+        os.replace(tmp, self.path)
+        self._f = open(self.path, "a", encoding="utf-8")
+        self.pending = 0
+
+    def close(self) -> None:
+        if not self._f.closed:
+            self._f.close()
+
+class PendingQueue:
+    """Row positions still waiting for a label, in file order.
+
+    Built once from the results; afterwards `peek` and `mark_done` for the head row are
+    O(1), so a click costs the same however large the corpus is.
+    """
+
+    def __init__(self, positions: Iterable[int], total: Optional[int] = None):
+        self._queue: Deque[int] = deque(int(p) for p in positions)
+        self._pending = set(self._queue)
+        self.total = len(self._queue) if total is None else total  # incl. rows labelled before
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    @property
+    def done(self) -> int:
+        return self.total - len(self._pending)
+
+    def peek(self) -> Optional[int]:
+        while self._queue and self._queue[0] not in self._pending:
+            self._queue.popleft()  # labelled out of order earlier
+        return self._queue[0] if self._queue else None
+
+    def mark_done(self, pos: int) -> None:
+        self._pending.discard(pos)
+        if self._queue and self._queue[0] == pos:
+            self._queue.popleft()
+
+    def upcoming(self, n: int) -> List[int]:
+        """The next `n` pending positions, head first."""
+        return list(islice((p for p in self._queue if p in self._pending), n))
+
+class PagedResults:
+    """A results CSV opened for labeling without holding it in memory.
+
+    One chunked pass over the file keeps only what the queue needs up front: the
+    positions of flagged rows (`score_col` == 0, missing scores count as flagged), their
+    existing labels, the row count and a fingerprint of the report column. The flagged
+    rows' `payload_cols` (None where absent) go to a temporary SQLite file of this
+    instance, removed by `close`. `get(pos)` fetches a row from it and runs `parse` on
+    it only when it is displayed. Parsed rows are kept in a small LRU cache, and
+    `prefetch` fills it from a background thread so the next row is ready.
+    """
+
+    def __init__(
+        self,
+        path: str | Path,
+        *,
+        score_col: str,
+        label_col: str,
+        payload_cols: Sequence[str],
+        parse: Callable[[Dict[str, Any]], Any] = dict,
+        chunksize: int = prompt.STREAM_CHUNKSIZE,
+        cache_rows: int = 64,
+    ):
+        self.path = Path(path)
+        self.score_col = score_col
+        self.label_col = label_col
+        self.payload_cols = list(payload_cols)
+        self.parse = parse
+        self.chunksize = chunksize
+        self.cache_rows = cache_rows
+        self._cache: "OrderedDict[int, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._prefetcher = ThreadPoolExecutor(max_workers=1, thread_name_prefix="label-prefetch")
+        # one index per instance: sessions labelling the same file must not share or delete it
+        fd, db_path = tempfile.mkstemp(dir=self.path.parent, prefix=f"{self.path.name}.", suffix=".pages.sqlite")
+        os.close(fd)
+        self._db_path = Path(db_path)
+        self._db = sqlite3.connect(str(self._db_path), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=OFF")
+        self._db.execute("PRAGMA synchronous=OFF")
+        self._db.execute("CREATE TABLE rows (pos INTEGER PRIMARY KEY, payload TEXT)")
+
+        self.rows = 0
+        self.labels: Dict[int, str] = {}  # labels already in the file, by position
+        try:
+            self.flagged, self.fingerprint = self._index(chunksize)
+        except BaseException:
+            self.close()
+            raise
+
+    def _index(self, chunksize: int) -> Tuple[List[int], str]:
+        """One pass over the file: fill `rows`, `labels` and the side file; returns the
+        flagged positions and the report fingerprint."""
+        score_col, label_col = self.score_col, self.label_col
+        h = hashlib.sha256()
+        flagged: List[int] = []
+        for chunk in pd.read_csv(self.path, chunksize=chunksize):
+            missing = {prompt.COL_REPORT, score_col} - set(chunk.columns)
+            if missing:
+                raise ValueError(f"CSV must contain: {', '.join(sorted(missing))}")
+            h.update(pd.util.hash_pandas_object(chunk[prompt.COL_REPORT], index=False).to_numpy().tobytes())
+            chunk.index = pd.RangeIndex(self.rows, self.rows + len(chunk))
+            self.rows += len(chunk)
+            score = pd.to_numeric(chunk[score_col], errors="coerce").fillna(0)
+            rows = chunk[score == 0]
+            flagged.extend(rows.index)
+            if label_col in rows.columns:
+                self.labels.update((int(p), v) for p, v in rows[label_col].items() if isinstance(v, str) and v)
+            payload = rows.reindex(columns=self.payload_cols).astype(object)
+            payload = payload.where(payload.notna(), None)
+            self._db.executemany(
+                "INSERT INTO rows VALUES (?, ?)",
+                ((int(p), json.dumps(r, ensure_ascii=False)) for p, r in zip(payload.index, payload.to_dict("records"))),
+            )
+        self._db.commit()
+        return flagged, h.hexdigest()
+
+    def get(self, pos: int) -> Any:
+        """Parsed payload of flagged row `pos`."""
+        with self._lock:
+            if pos in self._cache:
+                self._cache.move_to_end(pos)
+                return self._cache[pos]
+            (payload,) = self._db.execute("SELECT payload FROM rows WHERE pos = ?", (int(pos),)).fetchone()
+        row = self.parse(json.loads(payload))
+        with self._lock:
+            self._cache[pos] = row
+            while len(self._cache) > self.cache_rows:
+                self._cache.popitem(last=False)
+        return row
+
+    def prefetch(self, positions: Iterable[int]) -> None:
+        for pos in positions:
+            with self._lock:
+                cached = pos in self._cache
+            if not cached:
+                self._prefetcher.submit(self.get, pos)
+
+    def export(
+        self,
+        out_path: str | Path,
+        labels: Dict[int, str],
+        *,
+        transform: Optional[Callable[[pd.DataFrame], pd.DataFrame]] = None,
+    ) -> Path:
+        """Stream the file to `out_path` (may be the file itself) with `labels` applied.
+
+        `transform(chunk)` can add or change columns on the way out. Score columns are
+        read and written as `Int8`, as `ResultStore` builds them, so a chunk with a missing
+        score does not turn that chunk's scores into floats.
+        """
+        out_path = Path(out_path)
+        tmp = out_path.with_name(out_path.name + ".tmp")
+        pending = sorted(labels.items())
+        dtypes = {c: "Int8" for c in (prompt.COL_ACC1_SCORE, prompt.COL_ACC2_SCORE, self.score_col)}
+        i = offset = 0
+        with open(tmp, "w", newline="", encoding="utf-8") as f:
+            for chunk in pd.read_csv(
+                self.path, chunksize=self.chunksize, keep_default_na=False, na_values=[""], dtype={**dtypes, self.label_col: object},
+            ):
+                chunk.index = pd.RangeIndex(offset, offset + len(chunk))
+                if self.label_col not in chunk.columns:
+                    chunk[self.label_col] = ""
+                chunk[self.label_col] = chunk[self.label_col].astype(object).where(chunk[self.label_col].notna(), "")
+                while i < len(pending) and pending[i][0] < offset + len(chunk):
+                    chunk.at[pending[i][0], self.label_col] = pending[i][1]
+                    i += 1
+                if transform is not None:
+                    chunk = transform(chunk)
+                chunk = chunk.astype({c: t for c, t in dtypes.items() if c in chunk.columns})
+                chunk.to_csv(f, index=False, header=offset == 0)
+                offset += len(chunk)
+        os.replace(tmp, out_path)
+        return out_path
+
+    def close(self) -> None:
+        self._prefetcher.shutdown(wait=True)
+        with self._lock:
+            self._db.close()
+        self._db_path.unlink(missing_ok=True)
@@ -1,10 +1,14 @@
 
 from __future__ import annotations
-import re, json, time
-import openai, streamlit as st
-from typing import List, Dict, Any
+import re, json, time, random
+import httpx, openai
+from typing import Callable, List, Dict, Any, Optional
 
-from llm_tools.prompt import ERROR_SCHEMA, REQUEST_TIMEOUT, RETRY_SLEEP
+from llm_tools import events, hedging, scheduler, telemetry
+from llm_tools.prompt import ERROR_SCHEMA, MAX_CONNECTIONS, REQUEST_TIMEOUT, RETRY_MAX_SLEEP, RETRY_SLEEP
+from llm_tools.cache import ResponseCache, _cache_key
+from llm_tools.endpoints import EndpointPool
+from llm_tools.ratelimit import ConcurrencyController, _is_rate_limited, _retry_after_from_exc
 
 def _parse_score(cell: str | Dict[str, Any]) -> int | None:
     if not cell:
@@ -24,14 +28,215 @@ def _validate_json_response(content: str) -> None:
     if not (isinstance(obj, dict) and "error" in obj and "error_reason" in obj):
         raise ValueError("Response JSON missing required keys")
 
-def _chat_completion(client, model: str, messages: List[Dict[str, Any]]) -> str:
-    return client.chat.completions.create(
+def _validate_preprocessing_response(content: str) -> None:
+    try:
+        json.loads(content)
+    except Exception as e:
+        raise ValueError(f"Invalid preprocessing JSON: {e}")
+
+def _build_messages(system_prompt: str, user_message: str) -> List[Dict[str, Any]]:
+    return [
+        {"role": "developer", "content": [{"type": "text", "text": system_prompt}]},
+        {"role": "user", "content": user_message},
+    ]
+
+def _chat_completion(
+    client,
+    model: str,
+    messages: List[Dict[str, Any]],
+    schema: Dict[str, Any] = ERROR_SCHEMA,
+    reasoning_effort: Optional[str] = "high",
+    *,
+    pass_name: Optional[str] = None,
+) -> str:
+    extra = {"reasoning_effort": reasoning_effort} if reasoning_effort else {}
+    with telemetry.timed_call(pass_name, model) as call:
+        resp = client.chat.completions.create(
+            model=model,
+            messages=messages,
+            response_format={"type": "json_schema", "json_schema": schema},
+            timeout=REQUEST_TIMEOUT,
+            **extra,
+        )
+        call["usage"] = getattr(resp, "usage", None)
+    return resp.choices[0].message.content
+
+def _cached_completion(
+    client,
+    model: str,
+    system_prompt: str,
+    user_message: str,
+    *,
+    pass_name: str,
+    schema: Dict[str, Any] = ERROR_SCHEMA,
+    reasoning_effort: Optional[str] = "high",
+    validate: Callable[[str], None] = _validate_json_response,
+    cache: Optional[ResponseCache] = None,
+) -> str:
+    """`_chat_completion` behind the response cache; only validated responses are stored."""
+    key = None
+    if cache is not None:
+        key = _cache_key(pass_name, model, system_prompt, schema, reasoning_effort, user_message)
+        hit = cache.get(key)
+        if hit is not None:
+            return hit
+    content = _chat_completion(client, model, _build_messages(system_prompt, user_message), schema, reasoning_effort, pass_name=pass_name)
+    try:
+        validate(content)
+    except ValueError:
+        telemetry.record_invalid(pass_name, model)
+        raise
+    if cache is not None:
+        cache.put(key, content, pass_name=pass_name, model=model)
+    return content
+
+async def _achat_completion(
+    client,
+    model: str,
+    messages: List[Dict[str, Any]],
+    schema: Dict[str, Any] = ERROR_SCHEMA,
+    reasoning_effort: Optional[str] = "high",
+    controller: Optional[ConcurrencyController] = None,
+    *,
+    pass_name: Optional[str] = None,
+    reports: int = 1,
+    on_send: Optional[Callable[[], None]] = None,
+) -> str:
+    """One chat completion, recorded in the current telemetry as `pass_name` (answering `reports` reports).
+
+    Its prompt tokens are estimated up front; under a `TokenScheduler` with a TPM budget for
+    `model`, the call waits for budget first and the budget is settled with the actual usage.
+    `on_send` is called once the request leaves (after any wait for budget or a slot).
+    If `client` is an `EndpointPool`, the call goes to the endpoint the pool picks, under
+    that endpoint's own concurrency controller and TPM budget (which takes precedence over
+    the scheduler's).
+    """
+    extra = {"reasoning_effort": reasoning_effort} if reasoning_effort else {}
+    kwargs = dict(
         model=model,
         messages=messages,
-        response_format={"type": "json_schema", "json_schema": ERROR_SCHEMA},
-        reasoning_effort="high",
+        response_format={"type": "json_schema", "json_schema": schema},
         timeout=REQUEST_TIMEOUT,
-    ).choices[0].message.content
+        **extra,
+    )
+    pool = client if isinstance(client, EndpointPool) else None
+    endpoint = None
+    budget = None
+    if pool is not None:
+        endpoint = await pool.acquire(model)
+        client, kwargs["model"] = endpoint.client, endpoint.deployment(model)
+        if controller is not None:
+            controller = endpoint.controller(model)
+        budget = endpoint.budget(model)
+    predicted = scheduler.estimate_prompt_tokens(messages)
+    sched = scheduler.current()
+    if budget is None and sched is not None:
+        budget = sched.budget(client, model)
+    spend = None
+    usage = None
+    used: Optional[int] = predicted  # if the call fails, assume the prompt was processed
+    error: Optional[BaseException] = None
+    try:
+        if budget is not None:
+            spend = await budget.acquire(predicted)
+        if controller is None:
+            with telemetry.timed_call(pass_name, model, reports=reports, predicted_tokens=predicted) as call:
+                if on_send is not None:
+                    on_send()
+                resp = await client.chat.completions.create(**kwargs)
+                call["usage"] = usage = getattr(resp, "usage", None)
+            return resp.choices[0].message.content
+
+        queued = time.monotonic()
+        async with controller.slot():
+            start = time.monotonic()
+            with telemetry.timed_call(pass_name, model, reports=reports, queue_wait=start - queued, predicted_tokens=predicted) as call:
+                if on_send is not None:
+                    on_send()
+                try:
+                    raw = await client.chat.completions.with_raw_response.create(**kwargs)
+                except Exception as e:
+                    if _is_rate_limited(e):
+                        used = None
+                        controller.on_throttle(_retry_after_from_exc(e))
+                    else:
+                        controller.on_error(e)
+                    raise
+                controller.on_success(time.monotonic() - start, raw.headers)
+                resp = raw.parse()
+                call["usage"] = usage = getattr(resp, "usage", None)
+        return resp.choices[0].message.content
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        if endpoint is not None:
+            pool.release(endpoint, error)
+        if usage is not None:
+            tokens = telemetry._usage_tokens(usage)
+            used = tokens["prompt_tokens"] + tokens["completion_tokens"]
+            if sched is not None:
+                sched.record(predicted, tokens["prompt_tokens"])
+        if spend is not None:
+            await budget.settle(spend, used, None if usage is None else tokens["completion_tokens"])
+
+async def _acached_completion(
+    client,
+    model: str,
+    system_prompt: str,
+    user_message: str,
+    *,
+    pass_name: str,
+    schema: Dict[str, Any] = ERROR_SCHEMA,
+    reasoning_effort: Optional[str] = "high",
+    validate: Callable[[str], None] = _validate_json_response,
+    cache: Optional[ResponseCache] = None,
+    controller: Optional[ConcurrencyController] = None,
+    sample: int = 0,
+    lookup: bool = True,
+) -> str:
+    """`_achat_completion` behind the response cache; `sample` > 0 caches an independent
+    answer to the same request (for self-consistency sampling). With `lookup` False the
+    response is only stored (the caller has already missed the cache). Under a `Hedger`,
+    a slow call gets a duplicate request and the first valid response is used."""
+    key = None
+    if cache is not None:
+        tag = f"{pass_name}#{sample}" if sample else pass_name
+        key = _cache_key(tag, model, system_prompt, schema, reasoning_effort, user_message)
+        hit = cache.get(key) if lookup else None
+        if hit is not None:
+            return hit
+
+    async def _attempt(on_send: Optional[Callable[[], None]] = None, *, hedge: bool = False) -> str:
+        content = await _achat_completion(
+            client, model, _build_messages(system_prompt, user_message), schema, reasoning_effort,
+            None if hedge else controller,  # a hedge must not queue behind the calls it overtakes
+            pass_name=pass_name, on_send=on_send,
+        )
+        try:
+            validate(content)
+        except ValueError:
+            telemetry.record_invalid(pass_name, model)
+            raise
+        return content
+
+    hedger = hedging.current()
+    content = await (_attempt() if hedger is None else hedger.call(pass_name, model, _attempt))
+    if cache is not None:
+        cache.put(key, content, pass_name=pass_name, model=model)
+    return content
+
+def _make_async_client(api_key: str, use_chatgpt: bool, *, max_connections: int = MAX_CONNECTIONS, **kw):
+    """Async OpenAI/Azure client on one keep-alive connection pool shared by all in-flight requests.
+
+    SDK-level retries are disabled so 429s reach the concurrency controller and `retry.RetryScheduler`.
+    """
+    http_client = openai.DefaultAsyncHttpxClient(
+        limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+    )
+    if use_chatgpt:
+        return openai.AsyncOpenAI(api_key=api_key, http_client=http_client, max_retries=0, **kw)
+    return openai.AsyncAzureOpenAI(api_key=api_key, http_client=http_client, max_retries=0, **kw)
 
 def _make_client(api_key: str, use_chatgpt: bool, **kw):
     try:
@@ -74,16 +279,20 @@ def _retry_call(func, max_retries: int, use_exponential_backoff: bool = True, pr
     last_exception = None
     for attempt in range(1, max_retries + 1):
         try:
-            return func()
+            with telemetry.retry_attempt(attempt):
+                return func()
         except Exception as e:
             last_exception = e
             if idx is not None:
-                st.warning(f"[{prefix} {attempt}/{max_retries}] idx={idx} failed: {e}")
+                events.warning(f"[{prefix} {attempt}/{max_retries}] idx={idx} failed: {e}")
             else:
-                st.warning(f"[{prefix} {attempt}/{max_retries}] failed: {e}")
+                events.warning(f"[{prefix} {attempt}/{max_retries}] failed: {e}")
             if attempt < max_retries:
-                if use_exponential_backoff:
-                    time.sleep(2 ** attempt)
+                retry_after = _retry_after_from_exc(e)
+                if retry_after is not None:
+                    time.sleep(retry_after)
+                elif use_exponential_backoff:
+                    time.sleep(random.uniform(0, min(RETRY_MAX_SLEEP, 2 ** attempt)))  # full jitter
                 else:
                     time.sleep(RETRY_SLEEP)
     if last_exception:
@@ -0,0 +1,123 @@
+from __future__ import annotations
+import json, re
+from typing import Dict, Iterable, List, Optional, Tuple
+
+class LocalPreprocessor:
+    """Base class for local substitutes of the pass-1 LLM call.
+
+    Subclasses implement `parse`, returning the `PREPROCESSING_SCHEMA` fields or None when
+    they are not confident; calling the instance returns the JSON content (or None, meaning
+    "send this report to the LLM") and counts how many reports were handled locally.
+    """
+
+    def __init__(self):
+        self.handled = 0
+        self.fallback = 0
+
+    def parse(self, raw_report: str) -> Optional[Dict[str, str]]:
+        raise NotImplementedError
+
+    def __call__(self, raw_report: str) -> Optional[str]:
+        try:
+            sections = self.parse(raw_report) if isinstance(raw_report, str) else None
+        except Exception:
+            sections = None
+        if sections is None:
+            self.fallback += 1
+            return None
+        self.handled += 1
+        return json.dumps(sections, ensure_ascii=False)
+
+    def reset(self) -> None:
+        self.handled = self.fallback = 0
+
+    def summary(self) -> str:
+        total = self.handled + self.fallback
+        return f"Local preprocessor handled {self.handled:,} of {total:,} reports; {self.fallback:,} were sent to the LLM."
+
+# ──────────────────────────
+# Rule-based section splitter + redactor
+# ──────────────────────────
+_MONTH = r"(?:Jan(?:uary)?|Feb(?:ruary)?|Mar(?:ch)?|Apr(?:il)?|May|June?|July?|Aug(?:ust)?|Sep(?:t(?:ember)?)?|Oct(?:ober)?|Nov(?:ember)?|Dec(?:ember)?)"
+DATE_PATTERNS: List[str] = [
+    r"\b\d{4}([-/.])\d{1,2}\1\d{1,2}\b",                               # 2024-01-31
+    r"\b\d{1,2}([-/.])\d{1,2}\1\d{2,4}\b",                             # 01/31/2024, 31.01.24
+    rf"\b{_MONTH}\.?\s+\d{{1,2}}(?:st|nd|rd|th)?,?\s+\d{{4}}\b",       # January 31, 2024
+    rf"\b\d{{1,2}}(?:st|nd|rd|th)?\s+{_MONTH}\.?,?\s+\d{{4}}\b",       # 31 Jan 2024
+    rf"\b{_MONTH}\.?\s+\d{{4}}\b",                                     # Jan 2024
+]
+PHI_PATTERNS: List[str] = [
+    r"\b(?:MRN|Accession(?:\s+(?:No|Number))?|Acc|Patient\s+ID|Pt\s+ID)\s*[#:.]?\s*[A-Z0-9-]{4,}\b",
+    r"\b(?:Dr|Doctor)\.?\s+[A-Z][a-zA-Z'-]+(?:\s+[A-Z][a-zA-Z'-]+)?",
+    r"[\w.+-]+@[\w-]+\.[\w.-]+",
+    r"\(?\b\d{3}\)?[-.\s]\d{3}[-.\s]\d{4}\b",
+    r"\b\d{6,}\b",                                                     # MRN-like number runs
+]
+
+_FINDINGS   = ("findings", "finding", "observations")
+_IMPRESSION = ("impression", "impressions", "conclusion", "conclusions", "opinion", "interpretation")
+_ADDENDUM   = ("addendum", "addenda", "correction", "amendment")
+_DISCARD    = (
+    "history", "clinical history", "indication", "indications", "clinical indication",
+    "clinical information", "reason for exam", "reason for study", "technique", "comparison",
+    "comparisons", "exam", "examination", "procedure", "protocol", "contrast",
+    "electronically signed by", "signed by", "dictated by", "transcribed by", "reported by",
+)
+
+class RuleBasedPreprocessor(LocalPreprocessor):
+    """Heading-based Findings/Impression splitter with regex date/PHI redaction.
+
+    A line starting with a known heading (`FINDINGS:`, `IMPRESSION:`, `TECHNIQUE:`, ...)
+    opens a section; other lines, organ sub-headings included, belong to the open section.
+    Reports without both a Findings and an Impression section, with a repeated or
+    out-of-order heading, or with an Addendum/Correction (whose sentences have to be
+    routed by meaning) are left to the LLM.
+    """
+
+    def __init__(
+        self,
+        *,
+        findings: Iterable[str] = _FINDINGS,
+        impression: Iterable[str] = _IMPRESSION,
+        addendum: Iterable[str] = _ADDENDUM,
+        discard: Iterable[str] = _DISCARD,
+        date_patterns: Iterable[str] = DATE_PATTERNS,
+        phi_patterns: Iterable[str] = PHI_PATTERNS,
+    ):
+        super().__init__()
+        self._kind: Dict[str, str] = {}
+        for kind, names in (("findings", findings), ("impression", impression), ("addendum", addendum), ("discard", discard)):
+            self._kind.update({n.lower(): kind for n in names})
+        names = sorted(self._kind, key=len, reverse=True)
+        self._heading = re.compile(
+            r"^[ \t]*(" + "|".join(re.escape(n).replace(r"\ ", r"\s+") for n in names) + r")[ \t]*:[ \t]*(.*)$",
+            flags=re.I | re.M,
+        )
+        self._dates = [re.compile(p, flags=re.I) for p in date_patterns]
+        self._phi = [re.compile(p) for p in phi_patterns]
+
+    def _redact(self, text: str) -> str:
+        for pat in self._dates:
+            text = pat.sub("[DATE]", text)
+        for pat in self._phi:
+            text = pat.sub("[PHI]", text)
+        return text
+
+    def _sections(self, raw_report: str) -> List[Tuple[str, str]]:
+        matches = list(self._heading.finditer(raw_report))
+        sections: List[Tuple[str, str]] = []
+        for i, m in enumerate(matches):
+            end = matches[i + 1].start() if i + 1 < len(matches) else len(raw_report)
+            body = (m.group(2) + raw_report[m.end():end]).strip()
+            sections.append((self._kind[re.sub(r"\s+", " ", m.group(1).lower())], body))
+        return sections
+
+    def parse(self, raw_report: str) -> Optional[Dict[str, str]]:
+        sections = self._sections(raw_report)
+        kinds = [kind for kind, _ in sections if kind != "discard"]
+        if kinds != ["findings", "impression"]:  # missing, repeated, out of order or addendum
+            return None
+        body = {kind: text for kind, text in sections if kind != "discard"}
+        if not body["findings"] or not body["impression"]:
+            return None
+        return {"findings": self._redact(body["findings"]), "impression": self._redact(body["impression"])}
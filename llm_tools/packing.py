@@ -0,0 +1,176 @@
+from __future__ import annotations
+import asyncio, json
+from typing import Dict, List, Optional, Set, Tuple
+
+from llm_tools import events, prompt, llm_call
+from llm_tools.cache import ResponseCache, _cache_key
+from llm_tools.ratelimit import ConcurrencyController
+from llm_tools.scheduler import estimate_tokens
+
+def _pack_message(batch: List[Tuple[str, str]]) -> str:
+    return "\n\n".join(f'<report id="{rid}">\n{message}\n</report>' for rid, message in batch)
+
+def _unpack(content: str, ids: Set[str]) -> Dict[str, str]:
+    """id → per-report `ERROR_SCHEMA` JSON for every well-formed entry of a packed response."""
+    try:
+        entries = json.loads(content)["results"]
+    except (TypeError, ValueError, KeyError):
+        return {}
+    results: Dict[str, str] = {}
+    for entry in entries if isinstance(entries, list) else []:
+        if not isinstance(entry, dict):
+            continue
+        rid, error, reason = entry.get("id"), entry.get("error"), entry.get("error_reason")
+        if rid in ids and rid not in results and isinstance(error, str) and isinstance(reason, str):
+            results[rid] = json.dumps({"error": error, "error_reason": reason}, ensure_ascii=False)
+    return results
+
+class RequestPacker:
+    """Packs concurrent single-report requests of one pass into multi-report requests.
+
+    `submit` is called once per report, as `_acached_completion` would be. Reports
+    are grouped until `max_reports` of them or `token_budget` estimated tokens are
+    pending, or until `linger` seconds have passed. The group is then sent as one
+    `PACKED_ERROR_SCHEMA` request with the pass prompt followed by `PACKED_INSTRUCTIONS`.
+    That developer message is identical for every packed request, so providers can reuse
+    its cached prefix. Reports whose id is missing or malformed in the response are
+    retried on their own with the normal single-report prompt. If the packed request
+    itself fails (429, 5xx, timeout), every report in it gets that error, so the
+    callers' retry backoff applies.
+    """
+
+    def __init__(
+        self,
+        client,
+        model: str,
+        pass_name: str,
+        system_prompt: str,
+        *,
+        cache: Optional[ResponseCache] = None,
+        controller: Optional[ConcurrencyController] = None,
+        max_reports: int = prompt.PACK_MAX_REPORTS,
+        token_budget: int = prompt.PACK_TOKEN_BUDGET,
+        linger: float = prompt.PACK_LINGER,
+        reasoning_effort: Optional[str] = "high",
+    ):
+        self.client = client
+        self.model = model
+        self.pass_name = pass_name
+        self.system_prompt = system_prompt
+        self.packed_prompt = f"{system_prompt}\n\n{prompt.PACKED_INSTRUCTIONS}"
+        self.cache = cache
+        self.controller = controller
+        self.max_reports = max_reports
+        self.token_budget = token_budget
+        self.linger = linger
+        self.reasoning_effort = reasoning_effort
+        self._pending: List[Tuple[str, asyncio.Future]] = []
+        self._pending_tokens = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: Set[asyncio.Task] = set()
+        self.packed_requests = 0
+        self.packed_reports = 0
+        self.split_reports = 0
+
+    def _packed_key(self, user_message: str) -> str:
+        return _cache_key(
+            f"{self.pass_name}:packed", self.model, self.packed_prompt,
+            prompt.PACKED_ERROR_SCHEMA, self.reasoning_effort, user_message,
+        )
+
+    def _cached(self, user_message: str) -> Optional[str]:
+        if self.cache is None:
+            return None
+        single = _cache_key(self.pass_name, self.model, self.system_prompt, prompt.ERROR_SCHEMA, self.reasoning_effort, user_message)
+        return self.cache.get(single, self._packed_key(user_message))
+
+    async def _single(self, user_message: str) -> str:
+        return await llm_call._acached_completion(
+            self.client, self.model, self.system_prompt, user_message,
+            pass_name=self.pass_name, reasoning_effort=self.reasoning_effort,
+            cache=self.cache, controller=self.controller, lookup=False,  # `submit` already missed
+        )
+
+    async def submit(self, user_message: str) -> str:
+        hit = self._cached(user_message)
+        if hit is not None:
+            return hit
+        tokens = estimate_tokens(user_message)
+        if self.max_reports <= 1 or tokens >= self.token_budget:
+            return await self._single(user_message)
+        fut = asyncio.get_running_loop().create_future()
+        if self._pending and self._pending_tokens + tokens > self.token_budget:
+            self._flush()
+        self._pending.append((user_message, fut))
+        self._pending_tokens += tokens
+        if len(self._pending) >= self.max_reports:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.linger, self._flush)
+        return await fut
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending, self._pending_tokens = self._pending, [], 0
+        if not batch:
+            return
+        task = asyncio.get_running_loop().create_task(self._send(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, batch: List[Tuple[str, asyncio.Future]]) -> None:
+        if len(batch) == 1:
+            await self._resolve_single(*batch[0])
+            return
+        ids = [f"r{i}" for i in range(len(batch))]  # local to this request
+        try:
+            content = await llm_call._achat_completion(
+                self.client, self.model,
+                llm_call._build_messages(self.packed_prompt, _pack_message([(rid, msg) for rid, (msg, _) in zip(ids, batch)])),
+                prompt.PACKED_ERROR_SCHEMA, self.reasoning_effort, self.controller,
+                pass_name=self.pass_name, reports=len(batch),
+            )
+        except Exception as e:
+            # 429s, 5xx and timeouts: every report fails and backs off in the RetryScheduler,
+            # instead of turning one throttled request into N immediate ones
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        results = _unpack(content, set(ids))
+        if len(results) < len(batch):
+            events.warning(
+                f"[Pack {self.pass_name}] {len(batch) - len(results)} of {len(batch)} reports missing or malformed "
+                "in the packed answer; retrying them one by one"
+            )
+        self.packed_requests += 1
+        self.packed_reports += len(results)
+        retry = []
+        for rid, (message, fut) in zip(ids, batch):
+            if rid in results:
+                if self.cache is not None:
+                    self.cache.put(self._packed_key(message), results[rid], pass_name=self.pass_name, model=self.model)
+                if not fut.done():
+                    fut.set_result(results[rid])
+            else:
+                retry.append((message, fut))
+        self.split_reports += len(retry)
+        await asyncio.gather(*(self._resolve_single(message, fut) for message, fut in retry))
+
+    async def _resolve_single(self, message: str, fut: asyncio.Future) -> None:
+        try:
+            content = await self._single(message)
+        except Exception as e:
+            if not fut.done():
+                fut.set_exception(e)
+        else:
+            if not fut.done():
+                fut.set_result(content)
+
+    def summary(self) -> str:
+        return (
+            f"Packing ({self.pass_name}): {self.packed_reports:,} reports answered by "
+            f"{self.packed_requests:,} packed requests; {self.split_reports:,} retried individually."
+        )
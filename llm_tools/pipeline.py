@@ -1,186 +1,818 @@
 from __future__ import annotations
-import csv, json
-from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError
+import asyncio, json
 from pathlib import Path
-from typing import List, Tuple
-import pandas as pd, streamlit as st
-from stqdm import stqdm as tqdm
-from llm_tools import prompt, llm_call
-
-def _preprocess_reports(df: pd.DataFrame, client, model: str) -> List[int]:
-    failed: List[int] = []
-
-    def _call(idx: int, raw_report: str):
-        content = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "developer", "content": [{"type": "text", "text": prompt.SYSTEM_PROMPT_PREPROCESS}]},
-                {"role": "user", "content": raw_report},
-            ],
-            response_format={"type": "json_schema", "json_schema": prompt.PREPROCESSING_SCHEMA},
-            timeout=prompt.REQUEST_TIMEOUT,
-        ).choices[0].message.content
+from typing import Any, AsyncIterator, Callable, Dict, Hashable, Optional, Sequence, Tuple
+import pandas as pd
+from llm_tools import events, prompt, llm_call, ratelimit, batch, stream_io
+from llm_tools.cache import ResponseCache
+from llm_tools.cascade import Cascade
+from llm_tools.dedup import Deduplicator
+from llm_tools.effort import EffortPolicy, Tier
+from llm_tools.endpoints import EndpointPool
+from llm_tools.experiment import Variant, compare
+from llm_tools.hedging import Hedger, use_hedger
+from llm_tools.journal import RunJournal, _corpus_fingerprint, _run_settings, _settings_fingerprint
+from llm_tools.local_preprocess import LocalPreprocessor
+from llm_tools.packing import RequestPacker
+from llm_tools.ratelimit import ConcurrencyController
+from llm_tools.results import ResultStore
+from llm_tools.retry import AdmissionWindow, RetryPolicy, RetryScheduler, write_failures
+from llm_tools.scheduler import TokenScheduler, use_scheduler
+from llm_tools.telemetry import Telemetry, use_telemetry
 
-        try:
-            json.loads(content)
-            df.at[idx, prompt.COL_PREPROCESSED] = content
-        except Exception as e:
-            raise ValueError(f"Invalid preprocessing JSON: {e}")
-
-    with tqdm(total=len(df), desc="1st pass LLM: Preprocess", unit="rep") as pbar, ThreadPoolExecutor(max_workers=prompt.MAX_WORKERS) as pool:
-        futs = {pool.submit(_call, i, txt): i for i, txt in df[prompt.COL_REPORT].items()}
-        for fut in as_completed(futs):
-            idx = futs[fut]
+# ──────────────────────────
+# Per-report pass calls
+# ──────────────────────────
+async def _preprocess_report(
+    client, model: str, raw_report: str,
+    cache: Optional[ResponseCache] = None, controller: Optional[ConcurrencyController] = None,
+) -> str:
+    return await llm_call._acached_completion(
+        client, model, prompt.SYSTEM_PROMPT_PREPROCESS, raw_report,
+        pass_name=prompt.PASS_PREPROCESS,
+        schema=prompt.PREPROCESSING_SCHEMA,
+        reasoning_effort=None,
+        validate=llm_call._validate_preprocessing_response,
+        cache=cache, controller=controller,
+    )
+
+def _tier_model(variant: Variant, tier: Optional[Tier]) -> str:
+    return tier.model or variant.model if tier is not None else variant.model
+
+def _tier_effort(variant: Variant, tier: Optional[Tier]) -> Optional[str]:
+    return tier.reasoning_effort if tier is not None else variant.reasoning_effort
+
+async def _check_report(
+    client, variant: Variant, report: str,
+    cache: Optional[ResponseCache] = None, controller: Optional[ConcurrencyController] = None,
+    *, retry: bool = False, packer: Optional[RequestPacker] = None, tier: Optional[Tier] = None,
+) -> str:
+    if packer is not None and not retry:
+        return await packer.submit(report)
+    return await llm_call._acached_completion(
+        client, _tier_model(variant, tier), variant.error_prompt, f"<value note> {report}" if retry else report,
+        pass_name=prompt.PASS_ERROR_CHECK, reasoning_effort=_tier_effort(variant, tier),
+        cache=cache, controller=controller,
+    )
+
+async def _screen_report(
+    client, model: str, system_prompt: str, report: str, reasoning_effort: Optional[str],
+    cache: Optional[ResponseCache] = None, controller: Optional[ConcurrencyController] = None,
+    *, sample: int = 0,
+) -> str:
+    return await llm_call._acached_completion(
+        client, model, system_prompt, report,
+        pass_name=prompt.PASS_SCREEN, reasoning_effort=reasoning_effort,
+        cache=cache, controller=controller, sample=sample,
+    )
+
+async def _verify_report(
+    client, variant: Variant, report: str, error_json: str,
+    cache: Optional[ResponseCache] = None, controller: Optional[ConcurrencyController] = None,
+    *, packer: Optional[RequestPacker] = None, tier: Optional[Tier] = None,
+) -> str:
+    user_message = (
+        f"<preprocessed report JSON>\n{report}\n\n"
+        f"<previous error JSON>\n{error_json}"
+    )
+    if packer is not None:
+        return await packer.submit(user_message)
+    return await llm_call._acached_completion(
+        client, _tier_model(variant, tier), variant.fp_prompt, user_message,
+        pass_name=prompt.PASS_FP_CHECK, reasoning_effort=_tier_effort(variant, tier),
+        cache=cache, controller=controller,
+    )
+
+# ──────────────────────────
+# Streaming engine
+# ──────────────────────────
+_PASS_DESC = {
+    prompt.PASS_PREPROCESS:  "1st pass LLM: Preprocess",
+    prompt.PASS_ERROR_CHECK: "2nd pass LLM: Error detector",
+    prompt.PASS_FP_CHECK:    "3rd pass LLM: False positive verifier",
+}
+
+_RESULT_COLS = [
+    prompt.COL_PREPROCESSED,
+    prompt.COL_ACC1_JSON, prompt.COL_ACC1_SCORE,
+    prompt.COL_ACC2_JSON, prompt.COL_ACC2_SCORE,
+]
+_VERDICT_COLS = _RESULT_COLS[1:]
+
+# (report index, raw report, responses already journaled for it by pass name)
+ReportItem = Tuple[Hashable, str, Dict[str, str]]
+
+async def _process_reports(
+    items: AsyncIterator[ReportItem],
+    client,
+    model: str,
+    preprocess_model: str,
+    on_result: Callable[[Hashable, Optional[Dict[str, Any]]], None],
+    *,
+    cache: Optional[ResponseCache] = None,
+    max_concurrency: int = prompt.MAX_CONCURRENCY,
+    record: Optional[Callable[[Hashable, str, str], None]] = None,
+    total: Optional[int] = None,
+    local_preprocessor: Optional[LocalPreprocessor] = None,
+    dedup: Optional[Deduplicator] = None,
+    pack_reports: int = 1,
+    retries: Optional[RetryScheduler] = None,
+    cascade: Optional[Cascade] = None,
+    variants: Optional[Sequence[Variant]] = None,
+    effort_policy: Optional[EffortPolicy] = None,
+) -> None:
+    """Push every report through preprocess → error check → FP check without per-pass barriers.
+
+    Each report is one coroutine that moves to the next pass as soon as its previous pass
+    lands. In-flight requests are bounded per model by an adaptive `ConcurrencyController`
+    (ceiling `max_concurrency`); at most twice the ceiling of reports are admitted at a time,
+    so reports already in pass 2/3 are not queued behind the whole corpus's pass 1, and
+    `items` is only pulled as fast as reports finish. Failed calls are retried by `retries`
+    with per-error-class jittered backoff; a report sleeping before a retry gives its
+    admission place to a new one. Calls that still fail end up in `retries.failures`.
+
+    Every landed response goes to `record(idx, pass, content)`; responses supplied with the
+    item are used instead of calling the API. Pass 1 is tried with `local_preprocessor`
+    first and only falls back to the LLM for reports it cannot parse. With `dedup`, reports
+    whose preprocessed text falls into the same group share one pass-2/3 call chain: the
+    first becomes the group leader and the others wait for and copy its verdict. When a
+    report's chain ends, `on_result` gets its `_RESULT_COLS` values, or None if
+    preprocessing failed. With `pack_reports` > 1, up to that many concurrent error checks
+    (and FP checks) share one request (see `RequestPacker`). With `cascade`, a cheap screen
+    runs first and only the reports it flags or is unsure about get the full error check.
+
+    Passes 2 and 3 use `model` and the current module prompts. With `variants` (each with
+    its model set), they run once per variant instead, concurrently, on the same pass-1
+    output; the calls of each go to its telemetry, and `on_result` gets the preprocessed
+    report plus each variant's verdict columns under the variant's name. With
+    `effort_policy`, the reasoning effort (and model) of each error check and FP check is
+    chosen from the report by the policy; packing is then turned off, as a packed request
+    has a single effort. If `client` is an `EndpointPool`, the admission window is sized to
+    the sum of its endpoints' concurrency ceilings instead of `max_concurrency`.
+    """
+    if effort_policy is not None and pack_reports > 1:
+        events.warning("Reports are not packed with an effort policy; each is checked at its own effort.")
+        pack_reports = 1
+    experiment = variants is not None
+    if not experiment:
+        variants = [Variant(model, model=model)]
+    pre_ctl = ratelimit.controller_for(client, preprocess_model, max_limit=max_concurrency)
+    window = AdmissionWindow(2 * (client.max_concurrency if isinstance(client, EndpointPool) else max_concurrency))
+    retries = retries if retries is not None else RetryScheduler()
+    retries.window = window
+    ctls = {v.name: ratelimit.controller_for(client, v.model, max_limit=max_concurrency) for v in variants}
+    if cascade is not None:
+        screen_ctl = ratelimit.controller_for(client, cascade.screen_model, max_limit=max_concurrency)
+    packers: Dict[str, Tuple[Optional[RequestPacker], Optional[RequestPacker]]] = {}
+    for v in variants:
+        packers[v.name] = (None, None) if pack_reports <= 1 else (
+            RequestPacker(
+                client, v.model, prompt.PASS_ERROR_CHECK, v.error_prompt, reasoning_effort=v.reasoning_effort,
+                cache=cache, controller=ctls[v.name], max_reports=pack_reports,
+            ),
+            RequestPacker(
+                client, v.model, prompt.PASS_FP_CHECK, v.fp_prompt, reasoning_effort=v.reasoning_effort,
+                cache=cache, controller=ctls[v.name], max_reports=pack_reports,
+            ),
+        )
+
+    def _record(idx: Hashable, pass_name: str, content: str):
+        if record is not None:
+            record(idx, pass_name, content)
+
+    with events.progress(_PASS_DESC[prompt.PASS_PREPROCESS], total) as pbar_pre, \
+         events.progress(_PASS_DESC[prompt.PASS_ERROR_CHECK], 0) as pbar_err, \
+         events.progress(_PASS_DESC[prompt.PASS_FP_CHECK], 0) as pbar_fp:
+
+        async def _preprocess(idx: Hashable, raw_report: str, done: Dict[str, str]) -> Optional[str]:
+            call = lambda: _preprocess_report(client, preprocess_model, raw_report, cache, pre_ctl)
+            report = done.get(prompt.PASS_PREPROCESS)
             try:
-                fut.result(timeout=prompt.REQUEST_TIMEOUT)
-            except Exception as e:
-                st.warning(f"[Preprocess] idx={idx} failed: {e}")
-                failed.append(idx)
+                if report is None and local_preprocessor is not None:
+                    report = local_preprocessor(raw_report)
+                    if report is not None:
+                        _record(idx, prompt.PASS_PREPROCESS, report)
+                if report is None:
+                    report = await retries.call(call, pass_name=prompt.PASS_PREPROCESS, idx=idx)
+                    _record(idx, prompt.PASS_PREPROCESS, report)
+            except Exception:
+                return None
             finally:
-                pbar.update()
+                pbar_pre.update()
+            return report
 
-    # retry
-    for idx in list(failed):
-        raw_report = df.at[idx, prompt.COL_REPORT]
-        try:
-            content = llm_call._retry_call(
-                lambda: client.chat.completions.create(
-                    model=model,
-                    messages=[
-                        {"role": "developer", "content": [{"type": "text", "text": prompt.SYSTEM_PROMPT_PREPROCESS}]},
-                        {"role": "user", "content": raw_report},
-                    ],
-                    response_format={"type": "json_schema", "json_schema": prompt.PREPROCESSING_SCHEMA},
-                    timeout=prompt.REQUEST_TIMEOUT,
-                ).choices[0].message.content,
-                prompt.RETRY_LIMIT_FIRST,
-                prefix="Preprocess Retry",
-                idx=idx,
+        def _tiered(v: Variant, report: str) -> Tuple[Optional[Tier], ConcurrencyController]:
+            """The effort policy's tier for `report` (if any) and the controller of its model."""
+            if effort_policy is None:
+                return None, ctls[v.name]
+            tier = effort_policy.choose(report)
+            return tier, ratelimit.controller_for(client, _tier_model(v, tier), max_limit=max_concurrency)
+
+        async def _full_check(v: Variant, idx: Hashable, report: str) -> str:
+            tier, ctl = _tiered(v, report)
+            err_packer = packers[v.name][0]
+            return await retries.call(
+                lambda: _check_report(client, v, report, cache, ctl, packer=err_packer, tier=tier),
+                retry_func=lambda: _check_report(client, v, report, cache, ctl, retry=True, tier=tier),
+                pass_name=prompt.PASS_ERROR_CHECK, idx=idx,
             )
-            json.loads(content)
-            df.at[idx, prompt.COL_PREPROCESSED] = content
-            failed.remove(idx)
-        except Exception:
-            pass
 
-    return failed
+        async def _cascade_check(v: Variant, idx: Hashable, report: str) -> str:
+            """Screen samples first; the full check only if escalated (or audited)."""
+            samples = await window.gather(*(
+                retries.call(
+                    lambda i=i: _screen_report(
+                        client, cascade.screen_model, v.error_prompt, report, cascade.screen_effort, cache, screen_ctl, sample=i,
+                    ),
+                    pass_name=prompt.PASS_SCREEN, idx=idx,
+                ) for i in range(cascade.samples)
+            ), return_exceptions=True)
+            escalate, content = cascade.decide([None if isinstance(c, Exception) else c for c in samples])
+            audit = cascade.audits(report)
+            if not escalate and not audit:
+                return content
+            if not escalate:  # audit only: the report keeps the screen's verdict whatever happens
+                try:
+                    cascade.record_audit(escalate, await _full_check(v, idx, report))
+                except Exception:
+                    pass
+                return content
+            full = await _full_check(v, idx, report)
+            if audit:
+                cascade.record_audit(escalate, full)
+            return full
 
+        async def _evaluate(v: Variant, idx: Hashable, report: str, done: Dict[str, str]) -> Tuple[Dict[str, Any], Optional[str]]:
+            """Passes 2 and 3 for one report: (verdict columns, FP-verifier response if it ran)."""
+            verdict: Dict[str, Any] = dict.fromkeys(_VERDICT_COLS)
 
+            # 2) Error detection
+            pbar_err.total += 1
+            pbar_err.refresh()
+            content = done.get(prompt.PASS_ERROR_CHECK)
+            try:
+                if content is None:
+                    content = await (_full_check(v, idx, report) if cascade is None else _cascade_check(v, idx, report))
+                    _record(idx, prompt.PASS_ERROR_CHECK, content)
+            except Exception:
+                return verdict, None
+            finally:
+                pbar_err.update()
+            score = llm_call._parse_score(content)
+            verdict[prompt.COL_ACC1_JSON]  = verdict[prompt.COL_ACC2_JSON]  = content
+            verdict[prompt.COL_ACC1_SCORE] = verdict[prompt.COL_ACC2_SCORE] = score
+            if score != 0:
+                return verdict, None
 
-def _evaluate_first_pass(df: pd.DataFrame, client, model: str) -> List[int]:
-    failed: List[int] = []
+            # 3) False-positive check
+            pbar_fp.total += 1
+            pbar_fp.refresh()
+            error_json = content
+            fp_packer = packers[v.name][1]
+            content = done.get(prompt.PASS_FP_CHECK)
+            try:
+                if content is None:
+                    tier, ctl = _tiered(v, report)
+                    content = await retries.call(
+                        lambda: _verify_report(client, v, report, error_json, cache, ctl, packer=fp_packer, tier=tier),
+                        retry_func=lambda: _verify_report(client, v, report, error_json, cache, ctl, tier=tier),
+                        pass_name=prompt.PASS_FP_CHECK, idx=idx,
+                    )
+                    _record(idx, prompt.PASS_FP_CHECK, content)
+            except Exception:
+                return verdict, None  # keep the 2nd-pass verdict
+            finally:
+                pbar_fp.update()
+            verdict[prompt.COL_ACC2_JSON]  = content
+            verdict[prompt.COL_ACC2_SCORE] = llm_call._parse_score(content)
+            return verdict, content
 
-    def _call(idx: int, report: str):
-        content = llm_call._chat_completion(client, model, [
-            {"role": "developer", "content": [{"type": "text", "text": prompt.SYSTEM_PROMPT_ERROR_CHECK}]},
-            {"role": "user", "content": report},
-        ])
-        llm_call._validate_json_response(content)
-        return idx, content
+        # (variant, dedup group key) → future of the group leader's (verdict, FP response)
+        leaders: Dict[Tuple[str, str], asyncio.Future] = {}
 
-    with tqdm(total=len(df), desc="2nd pass LLM: Error detector", unit="rep") as pbar, ThreadPoolExecutor(max_workers=prompt.MAX_WORKERS) as pool:
-        fut_map = {pool.submit(_call, i, txt): i for i, txt in df[prompt.COL_PREPROCESSED].items()}
-        for fut in as_completed(fut_map):
-            idx = fut_map[fut]
+        async def _evaluate_grouped(
+            v: Variant, idx: Hashable, report: str, done: Dict[str, str], key: Optional[str],
+        ) -> Dict[str, Any]:
+            """`_evaluate`, shared within the dedup group `key` (None: not deduplicated)."""
+            if key is None:
+                return (await _evaluate(v, idx, report, done))[0]
+            group = (v.name, key)
+            leader = leaders.get(group)
+            if leader is not None:
+                async with window.outside():  # a retrying leader must be able to get a place back
+                    shared = await leader
+                if shared is not None:  # fan the leader's result out to this row
+                    verdict, fp_content = shared
+                    pbar_err.total += 1
+                    pbar_err.update()
+                    _record(idx, prompt.PASS_ERROR_CHECK, verdict[prompt.COL_ACC1_JSON])
+                    if fp_content is not None:
+                        pbar_fp.total += 1
+                        pbar_fp.update()
+                        _record(idx, prompt.PASS_FP_CHECK, fp_content)
+                    return dict(verdict)
+                return (await _evaluate(v, idx, report, done))[0]
+            leaders[group] = leader = asyncio.get_running_loop().create_future()
             try:
-                _, content = fut.result(timeout=prompt.REQUEST_TIMEOUT)
-                llm_call._validate_json_response(content)
-                df.at[idx, prompt.COL_ACC1_JSON] = content
-            except Exception as e:
-                st.warning(f"[1st] idx={idx} failed: {e}")
-                failed.append(idx)
+                verdict, fp_content = await _evaluate(v, idx, report, done)
+                leader.set_result((verdict, fp_content) if verdict[prompt.COL_ACC1_JSON] is not None else None)
             finally:
-                pbar.update()
+                if not leader.done():
+                    leader.set_result(None)
+                if leader.result() is None:
+                    del leaders[group]  # let the next member lead
+            return verdict
 
-    if failed:
-        st.info(f"Retrying {len(failed)} failed requests automatically...")
-        for idx in failed:
-            report = df.at[idx, prompt.COL_PREPROCESSED]
-            try:
-                content = llm_call._retry_call(
-                    lambda: llm_call._chat_completion(client, model, [
-                        {"role": "developer", "content": [{"type": "text", "text": prompt.SYSTEM_PROMPT_ERROR_CHECK}]},
-                        {"role": "user", "content": f"<value note> {report}"}
-                    ]),
-                    prompt.RETRY_LIMIT_FIRST, prefix="Retry", idx=idx
-                )
-                df.at[idx, prompt.COL_ACC1_JSON] = content
-                st.success(f"[Retry success] idx={idx}")
-            except Exception as e:
-                st.error(f"[Final Failure] idx={idx} Failed after retry attempt: {e}")
+        async def _chain(idx: Hashable, raw_report: str, done: Dict[str, str]) -> Optional[Dict[str, Any]]:
+            report = await _preprocess(idx, raw_report, done)
+            if report is None:
+                return None
+            row: Dict[str, Any] = {prompt.COL_PREPROCESSED: report}
+            # one key per report, shared by every variant (and counted once by the Deduplicator)
+            replayed = not experiment and prompt.PASS_ERROR_CHECK in done
+            key = dedup.key(report) if dedup is not None and not replayed else None
+            if not experiment:
+                row.update(await _evaluate_grouped(variants[0], idx, report, done, key))
+                return row
 
-    df[prompt.COL_ACC1_SCORE] = df[prompt.COL_ACC1_JSON].apply(llm_call._parse_score)
-    return failed
+            async def _variant(v: Variant) -> Dict[str, Any]:
+                with use_telemetry(v.telemetry):
+                    return await _evaluate_grouped(v, idx, report, {}, key)
+            row.update(zip((v.name for v in variants), await window.gather(*map(_variant, variants))))
+            return row
 
-def _evaluate_fp_pass(df: pd.DataFrame, client, model: str):
-    targets = df.index[df[prompt.COL_ACC1_SCORE] == 0].tolist()
-    if not targets:
+        async def _run(idx: Hashable, raw_report: str, done: Dict[str, str]):
+            on_result(idx, await _chain(idx, raw_report, done))
+
+        tasks = set()
+        async for idx, raw_report, done in items:
+            await window.enter()
+            task = asyncio.create_task(_run(idx, raw_report, done))
+            window.admit(task)
+            task.add_done_callback(tasks.discard)
+            tasks.add(task)
+        if tasks:
+            await asyncio.gather(*tasks)
+    for packer in (p for pair in packers.values() for p in pair):
+        if packer is not None and packer.packed_requests:
+            events.info(packer.summary())
+    if retries.retries or retries.failures:
+        events.info(retries.summary())
+
+def _report_failures(retries: RetryScheduler, failed_csv: Optional[str | Path]) -> None:
+    if not retries.failures:
         return
+    msg = f"🚨 {len(retries.failures)} calls failed after all retries"
+    if failed_csv is not None:
+        msg += f"; see {write_failures(retries.failures, failed_csv)}"
+    events.error(msg + ".")
 
-    def _call(idx: int):
-        content = llm_call._chat_completion(client, model, [
-            {"role": "developer", "content": [{"type": "text", "text": prompt.SYSTEM_PROMPT_FP_CHECK}]},
-            {"role": "user", "content": (
-                f"<preprocessed report JSON>\n{df.at[idx, prompt.COL_PREPROCESSED]}\n\n"
-                f"<previous error JSON>\n{df.at[idx, prompt.COL_ACC1_JSON]}"
-            )},
-        ])
-        llm_call._validate_json_response(content)
-        result_score = llm_call._parse_score(content)
-        return idx, content, result_score
-
-    with tqdm(total=len(targets), desc="3rd pass LLM: False positive verifier", unit="rep") as pbar, ThreadPoolExecutor(max_workers=prompt.MAX_WORKERS) as pool:
-        fut_map = {pool.submit(_call, i): i for i in targets}
-        for fut in as_completed(fut_map):
-            idx = fut_map[fut]
-            try:
-                _, content, result_score = fut.result()
-                df.at[idx, prompt.COL_ACC2_JSON]  = content
-                df.at[idx, prompt.COL_ACC2_SCORE] = result_score
-            except Exception as e:
-                st.warning(f"[FP] idx={idx} failed: {e}")
-            finally:
-                pbar.update()
+def _summary(acc1: Tuple[float, float], acc2: Tuple[float, float], telemetry: Optional[Telemetry] = None) -> pd.DataFrame:
+    """Accuracy mean/std, followed by one row per telemetry metric with a column per pass."""
+    summary = pd.DataFrame({
+        "Metric": ["mean", "std"],
+        "accuracy_1": list(acc1),
+        "accuracy_2": list(acc2),
+    })
+    if telemetry is None or not telemetry.calls:
+        return summary
+    calls = telemetry.summary().T.rename_axis("Metric").reset_index()
+    return pd.concat([summary, calls], ignore_index=True)
+
+async def _run_passes(
+    df: pd.DataFrame,
+    client,
+    model: str,
+    preprocess_model: str,
+    cache: Optional[ResponseCache] = None,
+    max_concurrency: int = prompt.MAX_CONCURRENCY,
+    journal: Optional[RunJournal] = None,
+    local_preprocessor: Optional[LocalPreprocessor] = None,
+    dedup: Optional[Deduplicator] = None,
+    pack_reports: int = 1,
+    retries: Optional[RetryScheduler] = None,
+    cascade: Optional[Cascade] = None,
+    scheduler: Optional[TokenScheduler] = None,
+    hedger: Optional[Hedger] = None,
+    effort_policy: Optional[EffortPolicy] = None,
+) -> ResultStore:
+    """`_process_reports` over an in-memory DataFrame; returns the filled `ResultStore`.
+
+    Responses already in `journal` are replayed instead of being requested again. With
+    `scheduler`, reports are dispatched in its order (longest first) and its TPM budgets
+    apply to every call; with `hedger`, slow calls are hedged.
+    """
+    replayed = journal.replay() if journal is not None else {}
+    if replayed.get(prompt.PASS_PREPROCESS):
+        events.info(
+            f"Resuming from journal: {len(replayed[prompt.PASS_PREPROCESS])} preprocessed, "
+            f"{len(replayed[prompt.PASS_ERROR_CHECK])} error-checked, "
+            f"{len(replayed[prompt.PASS_FP_CHECK])} FP-verified reports."
+        )
+    store = ResultStore(df.index)
+
+    reports = df[prompt.COL_REPORT]
+    if scheduler is not None:
+        reports = reports.loc[scheduler.order(reports)]
 
+    async def _items() -> AsyncIterator[ReportItem]:
+        for idx, raw_report in reports.items():
+            yield idx, raw_report, {p: done[idx] for p, done in replayed.items() if idx in done}
 
+    def _on_result(idx: Hashable, row: Optional[Dict[str, Any]]):
+        if row is not None:
+            store.set_row(idx, row)
 
+    with use_scheduler(scheduler), use_hedger(hedger):
+        await _process_reports(
+            _items(), client, model, preprocess_model, _on_result,
+            cache=cache, max_concurrency=max_concurrency,
+            record=journal.record if journal is not None else None, total=len(df),
+            local_preprocessor=local_preprocessor, dedup=dedup, pack_reports=pack_reports, retries=retries,
+            cascade=cascade, effort_policy=effort_policy,
+        )
+    return store
 
-def get_unstructured_accuracy(
+
+def _async_client(api_key: str, use_chatgpt: bool, endpoints: Optional[EndpointPool]):
+    """The pool if one is given, otherwise a single client for `api_key`."""
+    return endpoints if endpoints is not None else llm_call._make_async_client(api_key, use_chatgpt)
+
+async def get_unstructured_accuracy_async(
     data: pd.DataFrame,
     *,
     api_key: str,
     model: str = "o4-mini",
     use_chatgpt: bool = True,
+    cache: Optional[ResponseCache] = None,
+    max_concurrency: int = prompt.MAX_CONCURRENCY,
+    batch_state: Optional[str | Path] = None,
+    batch_poll_interval: float = prompt.BATCH_POLL_INTERVAL,
+    journal_dir: Optional[str | Path] = None,
+    local_preprocessor: Optional[LocalPreprocessor] = None,
+    dedup: Optional[Deduplicator] = None,
+    pack_reports: int = 1,
+    cascade: Optional[Cascade] = None,
+    scheduler: Optional[TokenScheduler] = None,
+    hedger: Optional[Hedger] = None,
+    effort_policy: Optional[EffortPolicy] = None,
+    endpoints: Optional[EndpointPool] = None,
+    retry_policies: Optional[Dict[str, RetryPolicy]] = None,
+    failed_csv: Optional[str | Path] = None,
+    reporter: Optional[events.Reporter] = None,
+    telemetry: Optional[Telemetry] = None,
 ) -> Tuple[pd.DataFrame, pd.DataFrame]:
-    if prompt.COL_REPORT not in data.columns:
-        raise ValueError("Input DataFrame must contain a 'report' column.")
-
-    df = data.copy()
-    df[[
-        prompt.COL_PREPROCESSED,
-        prompt.COL_ACC1_JSON, prompt.COL_ACC1_SCORE,
-        prompt.COL_ACC2_JSON, prompt.COL_ACC2_SCORE
-    ]] = None
-
-    client = llm_call._make_client(api_key, use_chatgpt)
-
-    # 0) Preprocess
-    preprocess_failures = _preprocess_reports(df, client, model="gpt-4.1-nano")
-    if preprocess_failures:
-        st.error(f"🚨 Preprocessing failed for {len(preprocess_failures)} reports; they will be skipped.")
-        df = df.drop(preprocess_failures)  # remove them from further analysis
-
-    # 1) Error detection
-    _evaluate_first_pass(df, client, model)
-    df[prompt.COL_ACC2_JSON]  = df[prompt.COL_ACC1_JSON]
-    df[prompt.COL_ACC2_SCORE] = df[prompt.COL_ACC1_SCORE]
-    
-    # 2) False‑positive check
-    _evaluate_fp_pass(df, client, model)
+    """Run the three passes over `data`.
 
-    summary = pd.DataFrame({
-        "Metric": ["mean", "std"],
-        "accuracy_1": [df[prompt.COL_ACC1_SCORE].mean(), df[prompt.COL_ACC1_SCORE].std()],
-        "accuracy_2": [df[prompt.COL_ACC2_SCORE].mean(), df[prompt.COL_ACC2_SCORE].std()],
-    })
-    return df.copy(), summary
+    With `batch_state` (a JSON path) the passes go through the OpenAI Batch API instead of
+    interactive requests and can be resumed from that file after a restart; the batches are
+    polled every `batch_poll_interval` seconds.
+    With `journal_dir`, interactive results are journaled to
+    `<journal_dir>/<corpus fingerprint>.jsonl` as they land, and re-running the same corpus,
+    models, prompts, cascade, effort policy and packing resumes from it, dispatching only
+    the missing work.
+    With `local_preprocessor` (e.g. `RuleBasedPreprocessor()`), pass 1 is done locally for
+    every report it can parse and only the rest go to the LLM.
+    With `dedup` (a `Deduplicator`), reports that are identical after preprocessing share
+    one error check and FP check, whose verdict is copied to every duplicate.
+    With `pack_reports` > 1 (interactive mode only), short reports are sent up to that many
+    per error-check/FP-check request, within a token budget; reports missing from a packed
+    answer are retried one by one.
+    With `cascade` (a `Cascade`, interactive mode only), every report is first screened by
+    a cheap model / low reasoning effort and only flagged or uncertain reports get the full
+    error check; its summary reports the escalation rate and the audit-sample agreement.
+    With `scheduler` (a `TokenScheduler`, interactive mode only), the longest reports are
+    dispatched first and each model's calls are kept within a tokens-per-minute budget;
+    its summary compares predicted with actual prompt tokens.
+    With `hedger` (a `Hedger`, interactive mode only), a call slower than its pass's usual
+    latency gets a duplicate request and the first valid answer wins; the summary and the
+    telemetry show the hedges and the tail latency they removed.
+    With `effort_policy` (an `EffortPolicy`, interactive mode only), each error check and FP
+    check runs at the reasoning effort (and model) of the report's complexity tier instead
+    of high effort; its summary shows how many checks each tier got.
+    With `endpoints` (an `EndpointPool`, interactive mode only), the calls are spread over
+    its OpenAI accounts and Azure deployments instead of one client for `api_key`; its
+    summary shows each endpoint's share of the calls, errors and ejections.
+    Failed calls are retried with jittered backoff per error class (`retry.DEFAULT_POLICIES`,
+    overridden by `retry_policies`); calls that still fail are listed, with their pass and
+    error class, in `failed_csv` if given.
+    Messages and progress go to `reporter` (default: the `llm_tools` logger). Every LLM call
+    is recorded in `telemetry` (a fresh `Telemetry` if omitted) and the per-pass latency,
+    token and cost figures are appended to the returned summary.
+    """
+    telemetry = telemetry if telemetry is not None else Telemetry()
+    with events.use_reporter(reporter), use_telemetry(telemetry):
+        if prompt.COL_REPORT not in data.columns:
+            raise ValueError("Input DataFrame must contain a 'report' column.")
+
+        df = data.drop(columns=_RESULT_COLS, errors="ignore")
+        for helper in (local_preprocessor, dedup, cascade, scheduler, hedger, effort_policy, endpoints):
+            if helper is not None:
+                helper.reset()
+
+        retries = RetryScheduler(retry_policies)
+        if batch_state is not None:
+            # Offline: one Batch API job per pass
+            if cascade is not None:
+                events.warning("The cascade is not used in Batch API mode; every report gets the full error check.")
+                cascade = None
+            if scheduler is not None:
+                events.warning("The token scheduler is not used in Batch API mode.")
+                scheduler = None
+            if hedger is not None:
+                events.warning("Requests are not hedged in Batch API mode.")
+                hedger = None
+            if effort_policy is not None:
+                events.warning("The effort policy is not used in Batch API mode; every check runs at high effort.")
+                effort_policy = None
+            if endpoints is not None:
+                events.warning("Batch API jobs are not spread over the endpoint pool; they go to the `api_key` account.")
+                endpoints = None
+            if pack_reports > 1:
+                events.warning("Reports are not packed in Batch API mode; each is its own batch request.")
+            if journal_dir is not None:
+                events.warning("journal_dir is not used in Batch API mode; the batch state file resumes the run.")
+            client = llm_call._make_client(api_key, use_chatgpt)
+            try:
+                store = await asyncio.to_thread(  # polls for hours; keep the event loop free
+                    batch._run_batch,
+                    df, client, model, preprocess_model=prompt.PREPROCESS_MODEL, state_path=batch_state,
+                    poll_interval=batch_poll_interval, local_preprocessor=local_preprocessor, dedup=dedup, cache=cache,
+                    failures=retries.failures,
+                )
+            finally:
+                _report_failures(retries, failed_csv)
+        else:
+            journal = None
+            if journal_dir is not None:
+                settings = _run_settings(cascade=cascade, effort_policy=effort_policy, pack_reports=pack_reports)
+                fingerprint = _corpus_fingerprint(df, model, prompt.PREPROCESS_MODEL, settings)
+                journal = RunJournal(Path(journal_dir) / f"{fingerprint[:16]}.jsonl", fingerprint)
+            # Preprocess → error detection → false-positive check, streamed per report
+            try:
+                async with _async_client(api_key, use_chatgpt, endpoints) as client:
+                    store = await _run_passes(
+                        df, client, model, preprocess_model=prompt.PREPROCESS_MODEL, cache=cache,
+                        max_concurrency=max_concurrency, journal=journal,
+                        local_preprocessor=local_preprocessor, dedup=dedup, pack_reports=pack_reports,
+                        retries=retries, cascade=cascade, scheduler=scheduler, hedger=hedger,
+                        effort_policy=effort_policy,
+                    )
+            finally:
+                if journal is not None:
+                    journal.close()
+                _report_failures(retries, failed_csv)
+        for helper in (local_preprocessor, dedup, cascade, scheduler, hedger, effort_policy, endpoints):
+            if helper is not None:
+                events.info(helper.summary())
+        preprocess_failures = store.failed()
+        if preprocess_failures:
+            events.error(f"🚨 Preprocessing failed for {len(preprocess_failures)} reports; they will be skipped.")
+        df = store.join(df)  # without the failed rows
+
+        summary = _summary(
+            (df[prompt.COL_ACC1_SCORE].mean(), df[prompt.COL_ACC1_SCORE].std()),
+            (df[prompt.COL_ACC2_SCORE].mean(), df[prompt.COL_ACC2_SCORE].std()),
+            telemetry,
+        )
+        return df, summary
+
+def get_unstructured_accuracy(data: pd.DataFrame, **kw) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Blocking wrapper around `get_unstructured_accuracy_async`; takes the same keyword arguments."""
+    return asyncio.run(get_unstructured_accuracy_async(data, **kw))
+
+# ──────────────────────────
+# Prompt/model experiments
+# ──────────────────────────
+async def run_experiment_async(
+    data: pd.DataFrame,
+    variants: Sequence[Variant],
+    *,
+    api_key: str,
+    model: str = "o4-mini",
+    use_chatgpt: bool = True,
+    cache: Optional[ResponseCache] = None,
+    max_concurrency: int = prompt.MAX_CONCURRENCY,
+    local_preprocessor: Optional[LocalPreprocessor] = None,
+    dedup: Optional[Deduplicator] = None,
+    pack_reports: int = 1,
+    scheduler: Optional[TokenScheduler] = None,
+    hedger: Optional[Hedger] = None,
+    effort_policy: Optional[EffortPolicy] = None,
+    endpoints: Optional[EndpointPool] = None,
+    retry_policies: Optional[Dict[str, RetryPolicy]] = None,
+    failed_csv: Optional[str | Path] = None,
+    reporter: Optional[events.Reporter] = None,
+    telemetry: Optional[Telemetry] = None,
+) -> Tuple[Dict[str, pd.DataFrame], pd.DataFrame]:
+    """Compare `variants` (`Variant`s of the pass-2/3 model, prompts and reasoning effort) on `data`.
+
+    Pass 1 runs once per report; its output is fanned out to every variant's error check
+    and FP check, which run concurrently. Variants without a model use `model`. Returns
+    {variant name: results with the columns of `get_unstructured_accuracy`} and the
+    comparison table of `experiment.compare`: flag rate, FP-verifier overturn rate,
+    agreement, latency, tokens and cost per variant, plus the shared pass-1 cost.
+    `telemetry` records the pass-1 calls; each variant's calls go to `variant.telemetry`.
+    The other arguments are as for `get_unstructured_accuracy`.
+    """
+    names = [v.name for v in variants]
+    if not names or len(set(names)) != len(names):
+        raise ValueError("Experiment variants need unique names.")
+    telemetry = telemetry if telemetry is not None else Telemetry()
+    with events.use_reporter(reporter), use_telemetry(telemetry):
+        if prompt.COL_REPORT not in data.columns:
+            raise ValueError("Input DataFrame must contain a 'report' column.")
+        df = data.drop(columns=_RESULT_COLS, errors="ignore")
+        for v in variants:
+            v.model = v.model or model
+        for helper in (local_preprocessor, dedup, scheduler, hedger, effort_policy, endpoints, *variants):
+            if helper is not None:
+                helper.reset()
+        stores = {name: ResultStore(df.index) for name in names}
+        reports = df[prompt.COL_REPORT]
+        if scheduler is not None:
+            reports = reports.loc[scheduler.order(reports)]
+
+        async def _items() -> AsyncIterator[ReportItem]:
+            for idx, raw_report in reports.items():
+                yield idx, raw_report, {}
+
+        def _on_result(idx: Hashable, row: Optional[Dict[str, Any]]):
+            if row is not None:
+                for name, store in stores.items():
+                    store.set_row(idx, {prompt.COL_PREPROCESSED: row[prompt.COL_PREPROCESSED], **row[name]})
+
+        retries = RetryScheduler(retry_policies)
+        try:
+            async with _async_client(api_key, use_chatgpt, endpoints) as client:
+                with use_scheduler(scheduler), use_hedger(hedger):
+                    await _process_reports(
+                        _items(), client, model, prompt.PREPROCESS_MODEL, _on_result,
+                        cache=cache, max_concurrency=max_concurrency, total=len(df),
+                        local_preprocessor=local_preprocessor, dedup=dedup, pack_reports=pack_reports,
+                        retries=retries, variants=variants, effort_policy=effort_policy,
+                    )
+        finally:
+            _report_failures(retries, failed_csv)
+        for helper in (local_preprocessor, dedup, scheduler, hedger, effort_policy, endpoints):
+            if helper is not None:
+                events.info(helper.summary())
+        preprocess_failures = stores[names[0]].failed()
+        if preprocess_failures:
+            events.error(f"🚨 Preprocessing failed for {len(preprocess_failures)} reports; they will be skipped.")
+        results = {name: store.join(df) for name, store in stores.items()}
+        return results, compare(variants, results, telemetry)
+
+def run_experiment(data: pd.DataFrame, variants: Sequence[Variant], **kw) -> Tuple[Dict[str, pd.DataFrame], pd.DataFrame]:
+    """Blocking wrapper around `run_experiment_async`; takes the same keyword arguments."""
+    return asyncio.run(run_experiment_async(data, variants, **kw))
+
+# ──────────────────────────
+# Larger-than-memory corpora
+# ──────────────────────────
+def _check_manifest(out_dir: Path, input_path: Path, model: str, chunksize: int, settings: Dict[str, Any]) -> None:
+    """Refuse to resume into `out_dir` if it holds partitions from a different run."""
+    manifest = {
+        "input": str(input_path.resolve()),
+        "size": input_path.stat().st_size,
+        "chunksize": chunksize,
+        "settings": _settings_fingerprint(model, prompt.PREPROCESS_MODEL, settings),
+    }
+    path = out_dir / "_manifest.json"
+    if path.exists():
+        if json.loads(path.read_text(encoding="utf-8")) != manifest:
+            raise ValueError(f"{out_dir} holds results of a different input or settings; use a new output directory.")
+    else:
+        path.write_text(json.dumps(manifest, indent=2), encoding="utf-8")
+
+async def stream_unstructured_accuracy_async(
+    input_path: str | Path,
+    out_dir: str | Path,
+    *,
+    api_key: str,
+    model: str = "o4-mini",
+    use_chatgpt: bool = True,
+    cache: Optional[ResponseCache] = None,
+    max_concurrency: int = prompt.MAX_CONCURRENCY,
+    chunksize: int = prompt.STREAM_CHUNKSIZE,
+    out_format: str = "csv",
+    local_preprocessor: Optional[LocalPreprocessor] = None,
+    dedup: Optional[Deduplicator] = None,
+    pack_reports: int = 1,
+    cascade: Optional[Cascade] = None,
+    scheduler: Optional[TokenScheduler] = None,
+    hedger: Optional[Hedger] = None,
+    effort_policy: Optional[EffortPolicy] = None,
+    endpoints: Optional[EndpointPool] = None,
+    retry_policies: Optional[Dict[str, RetryPolicy]] = None,
+    failed_csv: Optional[str | Path] = None,
+    reporter: Optional[events.Reporter] = None,
+    telemetry: Optional[Telemetry] = None,
+) -> pd.DataFrame:
+    """Run the three passes over a CSV/JSONL/Parquet file without loading it whole.
+
+    The file is read `chunksize` rows at a time and its reports are fed to the pass workers
+    through a bounded queue. Each chunk is written to `out_dir/part-NNNNN.<out_format>`
+    as soon as all of its rows are done, so peak memory depends on the chunk size and the
+    concurrency, not on the corpus. In-flight chunks are journaled under `out_dir/journal`.
+    Re-running into the same `out_dir` skips finished parts and replays partial ones.
+    Returns the summary table of `get_unstructured_accuracy`. `cascade`, `scheduler`,
+    `hedger`, `effort_policy`, `endpoints`, `retry_policies` and `failed_csv` are as there;
+    the scheduler orders reports within each chunk.
+    Messages and progress go to `reporter` (default: the `llm_tools` logger). Every LLM call
+    is recorded in `telemetry` (a fresh `Telemetry` if omitted) and the per-pass latency,
+    token and cost figures are appended to the returned summary.
+    """
+    telemetry = telemetry if telemetry is not None else Telemetry()
+    with events.use_reporter(reporter), use_telemetry(telemetry):
+        input_path = Path(input_path)
+        writer = stream_io.PartitionedWriter(out_dir, out_format)
+        settings = _run_settings(cascade=cascade, effort_policy=effort_policy, pack_reports=pack_reports)
+        _check_manifest(writer.out_dir, input_path, model, chunksize, settings)
+        journal_dir = writer.out_dir / "journal"
+        stats = stream_io._RunningStats(prompt.COL_ACC1_SCORE, prompt.COL_ACC2_SCORE)
+        queue: asyncio.Queue = asyncio.Queue(maxsize=2 * max_concurrency)
+        open_parts: Dict[int, Dict[str, Any]] = {}
+        owner: Dict[Hashable, int] = {}
+        n_failed = 0
+        for helper in (local_preprocessor, dedup, cascade, scheduler, hedger, effort_policy, endpoints):
+            if helper is not None:
+                helper.reset()
+
+        def _finish(part: int):
+            nonlocal n_failed
+            state = open_parts.pop(part)
+            out = state["store"].join(state["df"].drop(columns=_RESULT_COLS, errors="ignore"))
+            writer.write(part, out)
+            stats.update(out)
+            n_failed += len(state["df"]) - len(out)
+            state["journal"].close()
+            state["journal"].path.unlink()
+
+        async def _read():
+            part = 0
+            try:
+                async for chunk in stream_io._aiter_chunks(input_path, chunksize):
+                    if prompt.COL_REPORT not in chunk.columns:
+                        raise ValueError("Input file must contain a 'report' column.")
+                    if writer.exists(part):
+                        stats.update(writer.read_scores(part))
+                        part += 1
+                        continue
+                    fingerprint = _corpus_fingerprint(chunk, model, prompt.PREPROCESS_MODEL, settings)
+                    journal = RunJournal(journal_dir / f"part-{part:05d}.jsonl", fingerprint)
+                    replayed = journal.replay()
+                    open_parts[part] = {"df": chunk, "remaining": len(chunk), "store": ResultStore(chunk.index), "journal": journal}
+                    reports = chunk[prompt.COL_REPORT]
+                    if scheduler is not None:
+                        reports = reports.loc[scheduler.order(reports)]
+                    for idx, raw_report in reports.items():
+                        owner[idx] = part
+                        await queue.put((idx, raw_report, {p: done[idx] for p, done in replayed.items() if idx in done}))
+                    part += 1
+            finally:
+                await queue.put(None)
+
+        async def _items() -> AsyncIterator[ReportItem]:
+            while (item := await queue.get()) is not None:
+                yield item
+
+        def _record(idx: Hashable, pass_name: str, content: str):
+            open_parts[owner[idx]]["journal"].record(idx, pass_name, content)
+
+        def _on_result(idx: Hashable, row: Optional[Dict[str, Any]]):
+            part = owner.pop(idx)
+            state = open_parts[part]
+            if row is not None:
+                state["store"].set_row(idx, row)
+            state["remaining"] -= 1
+            if state["remaining"] == 0:
+                _finish(part)
+
+        retries = RetryScheduler(retry_policies)
+        try:
+            async with _async_client(api_key, use_chatgpt, endpoints) as client:
+                reader = asyncio.create_task(_read())
+                with use_scheduler(scheduler), use_hedger(hedger):
+                    await _process_reports(
+                        _items(), client, model, prompt.PREPROCESS_MODEL, _on_result,
+                        cache=cache, max_concurrency=max_concurrency, record=_record,
+                        local_preprocessor=local_preprocessor, dedup=dedup, pack_reports=pack_reports,
+                        retries=retries, cascade=cascade, effort_policy=effort_policy,
+                    )
+                await reader
+        finally:
+            for state in open_parts.values():
+                state["journal"].close()
+            _report_failures(retries, failed_csv)
+
+        if n_failed:
+            events.error(f"🚨 Preprocessing failed for {n_failed} reports; they were skipped.")
+        for helper in (local_preprocessor, dedup, cascade, scheduler, hedger, effort_policy, endpoints):
+            if helper is not None:
+                events.info(helper.summary())
+        return _summary(stats.mean_std(prompt.COL_ACC1_SCORE), stats.mean_std(prompt.COL_ACC2_SCORE), telemetry)
+
+def stream_unstructured_accuracy(input_path: str | Path, out_dir: str | Path, **kw) -> pd.DataFrame:
+    """Blocking wrapper around `stream_unstructured_accuracy_async`; takes the same keyword arguments."""
+    return asyncio.run(stream_unstructured_accuracy_async(input_path, out_dir, **kw))
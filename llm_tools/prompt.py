@@ -1,5 +1,5 @@
 from __future__ import annotations
-from typing import Dict, Any
+from typing import Dict, Any, Tuple
 
 # ──────────────────────────
 # Column names
@@ -12,6 +12,14 @@ COL_ACC1_SCORE = "accuracy_1_score"
 COL_ACC2_JSON  = "accuracy_2"
 COL_ACC2_SCORE = "accuracy_2_score"
 
+# ──────────────────────────
+# Pass names
+# ──────────────────────────
+PASS_PREPROCESS  = "preprocess"
+PASS_ERROR_CHECK = "error_check"
+PASS_FP_CHECK    = "fp_check"
+PASS_SCREEN      = "screen"      # cheap cascade screen ahead of the error check
+
 # ──────────────────────────
 # JSON Schemas
 # ──────────────────────────
@@ -29,6 +37,32 @@ ERROR_SCHEMA: Dict[str, Any] = {
     },
 }
 
+# Several reports per request (packing mode): one ERROR_SCHEMA object per report id
+PACKED_ERROR_SCHEMA: Dict[str, Any] = {
+    "name": "packed_error_report",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "results": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "id": {"type": "string"},
+                        "error": {"type": "string"},
+                        "error_reason": {"type": "string"},
+                    },
+                    "required": ["id", "error", "error_reason"],
+                    "additionalProperties": False,
+                },
+            },
+        },
+        "required": ["results"],
+        "additionalProperties": False,
+    },
+}
+
 PREPROCESSING_SCHEMA: Dict[str, Any] = {
     "name": "preprocessing",
     "strict": True,
@@ -97,14 +131,87 @@ Guidelines to confirm an error:
 If determined to be a FALSE POSITIVE, return JSON with:
 "error": "no error", "error_reason": "N/A".
 """.strip()
+
+# Appended to the error-check/FP-check prompt in packing mode. It is static, so every
+# packed request shares the same developer-message prefix; all per-report content goes
+# last, in the user message.
+PACKED_INSTRUCTIONS = """
+**Multiple reports**
+The user message contains several independent inputs, each wrapped as <report id="..."> ... </report>.
+Apply the tasks above to each input separately; never let one input influence another.
+Return one entry in "results" per input, with its "id" copied exactly and "error"/"error_reason" as described above.
+""".strip()
 # ──────────────────────────
 # Other constants
 # ──────────────────────────
-MAX_WORKERS       = 8
+PREPROCESS_MODEL  = "gpt-4.1-nano"
+SCREEN_MODEL      = "o4-mini"       # cascade screen model
+SCREEN_EFFORT     = "low"           # cascade screen reasoning effort
+
+MAX_WORKERS       = 8          # initial in-flight requests per endpoint/model
+MIN_CONCURRENCY   = 1          # adaptive in-flight request floor per endpoint/model
+MAX_CONCURRENCY   = 256        # adaptive in-flight request ceiling per endpoint/model
+MAX_CONNECTIONS   = 256        # keep-alive HTTP pool size
 REQUEST_TIMEOUT   = 100        # seconds
 BATCH_TIMEOUT     = 600        # seconds
+BATCH_POLL_INTERVAL     = 60   # seconds between Batch API status polls
+BATCH_COMPLETION_WINDOW = "24h"
+BATCH_MAX_RESUBMITS = 2       # follow-up batches per pass for requests without a valid response
+STREAM_CHUNKSIZE  = 10_000     # rows per input chunk / output partition
+JOB_CHUNKSIZE     = 1_000      # rows per partition of a background job; finished ones can be labelled early
+JOBS_DIR          = "results/jobs"
+JOB_POLL_INTERVAL = 5          # seconds between checks of a queued job / UI status refreshes
+SHARD_SIZE        = 50_000     # rows per work-queue shard (distributed mode)
+LEASE_TTL         = 300        # seconds a worker's shard lease lasts without a heartbeat
+SHARD_MAX_ATTEMPTS = 3         # leases per shard before it is marked failed
 RETRY_LIMIT_FIRST = 3
 RETRY_LIMIT_SECOND = 2
 RETRY_SLEEP       = 1         # seconds
+RETRY_MAX_SLEEP   = 60        # seconds, cap of the jittered exponential backoff
+RETRY_LIMIT_RATE  = 6         # retries after a 429
+BREAKER_WINDOW    = 50        # recent calls per endpoint/model watched by the circuit breaker
+BREAKER_MIN_CALLS = 20
+BREAKER_THRESHOLD = 0.5       # failure share that opens the breaker
+BREAKER_COOLDOWN  = 30        # seconds; doubles while probes keep failing
+ENDPOINT_EJECT_AFTER = 3      # consecutive 429/5xx/timeouts that take a pool endpoint out of rotation
+ENDPOINT_COOLDOWN = 30        # seconds out of rotation; doubles if it fails again right after
+
+HEDGE_QUANTILE    = 0.95       # a call slower than this latency quantile gets a duplicate request
+HEDGE_MAX_RATE    = 0.05       # at most this share of each pass's calls is hedged
+HEDGE_MIN_SAMPLES = 30         # latencies per pass/model needed before hedging starts
+HEDGE_MIN_DELAY   = 1.0        # seconds; never hedge sooner than this
+# Adaptive reasoning effort (effort.EffortPolicy): a report's complexity score is the weighted
+# sum of its local features; it gets the last tier whose minimum score it reaches.
+EFFORT_WEIGHTS: Dict[str, float] = {
+    "tokens":           1 / 200,   # per token of findings + impression
+    "measurements":     0.5,       # per size/volume measurement
+    "laterality":       0.5,       # per left/right/bilateral mention (at most 6 counted)
+    "addendum":         2.0,       # addendum or correction present
+    "impression_ratio": 1.0,       # impression length / findings length (at most 2)
+}
+EFFORT_TIERS: Tuple[Tuple[str, float], ...] = (("low", 0.0), ("medium", 3.0), ("high", 6.0))  # (effort, min score)
+TPM_WINDOW        = 60         # seconds of the rolling tokens-per-minute budget
+TPM_COMPLETION_ESTIMATE = 1_000  # output tokens reserved per request until the real mean is known
+
+PACK_MAX_REPORTS  = 8          # reports per packed error-check/FP request
+PACK_TOKEN_BUDGET = 6_000      # estimated input tokens of reports per packed request
+PACK_LINGER       = 0.05       # seconds to wait for a packed request to fill up
 
 FAILED_CSV        = "failed_requests.csv"
+
+# Estimated USD per 1M tokens: (input, cached input, output incl. reasoning). Used only for
+# cost estimates in telemetry; update when pricing changes. Batch API calls cost half.
+MODEL_PRICES: Dict[str, Tuple[float, float, float]] = {
+    "o3":           (2.00, 0.50, 8.00),
+    "o4-mini":      (1.10, 0.275, 4.40),
+    "gpt-4.1":      (2.00, 0.50, 8.00),
+    "gpt-4.1-mini": (0.40, 0.10, 1.60),
+    "gpt-4.1-nano": (0.10, 0.025, 0.40),
+    "gpt-4o":       (2.50, 1.25, 10.00),
+    "gpt-4o-mini":  (0.15, 0.075, 0.60),
+}
+BATCH_PRICE_FACTOR = 0.5
+
+CACHE_PATH        = "results/llm_cache.sqlite"
+CACHE_MAX_ENTRIES = 1_000_000
+CACHE_MAX_AGE     = 90 * 24 * 3600   # seconds
@@ -0,0 +1,226 @@
+from __future__ import annotations
+import asyncio, time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, Deque, Dict, Mapping, Optional, Tuple
+
+from llm_tools import prompt
+
+def _header(headers: Optional[Mapping[str, str]], name: str) -> Optional[float]:
+    if not headers:
+        return None
+    try:
+        return float(headers.get(name))
+    except (TypeError, ValueError):
+        return None
+
+def _retry_after(headers: Optional[Mapping[str, str]]) -> Optional[float]:
+    """Seconds the server asked us to wait (`retry-after-ms` / `retry-after`), if any."""
+    ms = _header(headers, "retry-after-ms")
+    if ms is not None:
+        return ms / 1000
+    return _header(headers, "retry-after")
+
+def _retry_after_from_exc(exc: BaseException) -> Optional[float]:
+    response = getattr(exc, "response", None)
+    return _retry_after(getattr(response, "headers", None))
+
+def _is_rate_limited(exc: BaseException) -> bool:
+    return getattr(exc, "status_code", None) == 429
+
+def _error_class(exc: BaseException) -> str:
+    """Retry class of a failed call: rate_limited, timeout, server, invalid, client or other."""
+    status = getattr(exc, "status_code", None)
+    if status == 429:
+        return "rate_limited"
+    if isinstance(exc, asyncio.TimeoutError) or "Timeout" in type(exc).__name__:
+        return "timeout"
+    if (status is not None and status >= 500) or "Connection" in type(exc).__name__:
+        return "server"
+    if isinstance(exc, ValueError):  # response failed JSON/schema validation
+        return "invalid"
+    if status is not None and status not in (408, 409):
+        return "client"
+    return "other"
+
+class CircuitBreaker:
+    """Opens when most recent calls to an endpoint fail at the transport level.
+
+    Outcomes of the last `window` calls are kept (429s are left to the AIMD limit and
+    invalid responses are not the endpoint's fault). Once `min_calls` are known and the
+    failure share reaches `threshold`, `record` returns a cooldown to pause dispatch for.
+    After the pause the breaker is half-open: the first outcome closes it on success or
+    re-opens it with a doubled cooldown (up to `max_cooldown`).
+    """
+
+    def __init__(
+        self,
+        *,
+        window: int = prompt.BREAKER_WINDOW,
+        min_calls: int = prompt.BREAKER_MIN_CALLS,
+        threshold: float = prompt.BREAKER_THRESHOLD,
+        cooldown: float = prompt.BREAKER_COOLDOWN,
+        max_cooldown: float = 16 * prompt.BREAKER_COOLDOWN,
+    ):
+        self.window = window
+        self.min_calls = min_calls
+        self.threshold = threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.reopen_at = 0.0
+        self.trips = 0
+        self._outcomes: Deque[bool] = deque(maxlen=window)
+
+    def record(self, ok: bool) -> Optional[float]:
+        now = time.monotonic()
+        if self.state == "open" and now >= self.reopen_at:
+            self.state = "half_open"
+        if self.state == "half_open":
+            if ok:
+                self.state, self.cooldown = "closed", self.base_cooldown
+                self._outcomes.clear()
+                return None
+            self.cooldown = min(self.max_cooldown, self.cooldown * 2)
+            return self._open(now)
+        self._outcomes.append(ok)
+        if self.state == "closed" and len(self._outcomes) >= self.min_calls:
+            if self._outcomes.count(False) / len(self._outcomes) >= self.threshold:
+                return self._open(now)
+        return None
+
+    def _open(self, now: float) -> float:
+        self.state = "open"
+        self.reopen_at = now + self.cooldown
+        self.trips += 1
+        self._outcomes.clear()
+        return self.cooldown
+
+class ConcurrencyController:
+    """AIMD limit on in-flight requests for a single endpoint/model.
+
+    The limit grows by ~1 per round-trip of successful calls and is multiplied by `backoff`
+    on a 429 (at most once per cooldown, so a burst of 429s counts as one congestion event).
+    Growth is held while latency is inflated over its observed floor or the
+    `x-ratelimit-remaining-*` headers show little headroom, and `retry-after` pauses all
+    new dispatches until it has elapsed. A `CircuitBreaker` watches transport failures;
+    when it opens, dispatch pauses for its cooldown and resumes at `min_limit`.
+    """
+
+    def __init__(
+        self,
+        *,
+        initial: int = prompt.MAX_WORKERS,
+        min_limit: int = prompt.MIN_CONCURRENCY,
+        max_limit: int = prompt.MAX_CONCURRENCY,
+        backoff: float = 0.5,
+        latency_tolerance: float = 2.0,
+        headroom: float = 0.05,
+    ):
+        self.limit = float(max(min_limit, min(initial, max_limit)))
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.headroom = headroom
+        self.inflight = 0
+        self.paused_until = 0.0
+        self.successes = 0
+        self.throttled = 0
+        self._latency_ewma: Optional[float] = None
+        self._latency_floor: Optional[float] = None
+        self._last_decrease = 0.0
+        self._cond: Optional[asyncio.Condition] = None
+        self._loop = None
+        self.breaker = CircuitBreaker()
+
+    # asyncio primitives are bound to one event loop; the learned limit survives across runs
+    def _condition(self) -> asyncio.Condition:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop, self._cond, self.inflight = loop, asyncio.Condition(), 0
+        return self._cond
+
+    @asynccontextmanager
+    async def slot(self):
+        cond = self._condition()
+        async with cond:
+            while True:
+                pause = self.paused_until - time.monotonic()
+                if pause > 0:
+                    try:
+                        await asyncio.wait_for(cond.wait(), pause)
+                    except asyncio.TimeoutError:
+                        pass
+                elif self.inflight < int(self.limit):
+                    break
+                else:
+                    await cond.wait()
+            self.inflight += 1
+        try:
+            yield
+        finally:
+            async with cond:
+                self.inflight -= 1
+                cond.notify(max(1, int(self.limit) - self.inflight))
+
+    def _low_headroom(self, headers: Optional[Mapping[str, str]]) -> bool:
+        remaining_req = _header(headers, "x-ratelimit-remaining-requests")
+        if remaining_req is not None and remaining_req <= self.inflight:
+            return True
+        remaining_tok = _header(headers, "x-ratelimit-remaining-tokens")
+        limit_tok = _header(headers, "x-ratelimit-limit-tokens")
+        return bool(remaining_tok is not None and limit_tok and remaining_tok / limit_tok < self.headroom)
+
+    def on_success(self, latency: float, headers: Optional[Mapping[str, str]] = None) -> None:
+        self.successes += 1
+        self.breaker.record(True)
+        self._latency_ewma = latency if self._latency_ewma is None else 0.8 * self._latency_ewma + 0.2 * latency
+        self._latency_floor = self._latency_ewma if self._latency_floor is None else min(self._latency_floor, self._latency_ewma)
+        if self._low_headroom(headers):
+            return
+        if self._latency_ewma > self.latency_tolerance * self._latency_floor:
+            return
+        self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def on_throttle(self, retry_after: Optional[float] = None) -> None:
+        self.throttled += 1
+        now = time.monotonic()
+        if retry_after:
+            self.paused_until = max(self.paused_until, now + retry_after)
+        if now - self._last_decrease >= max(1.0, self._latency_ewma or 0.0):
+            self.limit = max(self.min_limit, self.limit * self.backoff)
+            self._last_decrease = now
+
+    def on_error(self, exc: BaseException) -> None:
+        """A call failed without a 429; feeds the circuit breaker."""
+        if _error_class(exc) not in ("timeout", "server"):
+            return
+        pause = self.breaker.record(False)
+        if pause:
+            self.paused_until = max(self.paused_until, time.monotonic() + pause)
+            self.limit = float(self.min_limit)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "limit": int(self.limit),
+            "inflight": self.inflight,
+            "successes": self.successes,
+            "throttled": self.throttled,
+            "latency_ewma": self._latency_ewma,
+            "breaker": self.breaker.state,
+            "breaker_trips": self.breaker.trips,
+        }
+
+_CONTROLLERS: Dict[Tuple[str, str], ConcurrencyController] = {}
+
+def controller_for(client, model: str, *, max_limit: int = prompt.MAX_CONCURRENCY) -> ConcurrencyController:
+    """Process-wide controller for (endpoint, model), so learned limits persist between runs."""
+    key = (str(getattr(client, "base_url", "")), model)
+    ctl = _CONTROLLERS.get(key)
+    if ctl is None:
+        ctl = _CONTROLLERS[key] = ConcurrencyController(max_limit=max_limit)
+    ctl.max_limit = max_limit
+    ctl.limit = min(ctl.limit, max_limit)
+    return ctl
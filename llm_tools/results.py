@@ -0,0 +1,94 @@
+from __future__ import annotations
+from typing import Any, Dict, Hashable, List, Optional, Sequence
+import numpy as np
+import pandas as pd
+from llm_tools import prompt
+
+# bits of ResultStore._passes
+_PRE, _ERR, _FP = 1, 2, 4
+_MISSING = -1  # score sentinel; materialized as <NA>
+
+class ResultStore:
+    """Typed, preallocated pass outputs for a fixed set of rows.
+
+    Scores live in `int8` arrays (parsed once, when the response lands), the passes a row
+    has completed in a bit mask, and response texts in object arrays whose strings are
+    interned, so the many identical answers (e.g. every "No errors" verdict) share one
+    object. Rows are addressed by index label and filled from the event loop as results
+    arrive; `to_frame`/`join` build the DataFrame once at the end.
+    """
+
+    def __init__(self, index: Sequence[Hashable]):
+        self.index = pd.Index(index)
+        n = len(self.index)
+        self._pos: Dict[Hashable, int] = {idx: i for i, idx in enumerate(self.index)}
+        self._passes = np.zeros(n, dtype=np.uint8)
+        self._score1 = np.full(n, _MISSING, dtype=np.int8)
+        self._score2 = np.full(n, _MISSING, dtype=np.int8)
+        self._pre = np.full(n, None, dtype=object)
+        self._json1 = np.full(n, None, dtype=object)
+        self._json2 = np.full(n, None, dtype=object)
+        self._strings: Dict[str, str] = {}
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def _intern(self, text: Optional[str]) -> Optional[str]:
+        return None if text is None else self._strings.setdefault(text, text)
+
+    @staticmethod
+    def _score(score: Optional[int]) -> int:
+        return _MISSING if score is None else score
+
+    def set_preprocessed(self, idx: Hashable, content: str) -> None:
+        i = self._pos[idx]
+        self._pre[i] = content  # unique per report; not worth interning
+        self._passes[i] |= _PRE
+
+    def set_error_check(self, idx: Hashable, content: str, score: Optional[int]) -> None:
+        """Pass-2 answer; it also stands as the final verdict until an FP check overrides it."""
+        i = self._pos[idx]
+        self._json1[i] = self._json2[i] = self._intern(content)
+        self._score1[i] = self._score2[i] = self._score(score)
+        self._passes[i] |= _ERR
+
+    def set_fp_check(self, idx: Hashable, content: str, score: Optional[int]) -> None:
+        i = self._pos[idx]
+        self._json2[i] = self._intern(content)
+        self._score2[i] = self._score(score)
+        self._passes[i] |= _FP
+
+    def set_row(self, idx: Hashable, row: Dict[str, Any]) -> None:
+        """Store a finished report's `pipeline._RESULT_COLS` values."""
+        self.set_preprocessed(idx, row[prompt.COL_PREPROCESSED])
+        if row.get(prompt.COL_ACC1_JSON) is None:
+            return
+        self.set_error_check(idx, row[prompt.COL_ACC1_JSON], row[prompt.COL_ACC1_SCORE])
+        if row[prompt.COL_ACC2_JSON] != row[prompt.COL_ACC1_JSON]:
+            self.set_fp_check(idx, row[prompt.COL_ACC2_JSON], row[prompt.COL_ACC2_SCORE])
+
+    def failed(self) -> List[Hashable]:
+        """Rows whose preprocessing never landed."""
+        return list(self.index[(self._passes & _PRE) == 0])
+
+    def _scores(self, values: np.ndarray) -> pd.arrays.IntegerArray:
+        return pd.arrays.IntegerArray(values.copy(), values == _MISSING)
+
+    def columns(self) -> Dict[str, Any]:
+        """Result column name → array, in row order."""
+        return {
+            prompt.COL_PREPROCESSED: self._pre,
+            prompt.COL_ACC1_JSON: self._json1,
+            prompt.COL_ACC1_SCORE: self._scores(self._score1),
+            prompt.COL_ACC2_JSON: self._json2,
+            prompt.COL_ACC2_SCORE: self._scores(self._score2),
+        }
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame(self.columns(), index=self.index)
+
+    def join(self, df: pd.DataFrame) -> pd.DataFrame:
+        """`df` (the rows this store was built for, in order) with the result columns added
+        and the rows whose preprocessing failed dropped."""
+        out = df.assign(**self.columns())
+        return out[(self._passes & _PRE) != 0]
@@ -0,0 +1,212 @@
+from __future__ import annotations
+import asyncio, csv, random, time
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Set
+
+from llm_tools import events, prompt, telemetry
+from llm_tools.ratelimit import _error_class, _retry_after_from_exc
+
+class RetryPolicy:
+    """How often and how long to back off for one class of error.
+
+    The delay before retry `n` is drawn uniformly from [0, min(cap, base·2ⁿ)] ("full
+    jitter"), so failures from a burst do not come back in lockstep. A server-supplied
+    `retry-after` is used as a floor when `honor_retry_after` is set.
+    """
+
+    def __init__(self, max_retries: int, base: float = prompt.RETRY_SLEEP, cap: float = prompt.RETRY_MAX_SLEEP, honor_retry_after: bool = True):
+        self.max_retries = max_retries
+        self.base = base
+        self.cap = cap
+        self.honor_retry_after = honor_retry_after
+
+    def delay(self, retry: int, retry_after: Optional[float] = None) -> float:
+        delay = random.uniform(0, min(self.cap, self.base * 2 ** retry))
+        if self.honor_retry_after and retry_after:
+            delay = max(delay, retry_after)
+        return delay
+
+DEFAULT_POLICIES: Dict[str, RetryPolicy] = {
+    "rate_limited": RetryPolicy(prompt.RETRY_LIMIT_RATE),
+    "timeout":      RetryPolicy(prompt.RETRY_LIMIT_FIRST, base=2 * prompt.RETRY_SLEEP),
+    "server":       RetryPolicy(prompt.RETRY_LIMIT_FIRST),
+    "invalid":      RetryPolicy(prompt.RETRY_LIMIT_SECOND, base=0.5 * prompt.RETRY_SLEEP),
+    "client":       RetryPolicy(0),  # bad request / auth: retrying will not help
+    "other":        RetryPolicy(prompt.RETRY_LIMIT_FIRST),
+}
+
+class AdmissionWindow:
+    """Bounds how many reports are in progress; a report backing off gives its place up.
+
+    The producer `enter`s before starting a report's task and `admit`s the task; the
+    place is freed when the task ends. While a task sleeps before a retry it steps out of
+    the window, so new reports keep the workers busy instead of queueing behind failures.
+    Dedup followers waiting for their group leader step out as well, so a leader that
+    backs off can always get a place back. Subtasks started with `gather` (variants,
+    screen samples) share their report's place: it is given up while every one of them is
+    outside and taken again when the first steps back in.
+    """
+
+    def __init__(self, size: int):
+        self._sem = asyncio.Semaphore(size)
+        self._holders: Set[asyncio.Task] = set()
+        self._members: Dict[asyncio.Task, asyncio.Task] = {}  # subtask → admitted task it belongs to
+        self._inside: Dict[asyncio.Task, int] = {}  # admitted task → its tasks that are not outside
+        self._placed: Dict[asyncio.Task, bool] = {}  # admitted task → holds a place right now
+        self._locks: Dict[asyncio.Task, asyncio.Lock] = {}
+        self._out: Set[asyncio.Task] = set()  # tasks inside an `outside` block
+
+    async def enter(self) -> None:
+        await self._sem.acquire()
+
+    def admit(self, task: asyncio.Task) -> None:
+        self._holders.add(task)
+        self._inside[task] = 1
+        self._placed[task] = True
+        task.add_done_callback(self._leave)
+
+    def _leave(self, task: asyncio.Task) -> None:
+        if task in self._holders:
+            self._holders.discard(task)
+            del self._inside[task]
+            self._locks.pop(task, None)
+            self._out.discard(task)
+            if self._placed.pop(task):
+                self._sem.release()
+
+    def _holder(self, task: Optional[asyncio.Task]) -> Optional[asyncio.Task]:
+        holder = self._members.get(task, task)
+        return holder if holder in self._holders else None
+
+    def _step_out(self, holder: asyncio.Task) -> None:
+        self._inside[holder] -= 1
+        if self._inside[holder] == 0 and self._placed[holder]:
+            self._placed[holder] = False
+            self._sem.release()
+
+    async def _step_in(self, holder: asyncio.Task) -> None:
+        self._inside[holder] += 1
+        try:
+            async with self._locks.setdefault(holder, asyncio.Lock()):
+                if not self._placed[holder]:
+                    await self._sem.acquire()
+                    self._placed[holder] = True
+        except BaseException:
+            if holder in self._holders:
+                self._step_out(holder)
+            raise
+
+    @asynccontextmanager
+    async def outside(self):
+        """Give the current task's place up for the block and take one again after it.
+
+        If the block raises, the task stays outside the window.
+        """
+        task = asyncio.current_task()
+        holder = self._holder(task)
+        if holder is None or task in self._out:
+            yield
+            return
+        self._out.add(task)
+        self._step_out(holder)
+        yield
+        if holder in self._holders:
+            await self._step_in(holder)
+        self._out.discard(task)
+
+    async def wait_outside(self, delay: float) -> None:
+        async with self.outside():
+            await asyncio.sleep(delay)
+
+    async def gather(self, *aws: Awaitable[Any], return_exceptions: bool = False) -> List[Any]:
+        """`asyncio.gather` for subtasks of the current report, sharing its place."""
+        task = asyncio.current_task()
+        holder = self._holder(task)
+        if holder is None or task in self._out:
+            return await asyncio.gather(*aws, return_exceptions=return_exceptions)
+
+        async def _member(aw: Awaitable[Any]) -> Any:
+            member = asyncio.current_task()
+            self._members[member] = holder
+            try:
+                return await aw
+            finally:
+                del self._members[member]
+                if member in self._out:
+                    self._out.discard(member)
+                elif holder in self._holders:
+                    self._step_out(holder)
+
+        # the subtasks count as inside from now on; this task only waits for them
+        self._inside[holder] += len(aws)
+        async with self.outside():
+            return await asyncio.gather(*map(_member, aws), return_exceptions=return_exceptions)
+
+class RetryScheduler:
+    """Runs one call with per-error-class retries and records what finally failed.
+
+    Every retry waits a jittered backoff from the matching `RetryPolicy` and is then
+    dispatched through the same concurrency controller as first attempts. Calls that
+    exhaust their policy are kept in `failures` (index, pass, error class, attempts, last
+    error, timestamps) and can be written with `write_failures`.
+    """
+
+    def __init__(self, policies: Optional[Dict[str, RetryPolicy]] = None, window: Optional[AdmissionWindow] = None):
+        self.policies = {**DEFAULT_POLICIES, **(policies or {})}
+        self.window = window
+        self.retries: Dict[str, int] = {}
+        self.failures: List[Dict[str, Any]] = []
+
+    async def call(
+        self,
+        func: Callable[[], Awaitable[Any]],
+        *,
+        pass_name: str,
+        idx: Hashable = None,
+        retry_func: Optional[Callable[[], Awaitable[Any]]] = None,
+    ) -> Any:
+        """`await func()`, retried per policy (with `retry_func` from the second attempt on, if given)."""
+        first = time.time()
+        attempt = 0
+        while True:
+            try:
+                with telemetry.retry_attempt(attempt):
+                    return await (func if attempt == 0 or retry_func is None else retry_func)()
+            except Exception as e:
+                error_class = _error_class(e)
+                policy = self.policies.get(error_class, self.policies["other"])
+                if attempt >= policy.max_retries:
+                    self.failures.append({
+                        "index": idx, "pass": pass_name, "error_class": error_class, "attempts": attempt + 1,
+                        "error": f"{type(e).__name__}: {e}", "first_attempt": first, "last_attempt": time.time(),
+                    })
+                    events.error(f"[Final Failure] {pass_name} idx={idx} after {attempt + 1} attempts ({error_class}): {e}")
+                    raise
+                attempt += 1
+                self.retries[error_class] = self.retries.get(error_class, 0) + 1
+                delay = policy.delay(attempt, _retry_after_from_exc(e))
+                events.warning(f"[Retry {attempt}/{policy.max_retries}] {pass_name} idx={idx} {error_class}: {e}; retrying in {delay:.1f}s")
+                if self.window is not None:
+                    await self.window.wait_outside(delay)
+                else:
+                    await asyncio.sleep(delay)
+
+    def summary(self) -> str:
+        retried = ", ".join(f"{n:,} {cls}" for cls, n in sorted(self.retries.items())) or "none"
+        return f"Retries: {retried}; {len(self.failures):,} calls failed for good."
+
+def write_failures(failures: List[Dict[str, Any]], path: str | Path) -> Path:
+    """Write final failures to `path` (CSV), one row per failed call."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    cols = ["index", "pass", "error_class", "attempts", "error", "first_attempt", "last_attempt"]
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=cols)
+        writer.writeheader()
+        for row in failures:
+            writer.writerow({**row, "first_attempt": _iso(row["first_attempt"]), "last_attempt": _iso(row["last_attempt"])})
+    return path
+
+def _iso(ts: float) -> str:
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(ts))
@@ -0,0 +1,193 @@
+from __future__ import annotations
+import asyncio, re, time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from collections import deque
+from typing import Any, Deque, Dict, Iterator, List, Mapping, Optional, Tuple
+
+import pandas as pd
+from llm_tools import prompt
+
+try:
+    import tiktoken
+    _ENCODING = tiktoken.get_encoding("o200k_base")
+except Exception:  # optional (not installed, or its vocabulary cannot be downloaded)
+    _ENCODING = None
+
+# Approximates BPE splitting: words in pieces of up to 4 characters, each symbol on its own
+_TOKEN_RE = re.compile(r"\w{1,4}|[^\w\s]")
+_MESSAGE_OVERHEAD = 4  # role and separators per chat message
+
+def estimate_tokens(text: str) -> int:
+    """Token count of `text`: exact with `tiktoken` installed, otherwise a local approximation."""
+    if _ENCODING is not None:
+        return len(_ENCODING.encode(text, disallowed_special=()))
+    return len(_TOKEN_RE.findall(text))
+
+def estimate_prompt_tokens(messages: List[Dict[str, Any]]) -> int:
+    """Prompt tokens of a chat request built by `llm_call._build_messages`."""
+    total = 3
+    for message in messages:
+        content = message["content"]
+        if not isinstance(content, str):
+            content = "".join(part.get("text", "") for part in content)
+        total += _MESSAGE_OVERHEAD + estimate_tokens(content)
+    return total
+
+class _Spend:
+    __slots__ = ("at", "tokens", "expired")
+
+    def __init__(self, at: float, tokens: float):
+        self.at, self.tokens, self.expired = at, tokens, False
+
+class TokenBudget:
+    """Rolling tokens-per-minute budget for one endpoint/model.
+
+    `acquire` reserves a request's predicted tokens (prompt estimate plus the running mean
+    of completion tokens) and waits while the tokens spent in the last `window` seconds
+    would exceed `tpm`. A request larger than the whole budget is let through once the
+    window is empty. `settle` replaces the reservation with the tokens actually used.
+    """
+
+    def __init__(self, tpm: int, *, window: float = prompt.TPM_WINDOW, completion_estimate: float = prompt.TPM_COMPLETION_ESTIMATE):
+        self.tpm = tpm
+        self.window = window
+        self.completion_estimate = float(completion_estimate)
+        self.used = 0.0
+        self.requests = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self._spent: Deque[_Spend] = deque()
+        self._cond: Optional[asyncio.Condition] = None
+        self._loop = None
+
+    def _condition(self) -> asyncio.Condition:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop, self._cond = loop, asyncio.Condition()
+        return self._cond
+
+    def _expire(self, now: float) -> None:
+        while self._spent and self._spent[0].at <= now - self.window:
+            spend = self._spent.popleft()
+            spend.expired = True
+            self.used -= spend.tokens
+
+    async def acquire(self, prompt_tokens: int) -> _Spend:
+        tokens = prompt_tokens + self.completion_estimate
+        cond = self._condition()
+        queued = time.monotonic()
+        async with cond:
+            while True:
+                now = time.monotonic()
+                self._expire(now)
+                if not self._spent or self.used + tokens <= self.tpm:
+                    break
+                try:
+                    await asyncio.wait_for(cond.wait(), self._spent[0].at + self.window - now)
+                except asyncio.TimeoutError:
+                    pass
+            spend = _Spend(now, tokens)
+            self._spent.append(spend)
+            self.used += tokens
+        self.requests += 1
+        if now - queued > 0.01:
+            self.waits += 1
+            self.wait_time += now - queued
+        return spend
+
+    async def settle(self, spend: _Spend, tokens: Optional[int] = None, completion_tokens: Optional[int] = None) -> None:
+        """Record the tokens a request used (None: it was rejected and used none)."""
+        if completion_tokens is not None:
+            self.completion_estimate = 0.9 * self.completion_estimate + 0.1 * completion_tokens
+        cond = self._condition()
+        async with cond:
+            delta = (tokens or 0) - spend.tokens
+            if not spend.expired:
+                spend.tokens += delta
+                self.used += delta
+            elif delta > 0:  # the reservation already left the window; count the rest now
+                self._spent.append(_Spend(time.monotonic(), delta))
+                self.used += delta
+            if delta < 0:
+                cond.notify_all()
+
+class TokenScheduler:
+    """Token-aware dispatch: longest reports first, and a TPM budget per model.
+
+    With `longest_first`, reports are admitted in descending order of estimated tokens,
+    so the long reports that would otherwise finish last start first and the tail of
+    each pass is made of short ones. With `tpm` (one limit for every model, or a
+    {model: limit} mapping), each endpoint/model gets a rolling `TokenBudget` that holds
+    requests back before the provider's tokens-per-minute quota would answer with 429s.
+
+    Every request's prompt tokens are estimated up front (see `estimate_tokens`);
+    `summary()` compares the estimate with the usage the API reported.
+    """
+
+    def __init__(self, *, longest_first: bool = True, tpm: Optional[int | Mapping[str, int]] = None):
+        self.longest_first = longest_first
+        self.tpm = tpm
+        self._budgets: Dict[Tuple[str, str], TokenBudget] = {}
+        self.reset()
+
+    def reset(self) -> None:
+        self._budgets.clear()
+        self.predicted = self.actual = self.measured = 0
+
+    def order(self, reports: pd.Series) -> pd.Index:
+        """Index of `reports`, longest first if enabled."""
+        if not self.longest_first:
+            return reports.index
+        sizes = reports.astype(str).map(estimate_tokens)
+        return sizes.sort_values(ascending=False, kind="stable").index
+
+    def _tpm_for(self, model: str) -> Optional[int]:
+        if isinstance(self.tpm, Mapping):
+            return self.tpm.get(model)
+        return self.tpm
+
+    def budget(self, client, model: str) -> Optional[TokenBudget]:
+        key = (str(getattr(client, "base_url", "")), model)
+        budget = self._budgets.get(key)
+        if budget is None:
+            tpm = self._tpm_for(model)
+            if not tpm:
+                return None
+            budget = self._budgets[key] = TokenBudget(tpm)
+        return budget
+
+    def record(self, predicted: int, prompt_tokens: int) -> None:
+        if prompt_tokens:
+            self.predicted += predicted
+            self.actual += prompt_tokens
+            self.measured += 1
+
+    def summary(self) -> str:
+        parts = ["Scheduler: " + ("longest reports first" if self.longest_first else "input order")]
+        if self.measured:
+            error = self.predicted / self.actual - 1
+            parts.append(
+                f"predicted {self.predicted:,} vs actual {self.actual:,} prompt tokens "
+                f"over {self.measured:,} requests ({error:+.1%})"
+            )
+        for (_, model), budget in self._budgets.items():
+            parts.append(
+                f"{model} budget {budget.tpm:,} TPM: {budget.waits:,} of {budget.requests:,} requests "
+                f"held back, {budget.wait_time:.1f} s in total"
+            )
+        return "; ".join(parts) + "."
+
+_scheduler: ContextVar[Optional[TokenScheduler]] = ContextVar("llm_tools_scheduler", default=None)
+
+def current() -> Optional[TokenScheduler]:
+    return _scheduler.get()
+
+@contextmanager
+def use_scheduler(scheduler: Optional[TokenScheduler]) -> Iterator[Optional[TokenScheduler]]:
+    """Budget the LLM calls made in this context (and the tasks it starts) with `scheduler`."""
+    token = _scheduler.set(scheduler)
+    try:
+        yield scheduler
+    finally:
+        _scheduler.reset(token)
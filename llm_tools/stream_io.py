@@ -0,0 +1,98 @@
+from __future__ import annotations
+import asyncio, math, os
+from pathlib import Path
+from typing import AsyncIterator, Dict, Iterator, Optional, Tuple
+
+import pandas as pd
+from llm_tools import prompt
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:  # optional: only needed for Parquet input/output
+    pq = None
+
+def _require_pyarrow():
+    if pq is None:
+        raise ImportError("Parquet support needs pyarrow: pip install pyarrow")
+
+def _iter_chunks(path: str | Path, chunksize: int = prompt.STREAM_CHUNKSIZE) -> Iterator[pd.DataFrame]:
+    """Read a CSV, JSONL or Parquet corpus `chunksize` rows at a time.
+
+    Chunks are indexed by their global row number, so indices are unique across the file.
+    """
+    path = Path(path)
+    suffix = path.suffix.lower()
+    if suffix == ".parquet":
+        _require_pyarrow()
+        chunks = (b.to_pandas() for b in pq.ParquetFile(path).iter_batches(batch_size=chunksize))
+    elif suffix in (".jsonl", ".ndjson"):
+        chunks = pd.read_json(path, lines=True, chunksize=chunksize)
+    else:
+        chunks = pd.read_csv(path, chunksize=chunksize)
+    offset = 0
+    for chunk in chunks:
+        chunk.index = pd.RangeIndex(offset, offset + len(chunk))
+        offset += len(chunk)
+        yield chunk
+
+async def _aiter_chunks(path: str | Path, chunksize: int = prompt.STREAM_CHUNKSIZE) -> AsyncIterator[pd.DataFrame]:
+    """`_iter_chunks` with the blocking reads pushed to a worker thread."""
+    chunks = _iter_chunks(path, chunksize)
+    while True:
+        chunk = await asyncio.to_thread(next, chunks, None)
+        if chunk is None:
+            return
+        yield chunk
+
+class PartitionedWriter:
+    """Writes one `part-NNNNN.<fmt>` file per input chunk; each part appears atomically."""
+
+    def __init__(self, out_dir: str | Path, out_format: str = "csv"):
+        if out_format not in ("csv", "parquet"):
+            raise ValueError(f"Unsupported output format: {out_format}")
+        if out_format == "parquet":
+            _require_pyarrow()
+        self.out_dir = Path(out_dir)
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        self.out_format = out_format
+
+    def part_path(self, part: int) -> Path:
+        return self.out_dir / f"part-{part:05d}.{self.out_format}"
+
+    def exists(self, part: int) -> bool:
+        return self.part_path(part).exists()
+
+    def write(self, part: int, df: pd.DataFrame) -> Path:
+        path = self.part_path(part)
+        tmp = path.with_name(path.name + ".tmp")
+        if self.out_format == "parquet":
+            df.to_parquet(tmp, index=False)
+        else:
+            df.to_csv(tmp, index=False, encoding="utf-8")
+        os.replace(tmp, path)
+        return path
+
+    def read_scores(self, part: int) -> pd.DataFrame:
+        cols = [prompt.COL_ACC1_SCORE, prompt.COL_ACC2_SCORE]
+        if self.out_format == "parquet":
+            return pd.read_parquet(self.part_path(part), columns=cols)
+        return pd.read_csv(self.part_path(part), usecols=cols)
+
+class _RunningStats:
+    """Streaming mean/std (ddof=1, NaNs skipped) per score column."""
+
+    def __init__(self, *cols: str):
+        self._acc: Dict[str, Tuple[int, float, float]] = {c: (0, 0.0, 0.0) for c in cols}
+
+    def update(self, df: pd.DataFrame) -> None:
+        for col, (n, s, ss) in self._acc.items():
+            vals = pd.to_numeric(df[col]).dropna()
+            self._acc[col] = (n + len(vals), s + float(vals.sum()), ss + float((vals ** 2).sum()))
+
+    def mean_std(self, col: str) -> Tuple[Optional[float], Optional[float]]:
+        n, s, ss = self._acc[col]
+        if n == 0:
+            return math.nan, math.nan
+        mean = s / n
+        std = math.sqrt(max(ss - s * s / n, 0.0) / (n - 1)) if n > 1 else math.nan
+        return mean, std
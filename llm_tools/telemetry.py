@@ -0,0 +1,430 @@
+from __future__ import annotations
+import asyncio, json, math, random, re, threading, time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import pandas as pd
+from llm_tools import prompt
+
+_USAGE_FIELDS = ("prompt_tokens", "cached_tokens", "completion_tokens", "reasoning_tokens")
+_SUMMARY_COLS = [
+    "calls", "errors", "invalid", "retries", "reports",
+    "latency_p50_s", "latency_p95_s", "latency_p99_s", "queue_wait_mean_s", "reports_per_s",
+    "prompt_tokens", "cached_tokens", "completion_tokens", "reasoning_tokens", "tokens_per_report", "cost_usd",
+    "predicted_prompt_tokens", "prompt_estimate_error", "hedges", "hedge_wins", "hedge_saved_s", "hedge_cancelled",
+]
+
+def _usage_tokens(usage: Any) -> Dict[str, int]:
+    """Token counts from an SDK `usage` object or its dict form (Batch API output)."""
+    def get(obj, name):
+        return obj.get(name) if isinstance(obj, dict) else getattr(obj, name, None)
+    prompt_details = get(usage, "prompt_tokens_details") if usage else None
+    completion_details = get(usage, "completion_tokens_details") if usage else None
+    return {
+        "prompt_tokens": (get(usage, "prompt_tokens") if usage else None) or 0,
+        "cached_tokens": (get(prompt_details, "cached_tokens") if prompt_details else None) or 0,
+        "completion_tokens": (get(usage, "completion_tokens") if usage else None) or 0,
+        "reasoning_tokens": (get(completion_details, "reasoning_tokens") if completion_details else None) or 0,
+    }
+
+def _price(model: str) -> Optional[Tuple[float, float, float]]:
+    if model in prompt.MODEL_PRICES:
+        return prompt.MODEL_PRICES[model]
+    base = re.sub(r"-\d{4}-\d{2}-\d{2}$", "", model)  # dated snapshots, e.g. o4-mini-2025-04-16
+    return prompt.MODEL_PRICES.get(base)
+
+def _cost(model: str, tokens: Dict[str, int], batch: bool) -> float:
+    price = _price(model)
+    if price is None:
+        return math.nan
+    inp, cached, out = price
+    usd = ((tokens["prompt_tokens"] - tokens["cached_tokens"]) * inp + tokens["cached_tokens"] * cached
+           + tokens["completion_tokens"] * out) / 1e6
+    return usd * prompt.BATCH_PRICE_FACTOR if batch else usd
+
+def _outcome(exc: Optional[BaseException]) -> str:
+    if exc is None:
+        return "ok"
+    status = getattr(exc, "status_code", None)
+    if status == 429:
+        return "rate_limited"
+    if "Timeout" in type(exc).__name__:
+        return "timeout"
+    return f"http_{status}" if status else "error"
+
+class _PassStats:
+    """Running aggregates of the calls of one (pass, model)."""
+
+    def __init__(self, max_samples: int):
+        self.calls = 0
+        self.outcomes: Dict[str, int] = {}
+        self.invalid = 0
+        self.retries = 0
+        self.reports = 0
+        self.tokens = dict.fromkeys(_USAGE_FIELDS, 0)
+        self.predicted = 0           # estimated prompt tokens of the calls that reported usage
+        self.predicted_actual = 0    # their actual prompt tokens
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.hedge_saved = 0.0       # estimated seconds of latency removed by winning hedges
+        self.hedge_cancelled = 0     # requests of hedged calls cancelled because the other side won
+        self.cost = 0.0
+        self.priced = False
+        self.queue_wait = 0.0
+        self.latency_sum = 0.0
+        self.latency_count = 0
+        self.first_start = math.inf
+        self.last_end = -math.inf
+        self.samples: List[float] = []  # reservoir of successful-call latencies
+        self._max_samples = max_samples
+
+    def add(self, rec: Dict[str, Any]) -> None:
+        self.calls += 1
+        self.outcomes[rec["outcome"]] = self.outcomes.get(rec["outcome"], 0) + 1
+        self.retries += rec["retry"] > 0
+        self.reports += rec["reports"]
+        for f in _USAGE_FIELDS:
+            self.tokens[f] += rec[f]
+        cancelled = rec["outcome"] == "hedge_cancelled"
+        self.hedge_cancelled += cancelled
+        if rec["predicted_prompt_tokens"] and rec["prompt_tokens"] and not cancelled:  # not its own estimate
+            self.predicted += rec["predicted_prompt_tokens"]
+            self.predicted_actual += rec["prompt_tokens"]
+        if not math.isnan(rec["cost_usd"]):
+            self.cost += rec["cost_usd"]
+            self.priced = True
+        self.queue_wait += rec["queue_wait"]
+        latency = rec["latency"]
+        self.first_start = min(self.first_start, rec["ts"])
+        self.last_end = max(self.last_end, rec["ts"] + (latency or 0.0))
+        if latency is None or rec["outcome"] != "ok":
+            return
+        self.latency_sum += latency
+        self.latency_count += 1
+        if len(self.samples) < self._max_samples:
+            self.samples.append(latency)
+        else:
+            k = random.randrange(self.latency_count)
+            if k < self._max_samples:
+                self.samples[k] = latency
+
+    def merge(self, other: "_PassStats") -> None:
+        self.calls += other.calls
+        for outcome, n in other.outcomes.items():
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + n
+        self.invalid += other.invalid
+        self.retries += other.retries
+        self.reports += other.reports
+        for f in _USAGE_FIELDS:
+            self.tokens[f] += other.tokens[f]
+        self.predicted += other.predicted
+        self.predicted_actual += other.predicted_actual
+        self.hedges += other.hedges
+        self.hedge_wins += other.hedge_wins
+        self.hedge_saved += other.hedge_saved
+        self.hedge_cancelled += other.hedge_cancelled
+        self.cost += other.cost
+        self.priced |= other.priced
+        self.queue_wait += other.queue_wait
+        self.latency_sum += other.latency_sum
+        self.latency_count += other.latency_count
+        self.first_start = min(self.first_start, other.first_start)
+        self.last_end = max(self.last_end, other.last_end)
+        self.samples += other.samples
+
+    def quantile(self, q: float) -> float:
+        if not self.samples:
+            return math.nan
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def row(self) -> Dict[str, float]:
+        span = self.last_end - self.first_start
+        total_tokens = self.tokens["prompt_tokens"] + self.tokens["completion_tokens"]
+        return {
+            "calls": self.calls,
+            "errors": self.calls - self.outcomes.get("ok", 0) - self.hedge_cancelled,
+            "invalid": self.invalid,
+            "retries": self.retries,
+            "reports": self.reports,
+            "latency_p50_s": self.quantile(0.50),
+            "latency_p95_s": self.quantile(0.95),
+            "latency_p99_s": self.quantile(0.99),
+            "queue_wait_mean_s": self.queue_wait / self.calls if self.calls else math.nan,
+            "reports_per_s": self.reports / span if span > 0 else math.nan,
+            **self.tokens,
+            "tokens_per_report": total_tokens / self.reports if self.reports else math.nan,
+            "cost_usd": self.cost if self.priced else math.nan,
+            "predicted_prompt_tokens": self.predicted,
+            "prompt_estimate_error": self.predicted / self.predicted_actual - 1 if self.predicted_actual else math.nan,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "hedge_saved_s": self.hedge_saved,
+            "hedge_cancelled": self.hedge_cancelled,
+        }
+
+class Telemetry:
+    """Instrumentation of every LLM request in a run, with per-pass summaries and exports.
+
+    Each API call yields a record: pass, model, latency, queue wait (time spent waiting for
+    a concurrency slot), prompt/cached/completion/reasoning tokens, the prompt tokens
+    predicted before sending, retry attempt, outcome, number of reports answered (more
+    than one for packed requests) and estimated cost. The request of a hedged call that
+    lost the race is recorded too, with outcome `hedge_cancelled`, its latency until it
+    was cancelled and its estimated prompt tokens (which are billed, though no usage
+    comes back).
+    Records are folded into per-(pass, model) aggregates, so memory stays flat on long
+    runs; latency percentiles come from a reservoir of `max_samples` latencies. With
+    `jsonl_path`, every record is also appended to that file as it lands. Responses that
+    arrive but fail validation are counted as `invalid`.
+    """
+
+    def __init__(self, jsonl_path: Optional[str | Path] = None, *, max_samples: int = 10_000):
+        self.jsonl_path = Path(jsonl_path) if jsonl_path is not None else None
+        self.max_samples = max_samples
+        self._stats: Dict[Tuple[str, str], _PassStats] = {}
+        self._lock = threading.Lock()
+        self._file = None
+
+    def _get(self, pass_name: str, model: str) -> _PassStats:
+        stats = self._stats.get((pass_name, model))
+        if stats is None:
+            stats = self._stats[(pass_name, model)] = _PassStats(self.max_samples)
+        return stats
+
+    def record(
+        self,
+        *,
+        pass_name: str,
+        model: str,
+        start: float,
+        latency: Optional[float],
+        queue_wait: float = 0.0,
+        usage: Any = None,
+        exc: Optional[BaseException] = None,
+        reports: int = 1,
+        batch: bool = False,
+        predicted_tokens: int = 0,
+        hedge_cancelled: bool = False,
+    ) -> None:
+        tokens = _usage_tokens(usage)
+        if hedge_cancelled and not tokens["prompt_tokens"]:
+            tokens["prompt_tokens"] = predicted_tokens
+        rec = {
+            "ts": start,
+            "pass": pass_name,
+            "model": model,
+            "latency": latency,
+            "queue_wait": queue_wait,
+            **tokens,
+            "predicted_prompt_tokens": predicted_tokens,
+            "retry": _retry.get(),
+            "outcome": "hedge_cancelled" if hedge_cancelled else _outcome(exc),
+            "reports": reports if exc is None else 0,
+            "batch": batch,
+            "cost_usd": _cost(model, tokens, batch),
+        }
+        with self._lock:
+            self._get(pass_name, model).add(rec)
+            if self.jsonl_path is not None:
+                if self._file is None:
+                    self.jsonl_path.parent.mkdir(parents=True, exist_ok=True)
+                    self._file = open(self.jsonl_path, "a", encoding="utf-8")
+                clean = {k: (None if isinstance(v, float) and math.isnan(v) else v) for k, v in rec.items()}
+                self._file.write(json.dumps(clean) + "\n")
+
+    def record_invalid(self, pass_name: str, model: str) -> None:
+        with self._lock:
+            self._get(pass_name, model).invalid += 1
+
+    def record_hedge(self, pass_name: str, model: str, *, won: bool, saved: float) -> None:
+        """A hedged call finished; `saved` is the estimated latency its hedge removed."""
+        with self._lock:
+            stats = self._get(pass_name, model)
+            stats.hedges += 1
+            stats.hedge_wins += won
+            stats.hedge_saved += saved
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stats.clear()
+
+    def merge(self, other: "Telemetry") -> None:
+        """Fold `other`'s aggregates into this one (e.g. a per-file run into a process total)."""
+        with self._lock:
+            for (pass_name, model), stats in other._stats.items():
+                self._get(pass_name, model).merge(stats)
+
+    def flush(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    @property
+    def calls(self) -> int:
+        return sum(s.calls for s in self._stats.values())
+
+    def summary(self) -> pd.DataFrame:
+        """One row per pass (all models of the pass together) plus `total`, `_SUMMARY_COLS` columns."""
+        with self._lock:
+            by_pass: Dict[str, _PassStats] = {}
+            total = _PassStats(self.max_samples)
+            for (pass_name, _), stats in self._stats.items():
+                by_pass.setdefault(pass_name, _PassStats(self.max_samples)).merge(stats)
+                total.merge(stats)
+            rows = {name: stats.row() for name, stats in by_pass.items()}
+            rows["total"] = total.row()
+        return pd.DataFrame.from_dict(rows, orient="index", columns=_SUMMARY_COLS)
+
+    def write_summary_jsonl(self, path: str | Path) -> Path:
+        """Append one JSON line per pass summary, stamped with the current time."""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        now = time.time()
+        with open(path, "a", encoding="utf-8") as f:
+            for name, row in self.summary().iterrows():
+                clean = {k: (None if pd.isna(v) else float(v)) for k, v in row.items()}
+                f.write(json.dumps({"ts": now, "pass": name, **clean}) + "\n")
+        return path
+
+    def to_prometheus(self, prefix: str = "mprred_llm") -> str:
+        """Prometheus text exposition format, labelled by pass and model."""
+        lines: List[str] = []
+
+        def metric(name: str, kind: str, help_: str, samples: List[Tuple[str, Dict[str, str], float]]):
+            lines.append(f"# HELP {prefix}_{name} {help_}")
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+            for suffix, labels, value in samples:
+                label_str = ",".join(f'{k}="{v}"' for k, v in labels.items())
+                lines.append(f"{prefix}_{name}{suffix}{{{label_str}}} {value:g}")
+
+        with self._lock:
+            groups = [({"pass": p, "model": m}, s) for (p, m), s in sorted(self._stats.items())]
+            metric("calls_total", "counter", "LLM API calls by outcome.", [
+                ("", {**labels, "outcome": o}, n) for labels, s in groups for o, n in sorted(s.outcomes.items())
+            ])
+            metric("invalid_responses_total", "counter", "Responses that failed schema validation.", [
+                ("", labels, s.invalid) for labels, s in groups
+            ])
+            metric("retries_total", "counter", "Calls made as a retry.", [("", labels, s.retries) for labels, s in groups])
+            metric("latency_seconds", "summary", "Latency of successful calls.", [
+                sample for labels, s in groups for sample in (
+                    *(("", {**labels, "quantile": str(q)}, s.quantile(q)) for q in (0.5, 0.95, 0.99) if s.samples),
+                    ("_sum", labels, s.latency_sum),
+                    ("_count", labels, s.latency_count),
+                )
+            ])
+            metric("queue_wait_seconds_total", "counter", "Time spent waiting for a concurrency slot.", [
+                ("", labels, s.queue_wait) for labels, s in groups
+            ])
+            metric("tokens_total", "counter", "Tokens by kind.", [
+                ("", {**labels, "kind": f.removesuffix("_tokens")}, s.tokens[f]) for labels, s in groups for f in _USAGE_FIELDS
+            ])
+            metric("predicted_prompt_tokens_total", "counter", "Prompt tokens estimated before sending, for calls that reported usage.", [
+                ("", labels, s.predicted) for labels, s in groups
+            ])
+            metric("hedges_total", "counter", "Calls that got a hedged duplicate request, by winner.", [
+                sample for labels, s in groups for sample in (
+                    ("", {**labels, "winner": "hedge"}, s.hedge_wins),
+                    ("", {**labels, "winner": "original"}, s.hedges - s.hedge_wins),
+                )
+            ])
+            metric("hedge_saved_seconds_total", "counter", "Estimated latency removed by winning hedges.", [
+                ("", labels, s.hedge_saved) for labels, s in groups
+            ])
+            metric("reports_total", "counter", "Reports answered.", [("", labels, s.reports) for labels, s in groups])
+            metric("cost_usd_total", "counter", "Estimated cost in USD.", [
+                ("", labels, s.cost) for labels, s in groups if s.priced
+            ])
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str | Path) -> Path:
+        """Write `to_prometheus()` atomically, e.g. for node_exporter's textfile collector."""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + ".tmp")
+        tmp.write_text(self.to_prometheus(), encoding="utf-8")
+        tmp.replace(path)
+        return path
+
+_telemetry: ContextVar[Optional[Telemetry]] = ContextVar("llm_tools_telemetry", default=None)
+_retry: ContextVar[int] = ContextVar("llm_tools_retry", default=0)
+_hedge_side: ContextVar[Optional[Dict[str, bool]]] = ContextVar("llm_tools_hedge_side", default=None)
+
+def current() -> Optional[Telemetry]:
+    return _telemetry.get()
+
+@contextmanager
+def use_telemetry(telemetry: Optional[Telemetry]) -> Iterator[Optional[Telemetry]]:
+    """Record the LLM calls made in this context (and the tasks it starts) into `telemetry`."""
+    token = _telemetry.set(telemetry)
+    try:
+        yield telemetry
+    finally:
+        _telemetry.reset(token)
+
+@contextmanager
+def retry_attempt(attempt: int) -> Iterator[None]:
+    """Mark calls made in this context as retry number `attempt`."""
+    token = _retry.set(attempt)
+    try:
+        yield
+    finally:
+        _retry.reset(token)
+
+@contextmanager
+def hedge_side(side: Dict[str, bool]) -> Iterator[None]:
+    """Tasks started in this context are one request of a hedged call. The `Hedger` sets
+    `side["cancelled"]` before it cancels the request that lost, so it is still recorded."""
+    token = _hedge_side.set(side)
+    try:
+        yield
+    finally:
+        _hedge_side.reset(token)
+
+@contextmanager
+def timed_call(
+    pass_name: Optional[str], model: str, *, reports: int = 1, queue_wait: float = 0.0, predicted_tokens: int = 0,
+) -> Iterator[Dict[str, Any]]:
+    """Time one API call and record it in the current telemetry.
+
+    The body stores the SDK `usage` object under `call["usage"]`; an exception is
+    recorded with its outcome and re-raised.
+    """
+    call: Dict[str, Any] = {"usage": None}
+    start, t0 = time.time(), time.monotonic()
+    try:
+        yield call
+    except BaseException as e:
+        _emit(pass_name, model, start, time.monotonic() - t0, queue_wait, None, e, reports, predicted_tokens)
+        raise
+    _emit(pass_name, model, start, time.monotonic() - t0, queue_wait, call["usage"], None, reports, predicted_tokens)
+
+def _emit(pass_name, model, start, latency, queue_wait, usage, exc, reports, predicted_tokens=0) -> None:
+    telemetry = _telemetry.get()
+    side = _hedge_side.get()
+    hedge_cancelled = isinstance(exc, asyncio.CancelledError) and side is not None and side.get("cancelled", False)
+    if telemetry is not None and (exc is None or isinstance(exc, Exception) or hedge_cancelled):  # not other cancellations
+        telemetry.record(
+            pass_name=pass_name or "unknown", model=model, start=start, latency=latency,
+            queue_wait=queue_wait, usage=usage, exc=exc, reports=reports, predicted_tokens=predicted_tokens,
+            hedge_cancelled=hedge_cancelled,
+        )
+
+def record_invalid(pass_name: Optional[str], model: str) -> None:
+    telemetry = _telemetry.get()
+    if telemetry is not None:
+        telemetry.record_invalid(pass_name or "unknown", model)
+
+def record_hedge(pass_name: Optional[str], model: str, *, won: bool, saved: float) -> None:
+    telemetry = _telemetry.get()
+    if telemetry is not None:
+        telemetry.record_hedge(pass_name or "unknown", model, won=won, saved=saved)
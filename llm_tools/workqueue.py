@@ -0,0 +1,253 @@
+from __future__ import annotations
+import os, socket, sqlite3, threading, time, uuid
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import pandas as pd
+from llm_tools import events, prompt, stream_io
+from llm_tools.journal import _settings_fingerprint
+
+_ROW = "__row__"  # global row number of each report, kept through shards and results
+
+def worker_id() -> str:
+    """`host:pid:random`, unique per worker process."""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+class WorkQueue:
+    """Corpus shards in a directory, leased to worker processes through SQLite.
+
+    Layout under `root`: `queue.sqlite` (shard states and leases), `shards/` (the input
+    split into `shard-NNNNN.csv`), `results/` (one result file per finished shard) and
+    `journal/` (per-shard run journals, so a reassigned shard resumes where its previous
+    worker stopped). Workers on other hosts can share `root` as long as the file system
+    supports SQLite locking (a local disk or an NFS/SMB mount with working POSIX locks).
+
+    A lease lasts `lease_ttl` seconds and is renewed by the worker's heartbeat; a lease
+    that runs out (the worker died or hung) makes the shard available again. A shard that
+    fails `max_attempts` times is marked failed and left out of the merge.
+    """
+
+    def __init__(self, root: str | Path, *, lease_ttl: float = prompt.LEASE_TTL, max_attempts: int = prompt.SHARD_MAX_ATTEMPTS):
+        self.root = Path(root)
+        self.lease_ttl = lease_ttl
+        self.max_attempts = max_attempts
+        self.root.mkdir(parents=True, exist_ok=True)
+        for sub in ("shards", "results", "journal"):
+            (self.root / sub).mkdir(exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.root / "queue.sqlite"), timeout=60, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS shards ("
+            " id INTEGER PRIMARY KEY, rows INTEGER, status TEXT, worker TEXT, lease_until REAL,"
+            " attempts INTEGER DEFAULT 0, error TEXT, finished REAL)"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    # ── coordinator ────────────────────────
+    @classmethod
+    def create(
+        cls,
+        root: str | Path,
+        input_path: str | Path,
+        *,
+        model: str,
+        shard_size: int = prompt.SHARD_SIZE,
+        **kw,
+    ) -> "WorkQueue":
+        """Split `input_path` (CSV/JSONL/Parquet) into shards under `root` and enqueue them."""
+        queue = cls(root, **kw)
+        if queue.meta():
+            raise ValueError(f"{queue.root} already holds a work queue; use a new directory.")
+        with queue._lock:
+            queue._conn.execute("DELETE FROM shards")  # left over from an interrupted split
+        n = 0
+        for shard, chunk in enumerate(stream_io._iter_chunks(input_path, shard_size)):
+            if prompt.COL_REPORT not in chunk.columns:
+                raise ValueError("Input file must contain a 'report' column.")
+            path = queue.shard_path(shard)
+            chunk.to_csv(path.with_name(path.name + ".tmp"), index_label=_ROW, encoding="utf-8")
+            os.replace(path.with_name(path.name + ".tmp"), path)
+            with queue._lock:
+                queue._conn.execute("INSERT INTO shards (id, rows, status) VALUES (?, ?, 'pending')", (shard, len(chunk)))
+            n += 1
+        with queue._lock:
+            queue._conn.executemany("INSERT INTO meta VALUES (?, ?)", [
+                ("input", str(Path(input_path).resolve())),
+                ("model", model),
+                ("settings", _settings_fingerprint(model, prompt.PREPROCESS_MODEL)),
+                ("shards", str(n)),
+            ])
+        return queue
+
+    def meta(self) -> Dict[str, str]:
+        with self._lock:
+            return dict(self._conn.execute("SELECT key, value FROM meta").fetchall())
+
+    def check_settings(self, model: str) -> None:
+        """Refuse to work a queue created for another model or prompt set."""
+        meta = self.meta()
+        if not meta:
+            raise ValueError(f"{self.root} is not a work queue; create it with `queue init` first.")
+        if meta["settings"] != _settings_fingerprint(model, prompt.PREPROCESS_MODEL):
+            raise ValueError(f"{self.root} was created for model {meta['model']} or other prompts; workers must use the same settings.")
+
+    def status(self) -> Dict[str, Any]:
+        """Shard and row counts per status, plus the number of expired leases."""
+        now = time.time()
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*), COALESCE(SUM(rows), 0) FROM shards GROUP BY status").fetchall()
+            (expired,) = self._conn.execute(
+                "SELECT COUNT(*) FROM shards WHERE status = 'leased' AND lease_until < ?", (now,)
+            ).fetchone()
+        stats: Dict[str, Any] = {s: 0 for s in ("pending", "leased", "done", "failed")}
+        stats.update({status: count for status, count, _ in rows})
+        stats["rows_done"] = sum(r for status, _, r in rows if status == "done")
+        stats["rows_total"] = sum(r for _, _, r in rows)
+        stats["expired_leases"] = expired
+        return stats
+
+    # ── workers ────────────────────────────
+    def shard_path(self, shard: int) -> Path:
+        return self.root / "shards" / f"shard-{shard:05d}.csv"
+
+    def result_path(self, shard: int) -> Path:
+        return self.root / "results" / f"shard-{shard:05d}.csv"
+
+    def lease(self, worker: str) -> Optional[int]:
+        """Take the lowest pending (or expired) shard for `worker`, or None if none is free.
+
+        An expired shard that has used up its attempts (its workers keep dying on it) is
+        marked failed instead of being leased again.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "UPDATE shards SET status = 'failed', lease_until = NULL,"
+                    " error = COALESCE(error, 'lease expired after ' || attempts || ' attempts')"
+                    " WHERE status = 'leased' AND lease_until < ? AND attempts >= ?", (now, self.max_attempts),
+                )
+                row = self._conn.execute(
+                    "SELECT id FROM shards WHERE status = 'pending' OR (status = 'leased' AND lease_until < ?)"
+                    " ORDER BY id LIMIT 1", (now,),
+                ).fetchone()
+                if row is not None:
+                    self._conn.execute(
+                        "UPDATE shards SET status = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1 WHERE id = ?",
+                        (worker, now + self.lease_ttl, row[0]),
+                    )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return None if row is None else row[0]
+
+    def _update_own(self, shard: int, worker: str, sql: str, params: Tuple) -> bool:
+        with self._lock:
+            cur = self._conn.execute(f"{sql} WHERE id = ? AND worker = ? AND status = 'leased'", (*params, shard, worker))
+        return cur.rowcount == 1
+
+    def renew(self, shard: int, worker: str) -> bool:
+        """Extend `worker`'s lease; False if it lost the shard to another worker."""
+        return self._update_own(shard, worker, "UPDATE shards SET lease_until = ?", (time.time() + self.lease_ttl,))
+
+    def complete(self, shard: int, worker: str) -> bool:
+        return self._update_own(shard, worker, "UPDATE shards SET status = 'done', finished = ?, error = NULL", (time.time(),))
+
+    def fail(self, shard: int, worker: str, error: str) -> bool:
+        """Give the shard back, or mark it failed once it has used up its attempts."""
+        return self._update_own(
+            shard, worker,
+            "UPDATE shards SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, error = ?, lease_until = NULL",
+            (self.max_attempts, error),
+        )
+
+    def has_open_leases(self) -> bool:
+        with self._lock:
+            (n,) = self._conn.execute("SELECT COUNT(*) FROM shards WHERE status = 'leased'").fetchone()
+        return n > 0
+
+    def load_shard(self, shard: int) -> pd.DataFrame:
+        return pd.read_csv(self.shard_path(shard), index_col=_ROW)
+
+    def write_result(self, shard: int, df: pd.DataFrame) -> Path:
+        path = self.result_path(shard)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        df.to_csv(tmp, index_label=_ROW, encoding="utf-8")
+        os.replace(tmp, path)
+        return path
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+def _heartbeat(queue: WorkQueue, shard: int, worker: str, stop: threading.Event) -> None:
+    while not stop.wait(queue.lease_ttl / 3):
+        if not queue.renew(shard, worker):
+            events.warning(f"Lost the lease on shard {shard}; another worker took it over.")
+            return
+
+def run_worker(
+    queue: WorkQueue,
+    process: Callable[[pd.DataFrame, int], pd.DataFrame],
+    *,
+    worker: Optional[str] = None,
+    poll_interval: float = 5.0,
+) -> int:
+    """Lease and process shards until none are left; returns the number this worker finished.
+
+    `process(df, shard)` runs the passes over one shard and returns its result rows (e.g.
+    `get_unstructured_accuracy(df, journal_dir=queue.root / "journal", ...)[0]`). While shards
+    are still leased by other workers, this waits and retries in case their leases expire.
+    """
+    worker = worker or worker_id()
+    done = 0
+    while True:
+        shard = queue.lease(worker)
+        if shard is None:
+            if not queue.has_open_leases():
+                return done
+            time.sleep(poll_interval)
+            continue
+        events.info(f"[{worker}] shard {shard} leased")
+        stop = threading.Event()
+        beat = threading.Thread(target=_heartbeat, args=(queue, shard, worker, stop), daemon=True)
+        beat.start()
+        try:
+            result = process(queue.load_shard(shard), shard)
+            queue.write_result(shard, result)
+            if queue.complete(shard, worker):
+                done += 1
+                events.success(f"[{worker}] shard {shard} done")
+        except Exception as e:
+            queue.fail(shard, worker, f"{type(e).__name__}: {e}")
+            events.error(f"[{worker}] shard {shard} failed: {e}")
+        finally:
+            stop.set()
+            beat.join()
+
+def merge(queue: WorkQueue, out_path: str | Path, *, allow_partial: bool = False) -> Tuple[Path, Tuple[Tuple[float, float], Tuple[float, float]]]:
+    """Concatenate the finished shards' results, in row order, into one CSV at `out_path`.
+
+    The output has the columns of `get_unstructured_accuracy`'s result (input columns plus
+    the pass columns), which is what the labeling app loads. Returns the path and the
+    (mean, std) of both accuracy scores. Unless `allow_partial`, every shard must be done.
+    """
+    status = queue.status()
+    if not allow_partial and status["done"] != int(queue.meta().get("shards", 0)):
+        raise ValueError(f"Not every shard is done ({status}); wait for the workers or pass allow_partial=True.")
+    out_path = Path(out_path)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    stats = stream_io._RunningStats(prompt.COL_ACC1_SCORE, prompt.COL_ACC2_SCORE)
+    with queue._lock:
+        shards = [s for (s,) in queue._conn.execute("SELECT id FROM shards WHERE status = 'done' ORDER BY id")]
+    tmp = out_path.with_name(out_path.name + ".tmp")
+    with open(tmp, "w", newline="", encoding="utf-8") as f:
+        for i, shard in enumerate(shards):
+            df = pd.read_csv(queue.result_path(shard), index_col=_ROW).sort_index()
+            df.to_csv(f, index=False, header=i == 0)
+            stats.update(df)
+    os.replace(tmp, out_path)
+    return out_path, (stats.mean_std(prompt.COL_ACC1_SCORE), stats.mean_std(prompt.COL_ACC2_SCORE))
@@ -0,0 +1,93 @@
+import json
+from types import SimpleNamespace
+
+import pandas as pd
+import pytest
+from llm_tools import batch, prompt
+
+class _Crash(Exception):
+    pass
+
+class _BatchServer:
+    """In-memory files/batches endpoints; custom_id `i` in `drop` gets a 500 line in its first `drop[i]` batches."""
+
+    def __init__(self, drop=None):
+        self.files, self.batches, self.created = {}, {}, []
+        self.drop = dict(drop or {})
+        self.in_progress = set()
+
+    def client(self):
+        server = self
+        files = SimpleNamespace(
+            create=lambda file, purpose: server._store(file.read()),
+            content=lambda file_id: SimpleNamespace(text=server.files[file_id].decode("utf-8")),
+        )
+        batches = SimpleNamespace(create=server._create, retrieve=server._retrieve)
+        return SimpleNamespace(files=files, batches=batches)
+
+    def _store(self, data: bytes):
+        file_id = f"file-{len(self.files)}"
+        self.files[file_id] = data
+        return SimpleNamespace(id=file_id)
+
+    def _create(self, input_file_id, endpoint, completion_window):
+        lines = [json.loads(line) for line in self.files[input_file_id].decode("utf-8").splitlines()]
+        out = []
+        for line in lines:
+            if self.drop.get(line["custom_id"], 0) > 0:
+                self.drop[line["custom_id"]] -= 1
+                out.append({"custom_id": line["custom_id"], "response": {"status_code": 500, "body": {"error": {"message": "boom"}}}})
+                continue
+            body = line["body"]
+            if body["response_format"]["json_schema"]["name"] == "preprocessing":
+                content = {"findings": body["messages"][1]["content"], "impression": "Normal."}
+            else:
+                content = {"error": "No error", "error_reason": ""}
+            choice = {"message": {"content": json.dumps(content)}}
+            out.append({"custom_id": line["custom_id"], "response": {"status_code": 200, "body": {"model": body["model"], "choices": [choice]}}})
+        batch_id = f"batch-{len(self.batches)}"
+        self.batches[batch_id] = self._store("".join(json.dumps(o) + "\n" for o in out).encode("utf-8")).id
+        self.created.append((batch_id, [line["custom_id"] for line in lines]))
+        self.in_progress.add(batch_id)
+        return SimpleNamespace(id=batch_id)
+
+    def _retrieve(self, batch_id):
+        if batch_id in self.in_progress:  # reported running once, then done
+            self.in_progress.discard(batch_id)
+            return SimpleNamespace(id=batch_id, status="in_progress", output_file_id=None)
+        return SimpleNamespace(id=batch_id, status="completed", output_file_id=self.batches[batch_id])
+
+def _df():
+    return pd.DataFrame({"report": [f"CT head {i}. No acute abnormality." for i in range(4)]})
+
+def test_restart_polls_the_saved_batch(tmp_path, monkeypatch):
+    server = _BatchServer()
+    state_path = tmp_path / "state.json"
+
+    def crash(seconds):
+        raise _Crash()
+    monkeypatch.setattr(batch.time, "sleep", crash)
+    with pytest.raises(_Crash):
+        batch._run_batch(_df(), server.client(), "stub", "stub-pre", state_path, poll_interval=0)
+    assert len(server.created) == 1
+    assert json.loads(state_path.read_text())["passes"][prompt.PASS_PREPROCESS]["batch_id"] == "batch-0"
+
+    monkeypatch.setattr(batch.time, "sleep", lambda seconds: None)
+    store = batch._run_batch(_df(), server.client(), "stub", "stub-pre", state_path, poll_interval=0)
+    # pass 1 resumed batch-0 and only the pass-2 batch was added (every report is clean: no pass 3)
+    assert [b for b, _ in server.created] == ["batch-0", "batch-1"]
+    assert (store.to_frame()[prompt.COL_ACC2_SCORE] == 1).all()
+
+def test_failed_lines_are_resubmitted(tmp_path, monkeypatch):
+    monkeypatch.setattr(batch.time, "sleep", lambda seconds: None)
+    server = _BatchServer(drop={"2": 1, "3": 99})
+    failures = []
+    store = batch._run_batch(_df(), server.client(), "stub", "stub-pre", tmp_path / "state.json", poll_interval=0, failures=failures)
+    # pass 1: the first batch, then BATCH_MAX_RESUBMITS follow-ups with only the failed lines
+    follow_ups = [ids for _, ids in server.created[1:1 + prompt.BATCH_MAX_RESUBMITS]]
+    assert follow_ups == [["2", "3"]] + [["3"]] * (prompt.BATCH_MAX_RESUBMITS - 1)
+    assert server.created[1 + prompt.BATCH_MAX_RESUBMITS][1] == ["0", "1", "2"]  # pass 2
+    assert store.failed() == [3]
+    assert [(f["index"], f["pass"], f["error_class"], f["attempts"]) for f in failures] == [
+        (3, prompt.PASS_PREPROCESS, "server", 1 + prompt.BATCH_MAX_RESUBMITS),
+    ]
@@ -0,0 +1,80 @@
+import asyncio, json
+
+import pandas as pd
+from llm_tools import events, llm_call, pipeline, prompt
+from llm_tools.dedup import Deduplicator
+from llm_tools.retry import AdmissionWindow, RetryPolicy
+
+class _ServerError(Exception):
+    status_code = 500
+
+class _Raw:
+    headers = {}
+
+    def __init__(self, content: str):
+        message = type("Message", (), {"content": content})()
+        self._resp = type("Response", (), {"choices": [type("Choice", (), {"message": message})()], "usage": None})()
+
+    def parse(self):
+        return self._resp
+
+class _FlakyClient:
+    """Answers every schema; the first `failures` error checks get a 5xx."""
+
+    def __init__(self, failures: int):
+        self.failures = failures
+        self.chat = self.completions = self.with_raw_response = self
+
+    async def create(self, **kwargs):
+        await asyncio.sleep(0.001)
+        if kwargs["response_format"]["json_schema"]["name"] == "preprocessing":
+            return _Raw(json.dumps({"findings": kwargs["messages"][1]["content"], "impression": "Normal."}))
+        if self.failures > 0:
+            self.failures -= 1
+            raise _ServerError("Injected server error")
+        return _Raw(json.dumps({"error": "No error", "error_reason": ""}))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return None
+
+def test_retrying_dedup_leader_does_not_deadlock(monkeypatch):
+    # With a window of two places, the leader's 5xx backoff used to leave both places to
+    # followers awaiting it, and the run hung.
+    monkeypatch.setattr(llm_call, "_make_async_client", lambda *a, **kw: _FlakyClient(failures=3))
+    df = pd.DataFrame({"report": ["CT head. No acute intracranial abnormality."] * 50})
+    out, _ = asyncio.run(asyncio.wait_for(pipeline.get_unstructured_accuracy_async(
+        df, api_key="x", dedup=Deduplicator(), max_concurrency=1,
+        retry_policies={"server": RetryPolicy(5, base=0.01)}, reporter=events.Reporter(),
+    ), timeout=30))
+    assert len(out) == 50
+    assert (out[prompt.COL_ACC2_SCORE] == 1).all()
+
+def test_subtasks_share_their_report_place():
+    async def main():
+        window = AdmissionWindow(1)
+        release = [asyncio.Event(), asyncio.Event()]
+
+        async def subtask(i: int):
+            async with window.outside():  # e.g. a dedup follower waiting for its leader
+                await release[i].wait()
+
+        async def report():
+            await window.gather(subtask(0), subtask(1))
+
+        await window.enter()
+        task = asyncio.create_task(report())
+        window.admit(task)
+        await asyncio.sleep(0.01)
+        await asyncio.wait_for(window.enter(), 1)  # both subtasks outside: the place is free
+        release[0].set()
+        await asyncio.sleep(0.01)
+        assert not task.done()  # subtask 0 waits to get the place back
+        window._sem.release()
+        release[1].set()
+        await asyncio.wait_for(task, 1)
+        assert window._sem._value == 1
+
+    asyncio.run(main())
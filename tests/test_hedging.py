@@ -0,0 +1,38 @@
+import asyncio, json
+
+from llm_tools import llm_call, prompt
+from llm_tools.hedging import Hedger, use_hedger
+from llm_tools.telemetry import Telemetry, use_telemetry
+
+class _Resp:
+    def __init__(self, content: str):
+        message = type("Message", (), {"content": content})()
+        self.choices = [type("Choice", (), {"message": message})()]
+        self.usage = {"prompt_tokens": 100, "completion_tokens": 10}
+
+class _SlowOnceClient:
+    """Answers in 10 ms, except that call number `slow` hangs for a second."""
+
+    def __init__(self, slow: int):
+        self.slow = slow
+        self.n = 0
+        self.chat = self.completions = self
+
+    async def create(self, **kwargs):
+        self.n += 1
+        await asyncio.sleep(1.0 if self.n == self.slow else 0.01)
+        return _Resp(json.dumps({"error": "No error", "error_reason": ""}))
+
+def test_cancelled_hedge_loser_is_recorded():
+    client = _SlowOnceClient(slow=4)
+    tm = Telemetry()
+
+    async def main():
+        with use_telemetry(tm), use_hedger(Hedger(min_samples=2, min_delay=0.02, max_rate=1.0)):
+            for i in range(4):
+                await llm_call._acached_completion(client, "stub", "system", f"report {i}", pass_name=prompt.PASS_ERROR_CHECK)
+
+    asyncio.run(asyncio.wait_for(main(), 5))
+    row = tm.summary().loc[prompt.PASS_ERROR_CHECK]
+    assert (row["calls"], row["errors"], row["hedges"], row["hedge_wins"], row["hedge_cancelled"]) == (5, 0, 1, 1, 1)
+    assert row["prompt_tokens"] > 4 * 100  # the cancelled request's estimated prompt tokens count as billed
@@ -0,0 +1,72 @@
+import asyncio, json
+
+import pandas as pd
+from llm_tools import events, llm_call, pipeline, prompt
+from llm_tools.effort import EffortPolicy
+from test_dedup_retry import _Raw
+
+class _CountingClient:
+    """Flags reports mentioning "left" in pass 2 and confirms them in pass 3; counts calls per pass."""
+
+    def __init__(self):
+        self.calls = {}
+        self.chat = self.completions = self.with_raw_response = self
+
+    async def create(self, **kwargs):
+        await asyncio.sleep(0.001)
+        system, user = kwargs["messages"][0]["content"][0]["text"], kwargs["messages"][1]["content"]
+        name = {
+            prompt.SYSTEM_PROMPT_PREPROCESS: prompt.PASS_PREPROCESS,
+            prompt.SYSTEM_PROMPT_ERROR_CHECK: prompt.PASS_ERROR_CHECK,
+            prompt.SYSTEM_PROMPT_FP_CHECK: prompt.PASS_FP_CHECK,
+        }[system]
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if name == prompt.PASS_PREPROCESS:
+            return _Raw(json.dumps({"findings": user, "impression": "Normal."}))
+        if "left" in user:
+            return _Raw(json.dumps({"error": "Laterality", "error_reason": "left vs right"}))
+        return _Raw(json.dumps({"error": "No error", "error_reason": ""}))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return None
+
+def _run(monkeypatch, client, df, journal_dir, **kw):
+    monkeypatch.setattr(llm_call, "_make_async_client", lambda *a, **kw: client)
+    out, _ = asyncio.run(pipeline.get_unstructured_accuracy_async(
+        df, api_key="x", journal_dir=journal_dir, reporter=events.Reporter(), **kw,
+    ))
+    return out[[prompt.COL_ACC1_SCORE, prompt.COL_ACC2_SCORE, prompt.COL_ACC2_JSON]]
+
+def test_rerun_replays_the_journal(tmp_path, monkeypatch):
+    df = pd.DataFrame({"report": [f"CT head {i}. No acute abnormality." for i in range(6)] + ["Fracture of the left radius."]})
+    first = _CountingClient()
+    expected = _run(monkeypatch, first, df, tmp_path)
+    assert first.calls == {prompt.PASS_PREPROCESS: 7, prompt.PASS_ERROR_CHECK: 7, prompt.PASS_FP_CHECK: 1}
+    assert expected[prompt.COL_ACC2_SCORE].tolist() == [1] * 6 + [0]
+
+    again = _CountingClient()
+    pd.testing.assert_frame_equal(_run(monkeypatch, again, df, tmp_path), expected)
+    assert again.calls == {}
+
+def test_torn_last_record_is_requested_again(tmp_path, monkeypatch):
+    df = pd.DataFrame({"report": [f"CT head {i}. No acute abnormality." for i in range(6)]})
+    expected = _run(monkeypatch, _CountingClient(), df, tmp_path)
+    (journal,) = tmp_path.glob("*.jsonl")
+    lines = journal.read_text(encoding="utf-8").splitlines(keepends=True)
+    torn = json.loads(lines[-1])
+    journal.write_text("".join(lines[:-1]) + lines[-1][:20], encoding="utf-8")  # crash mid-write
+
+    again = _CountingClient()
+    pd.testing.assert_frame_equal(_run(monkeypatch, again, df, tmp_path), expected)
+    assert again.calls == {torn["pass"]: 1}
+
+def test_other_options_do_not_replay(tmp_path, monkeypatch):
+    df = pd.DataFrame({"report": [f"CT head {i}. No acute abnormality." for i in range(4)]})
+    _run(monkeypatch, _CountingClient(), df, tmp_path)
+    again = _CountingClient()
+    _run(monkeypatch, again, df, tmp_path, effort_policy=EffortPolicy())
+    assert again.calls == {prompt.PASS_PREPROCESS: 4, prompt.PASS_ERROR_CHECK: 4}
+    assert len(list(tmp_path.glob("*.jsonl"))) == 2
@@ -0,0 +1,53 @@
+import time
+
+import pandas as pd
+from llm_tools import prompt
+from llm_tools.workqueue import WorkQueue, merge, run_worker
+
+def _queue(tmp_path, rows: int = 5, **kw) -> WorkQueue:
+    src = tmp_path / "reports.csv"
+    pd.DataFrame({"report": [f"report {i}" for i in range(rows)]}).to_csv(src, index=False)
+    return WorkQueue.create(tmp_path / "queue", src, model="stub", shard_size=2, **kw)
+
+def _fake_process(df: pd.DataFrame, shard: int) -> pd.DataFrame:
+    """Pass columns without any LLM call, in shuffled row order."""
+    out = df.sample(frac=1, random_state=shard)
+    return out.assign(**{prompt.COL_ACC1_SCORE: 1, prompt.COL_ACC2_SCORE: 1})
+
+def test_expired_lease_is_reassigned(tmp_path):
+    queue = _queue(tmp_path, lease_ttl=0.05)
+    assert queue.lease("a") == 0
+    assert queue.lease("b") == 1
+    time.sleep(0.1)  # a dies without renewing
+    assert queue.status()["expired_leases"] == 2
+    assert queue.lease("c") == 0
+    assert not queue.renew(0, "a")
+    assert not queue.complete(0, "a")
+    assert queue.complete(0, "c")
+
+def test_shard_fails_after_max_attempts(tmp_path):
+    queue = _queue(tmp_path, max_attempts=2)
+    calls = []
+
+    def process(df, shard):
+        calls.append(shard)
+        if shard == 1:
+            raise RuntimeError("boom")
+        return _fake_process(df, shard)
+
+    assert run_worker(queue, process, worker="w", poll_interval=0.01) == 2
+    assert calls.count(1) == 2
+    status = queue.status()
+    assert (status["done"], status["failed"], status["rows_done"]) == (2, 1, 3)
+    assert not queue.result_path(1).exists()
+
+def test_merge_is_in_input_order(tmp_path):
+    queue = _queue(tmp_path, rows=7)
+    assert [queue.lease("w") for _ in range(4)] == [0, 1, 2, 3]
+    for shard in (3, 1, 0, 2):  # finish out of order
+        queue.write_result(shard, _fake_process(queue.load_shard(shard), shard))
+        assert queue.complete(shard, "w")
+    out, (acc1, _) = merge(queue, tmp_path / "merged.csv")
+    merged = pd.read_csv(out)
+    assert merged["report"].tolist() == [f"report {i}" for i in range(7)]
+    assert acc1 == (1.0, 0.0)